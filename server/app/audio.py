@@ -0,0 +1,649 @@
+import audioop
+import hashlib
+import itertools
+import mmap
+import os
+import queue
+import re
+import struct
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .config import CACHE_DIR, FFMPEG_PATH
+
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# the first two bytes of the subformat guid of WAVE_FORMAT_EXTENSIBLE files
+# contain the actual format tag
+KSDATAFORMAT_SUBTYPE_PCM = b"\x01\x00"
+
+# some streaming encoders write these placeholders instead of the real sizes
+UNKNOWN_CHUNK_SIZES = (0, 0xFFFFFFFF)
+
+# Number of seconds of input audio that are converted at once by AudioSource
+CONVERSION_WINDOW_SIZE = 10
+HASH_BLOCK_SIZE = 1024 * 1024
+# Number of bytes read from ffmpeg at once, 64KiB are two seconds of audio
+FFMPEG_READ_SIZE = 64 * 1024
+FFMPEG_DURATION = re.compile(rb"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+class UnsupportedAudioFormat(Exception):
+    pass
+
+
+class UploadAborted(Exception):
+    pass
+
+
+@dataclass
+class WavHeader:
+    channels: int
+    sample_rate: int
+    sample_width: int
+    data_size: Optional[int]
+
+    @property
+    def frame_width(self) -> int:
+        return self.channels * self.sample_width
+
+    @property
+    def duration_seconds(self) -> Optional[float]:
+        if self.data_size is None:
+            return None
+        return self.data_size / (self.frame_width * self.sample_rate)
+
+
+def is_wav(head: bytes) -> bool:
+    return head[:4] == b"RIFF" and head[8:12] == b"WAVE"
+
+
+def parse_fmt_chunk(data: bytes) -> WavHeader:
+    audio_format, channels, sample_rate, _, _, bits_per_sample = struct.unpack(
+        "<HHIIHH", data[:16]
+    )
+    if audio_format == WAVE_FORMAT_EXTENSIBLE and len(data) >= 26:
+        if data[24:26] == KSDATAFORMAT_SUBTYPE_PCM:
+            audio_format = WAVE_FORMAT_PCM
+    if audio_format != WAVE_FORMAT_PCM:
+        raise UnsupportedAudioFormat(f"unsupported wav format 0x{audio_format:04x}")
+    if bits_per_sample not in (8, 16, 24, 32):
+        raise UnsupportedAudioFormat(f"unsupported sample width {bits_per_sample}")
+    return WavHeader(
+        channels=channels,
+        sample_rate=sample_rate,
+        sample_width=bits_per_sample // 8,
+        data_size=None,
+    )
+
+
+def parse_wav(buffer) -> Tuple[WavHeader, int]:
+    """
+    Parses the chunk list of a complete wav file.
+    Returns the header and the offset of the pcm data in the buffer.
+    """
+    if not is_wav(buffer):
+        raise UnsupportedAudioFormat("not a RIFF/WAVE file")
+    header = None
+    position = 12
+    while position + 8 <= len(buffer):
+        chunk_id = bytes(buffer[position : position + 4])
+        (chunk_size,) = struct.unpack("<I", buffer[position + 4 : position + 8])
+        position += 8
+        if chunk_id == b"fmt ":
+            header = parse_fmt_chunk(bytes(buffer[position : position + chunk_size]))
+        elif chunk_id == b"data":
+            if header is None:
+                raise UnsupportedAudioFormat("data chunk before fmt chunk")
+            available = len(buffer) - position
+            if chunk_size in UNKNOWN_CHUNK_SIZES or chunk_size > available:
+                chunk_size = available
+            header.data_size = chunk_size - chunk_size % header.frame_width
+            return header, position
+        position += chunk_size + (chunk_size & 1)
+    raise UnsupportedAudioFormat("wav file without data chunk")
+
+
+class PcmConverter:
+    """
+    Converts interleaved pcm frames of arbitrary width, channel count and sample
+    rate to mono 16 bit SAMPLE_RATE pcm. The resampler state is carried across
+    calls, so the input can be converted in arbitrarily sized chunks.
+    """
+
+    def __init__(self, header: WavHeader, sample_rate: int = SAMPLE_RATE):
+        self.header = header
+        self.sample_rate = sample_rate
+        self.ratecv_state = None
+
+    def convert(self, frames: bytes) -> bytes:
+        width = self.header.sample_width
+        if width == 1:
+            # 8 bit wav files are unsigned
+            frames = audioop.bias(frames, 1, -128)
+        if width != SAMPLE_WIDTH:
+            frames = audioop.lin2lin(frames, width, SAMPLE_WIDTH)
+
+        if self.header.channels == 2:
+            frames = audioop.tomono(frames, SAMPLE_WIDTH, 0.5, 0.5)
+        elif self.header.channels > 2:
+            samples = np.frombuffer(frames, dtype=np.int16)
+            samples = samples.reshape(-1, self.header.channels).mean(axis=1)
+            frames = samples.astype(np.int16).tobytes()
+
+        if self.header.sample_rate != self.sample_rate:
+            frames, self.ratecv_state = audioop.ratecv(
+                frames,
+                SAMPLE_WIDTH,
+                1,
+                self.header.sample_rate,
+                self.sample_rate,
+                self.ratecv_state,
+            )
+        return frames
+
+
+class WavStreamDecoder:
+    """
+    Incrementally parses a RIFF/WAVE byte stream and yields its audio as mono
+    16 bit SAMPLE_RATE pcm as soon as the bytes arrive.
+    """
+
+    def __init__(self, expected_size: Optional[int] = None):
+        self.expected_size = expected_size
+        self.header: Optional[WavHeader] = None
+        self.buffer = bytearray()
+        self.converter: Optional[PcmConverter] = None
+        self.riff_checked = False
+        # number of data chunk bytes that still have to be consumed. None if the
+        # data chunk continues until the end of the stream
+        self.data_remaining: Optional[int] = None
+        self.in_data = False
+        self.done = False
+
+    @property
+    def duration_seconds(self) -> Optional[float]:
+        """The duration of the audio if it is known (or can be estimated) already"""
+        if self.header is None:
+            return None
+        if self.header.duration_seconds is not None:
+            return self.header.duration_seconds
+        if self.expected_size:
+            return self.expected_size / (
+                self.header.frame_width * self.header.sample_rate
+            )
+        return None
+
+    def decode(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        for chunk in chunks:
+            self.buffer += chunk
+            pcm = self._process()
+            if pcm:
+                yield pcm
+        if self.header is None:
+            raise UnsupportedAudioFormat("stream ended before the wav header")
+
+    def _process(self) -> bytes:
+        if not self.riff_checked:
+            if len(self.buffer) < 12:
+                return b""
+            if not is_wav(self.buffer):
+                raise UnsupportedAudioFormat("not a RIFF/WAVE file")
+            del self.buffer[:12]
+            self.riff_checked = True
+
+        if self.done:
+            self.buffer.clear()
+            return b""
+
+        while not self.in_data:
+            if len(self.buffer) < 8:
+                return b""
+            chunk_id = bytes(self.buffer[:4])
+            (chunk_size,) = struct.unpack("<I", self.buffer[4:8])
+            if chunk_id == b"data":
+                if self.header is None:
+                    raise UnsupportedAudioFormat("data chunk before fmt chunk")
+                del self.buffer[:8]
+                if chunk_size not in UNKNOWN_CHUNK_SIZES:
+                    self.data_remaining = chunk_size
+                    self.header.data_size = chunk_size
+                self.in_data = True
+                break
+            padded_size = chunk_size + (chunk_size & 1)
+            if len(self.buffer) < 8 + padded_size:
+                return b""
+            if chunk_id == b"fmt ":
+                self.header = parse_fmt_chunk(bytes(self.buffer[8 : 8 + chunk_size]))
+                self.converter = PcmConverter(self.header)
+            del self.buffer[: 8 + padded_size]
+
+        if not self.in_data:
+            return b""
+
+        available = len(self.buffer)
+        if self.data_remaining is not None:
+            available = min(available, self.data_remaining)
+        # only convert whole frames, the rest stays in the buffer for the next chunk
+        available -= available % self.header.frame_width
+        if available == 0:
+            return b""
+        frames = bytes(self.buffer[:available])
+        del self.buffer[:available]
+        if self.data_remaining is not None:
+            self.data_remaining -= available
+            if self.data_remaining < self.header.frame_width:
+                # everything after the data chunk is metadata we don't care about
+                self.in_data = False
+                self.done = True
+                self.buffer.clear()
+        return self.converter.convert(frames)
+
+
+class FfmpegDecoder:
+    """
+    Decodes any audio or video format ffmpeg knows to mono 16 bit SAMPLE_RATE pcm.
+    The input is fed into ffmpeg while its output is read, so the first samples
+    are available after the first few kilobytes of a compressed file.
+    """
+
+    def __init__(self):
+        self.duration_seconds: Optional[float] = None
+        self.input_error: Optional[BaseException] = None
+        # the last lines of ffmpeg's log, for the error message
+        self.log: deque = deque(maxlen=10)
+
+    def decode(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Decodes a stream, formats that need to seek (e.g. mp4) might fail"""
+        return self._run("pipe:0", chunks)
+
+    def decode_file(self, file: BinaryIO) -> Iterator[bytes]:
+        name = getattr(file, "name", None)
+        if isinstance(name, str) and os.path.isfile(name):
+            return self._run(name, None)
+        try:
+            fileno = file.fileno()
+        except (OSError, ValueError):
+            fileno = None
+        if fileno is not None and os.name == "posix":
+            # ffmpeg can seek in the file if it gets it as a file and not as a pipe
+            file.seek(0)
+            return self._run(f"/dev/fd/{fileno}", None, (fileno,))
+        file.seek(0)
+        return self._run("pipe:0", iter(lambda: file.read(HASH_BLOCK_SIZE), b""))
+
+    def _run(
+        self, source: str, chunks: Optional[Iterable[bytes]], pass_fds=()
+    ) -> Iterator[bytes]:
+        command = [FFMPEG_PATH, "-hide_banner", "-nostats", "-i", source, "-vn"]
+        command += ["-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "pipe:1"]
+        try:
+            process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE if chunks is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                pass_fds=pass_fds,
+            )
+        except OSError as e:
+            raise UnsupportedAudioFormat(
+                f"only wav files can be decoded without ffmpeg: {e}"
+            )
+        threads = [threading.Thread(target=self._read_log, args=(process,))]
+        if chunks is not None:
+            threads.append(threading.Thread(target=self._feed, args=(process, chunks)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        decoded = 0
+        try:
+            while True:
+                pcm = process.stdout.read1(FFMPEG_READ_SIZE)
+                if not pcm:
+                    break
+                # the last byte of a sample might still be missing
+                while len(pcm) % SAMPLE_WIDTH:
+                    rest = process.stdout.read(SAMPLE_WIDTH - len(pcm) % SAMPLE_WIDTH)
+                    if not rest:
+                        break
+                    pcm += rest
+                decoded += len(pcm)
+                yield pcm
+            process.wait()
+            for thread in threads:
+                thread.join()
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+        if self.input_error is not None:
+            raise self.input_error
+        if process.returncode != 0:
+            raise UnsupportedAudioFormat(
+                f"ffmpeg could not decode the file: {b' '.join(self.log).decode()}"
+            )
+        if not decoded:
+            # ffmpeg exits cleanly for some inputs it can't read from a pipe
+            raise UnsupportedAudioFormat(
+                f"ffmpeg decoded no audio: {b' '.join(self.log).decode()}"
+            )
+
+    def _feed(self, process: subprocess.Popen, chunks: Iterable[bytes]):
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # ffmpeg stopped reading, its exit code tells why
+            pass
+        except BaseException as e:
+            self.input_error = e
+            process.kill()
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def _read_log(self, process: subprocess.Popen):
+        for line in process.stderr:
+            line = line.strip()
+            self.log.append(line)
+            match = FFMPEG_DURATION.search(line)
+            if match is not None and self.duration_seconds is None:
+                hours, minutes, seconds = match.groups()
+                self.duration_seconds = (
+                    int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+                )
+        process.stderr.close()
+
+
+class MediaStreamDecoder:
+    """
+    Decodes a stream of a wav file with WavStreamDecoder and any other format
+    with ffmpeg, yielding mono 16 bit SAMPLE_RATE pcm.
+    """
+
+    def __init__(self, expected_size: Optional[int] = None):
+        self.expected_size = expected_size
+        self.decoder = None
+
+    @property
+    def duration_seconds(self) -> Optional[float]:
+        if self.decoder is None:
+            return None
+        return self.decoder.duration_seconds
+
+    def decode(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        chunks = iter(chunks)
+        head = b""
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= 12:
+                break
+        if not head:
+            raise UnsupportedAudioFormat("empty file")
+        if is_wav(head):
+            self.decoder = WavStreamDecoder(self.expected_size)
+        else:
+            self.decoder = FfmpegDecoder()
+        return self.decoder.decode(itertools.chain([head], chunks))
+
+
+class AudioSource:
+    """
+    Exposes the audio of a file as mono 16 bit SAMPLE_RATE samples.
+
+    The pcm data is memory mapped instead of read into memory. If it is not in the
+    target format already, it is converted window by window into a temporary file
+    in CACHE_DIR on first access, so memory usage scales with the window size and
+    not with the length of the file.
+    """
+
+    def __init__(self, file: BinaryIO, header: WavHeader, data_offset: int):
+        self.file = file
+        self.header = header
+        self.data_offset = data_offset
+        # this also rolls spooled temporary files over to disk
+        fileno = file.fileno()
+        file.flush()
+        file.seek(0, 2)
+        self.mmap = None
+        if file.tell() > 0:
+            self.mmap = mmap.mmap(fileno, 0, access=mmap.ACCESS_COPY)
+        self._samples: Optional[np.ndarray] = None
+        self._converted_file = None
+        self._content_hash: Optional[str] = None
+
+    @classmethod
+    def from_wav(cls, file: BinaryIO) -> "AudioSource":
+        file.seek(0, 2)
+        if file.tell() == 0:
+            raise UnsupportedAudioFormat("empty file")
+        source = cls(file, WavHeader(1, SAMPLE_RATE, SAMPLE_WIDTH, None), 0)
+        source.header, source.data_offset = parse_wav(source.mmap)
+        return source
+
+    @classmethod
+    def from_file(
+        cls, file: BinaryIO, content_hash: Optional[str] = None
+    ) -> "AudioSource":
+        """
+        Maps wav files directly, other formats are decoded with ffmpeg into a
+        temporary file in CACHE_DIR. The content hash is the one of the original
+        file in both cases, content_hash saves computing it if it is known.
+        """
+        file.seek(0)
+        if is_wav(file.read(12)):
+            source = cls.from_wav(file)
+            source._content_hash = content_hash
+            return source
+        if content_hash is None:
+            content_hash = file_hash(file)
+        file.seek(0, 2)
+        if file.tell() == 0:
+            raise UnsupportedAudioFormat("empty file")
+        file.seek(0)
+        pcm_file = tempfile.TemporaryFile(dir=CACHE_DIR)
+        try:
+            for pcm in FfmpegDecoder().decode_file(file):
+                pcm_file.write(pcm)
+        except BaseException:
+            pcm_file.close()
+            raise
+        source = cls.from_pcm(pcm_file)
+        # closed together with the source
+        source._converted_file = pcm_file
+        source._content_hash = content_hash
+        return source
+
+    @classmethod
+    def from_pcm(cls, file: BinaryIO) -> "AudioSource":
+        """Wraps a file that contains raw mono 16 bit SAMPLE_RATE pcm"""
+        file.seek(0, 2)
+        size = file.tell()
+        return cls(file, WavHeader(1, SAMPLE_RATE, SAMPLE_WIDTH, size), 0)
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.header.duration_seconds
+
+    def content_hash(self) -> str:
+        """sha256 of the whole file, including the header"""
+        if self._content_hash is not None:
+            return self._content_hash
+        content_hash = hashlib.sha256()
+        if self.mmap is not None:
+            for start in range(0, len(self.mmap), HASH_BLOCK_SIZE):
+                content_hash.update(self.mmap[start : start + HASH_BLOCK_SIZE])
+        return content_hash.hexdigest()
+
+    @property
+    def samples(self) -> np.ndarray:
+        if self._samples is None:
+            self._samples = self._convert()
+        return self._samples
+
+    def _is_target_format(self) -> bool:
+        return self.header == WavHeader(
+            1, SAMPLE_RATE, SAMPLE_WIDTH, self.header.data_size
+        )
+
+    def _convert(self) -> np.ndarray:
+        if not self.header.data_size:
+            return np.zeros(0, dtype=np.int16)
+        if self._is_target_format():
+            return np.frombuffer(
+                self.mmap,
+                dtype=np.int16,
+                count=self.header.data_size // SAMPLE_WIDTH,
+                offset=self.data_offset,
+            )
+
+        converter = PcmConverter(self.header)
+        window = CONVERSION_WINDOW_SIZE * self.header.sample_rate
+        window *= self.header.frame_width
+        end = self.data_offset + self.header.data_size
+        self._converted_file = tempfile.TemporaryFile(dir=CACHE_DIR)
+        for start in range(self.data_offset, end, window):
+            frames = self.mmap[start : min(start + window, end)]
+            self._converted_file.write(converter.convert(frames))
+        self._converted_file.flush()
+
+        if self._converted_file.tell() == 0:
+            return np.zeros(0, dtype=np.int16)
+        return np.memmap(self._converted_file, dtype=np.int16, mode="c")
+
+    def close(self):
+        self._samples = None
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # some views of the samples are still alive somewhere, the mapping
+                # is closed once they are garbage collected
+                pass
+        if self._converted_file is not None:
+            self._converted_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def find_split_points(
+    samples: np.ndarray,
+    chunk_size: float,
+    search_window: float = 5,
+    frame_size: float = 0.01,
+    smoothing: int = 10,
+) -> List[float]:
+    """
+    Finds points (in seconds) to split the audio into chunks of roughly chunk_size
+    seconds. Each split is placed at the quietest point within search_window
+    seconds of the fixed chunk boundary, so we don't cut through words.
+    """
+    frame_length = int(frame_size * SAMPLE_RATE)
+    duration = len(samples) / SAMPLE_RATE
+    split_points = []
+    boundary = chunk_size
+    while boundary < duration - chunk_size / 2:
+        start = max(int((boundary - search_window) * SAMPLE_RATE), 0)
+        end = min(int((boundary + search_window) * SAMPLE_RATE), len(samples))
+        frames = samples[start:end]
+        frames = frames[: len(frames) - len(frames) % frame_length]
+        energy = np.square(frames.reshape(-1, frame_length), dtype=np.float64)
+        energy = energy.mean(axis=1)
+        # sum over a few frames, so we prefer pauses over single quiet frames
+        window = min(smoothing, len(energy))
+        energy = np.convolve(energy, np.ones(window), mode="valid")
+        quietest = int(np.argmin(energy)) + window // 2
+        split_points.append((start + (quietest + 0.5) * frame_length) / SAMPLE_RATE)
+        boundary = split_points[-1] + chunk_size
+    return split_points
+
+
+def file_hash(file: BinaryIO) -> str:
+    """sha256 of the whole file"""
+    file.seek(0)
+    content_hash = hashlib.sha256()
+    for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+        content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+class ChunkStream:
+    """
+    Hands the chunks of a request body from the event loop to the thread that
+    decodes them. The queue is bounded, so a slow decoder applies backpressure to
+    the upload instead of buffering the whole file in memory.
+    The sha256 of the consumed chunks is computed on the way.
+    """
+
+    def __init__(self, maxsize: int = 64):
+        self.queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.content_hash = hashlib.sha256()
+        self.consumer_done = False
+        self.aborted = False
+        # why the consumer stopped early, if it failed
+        self.error: Optional[BaseException] = None
+
+    def offer(self, chunk: Optional[bytes]) -> bool:
+        """Queues the chunk without waiting, False if the queue is full"""
+        if self.consumer_done or self.aborted:
+            return True
+        try:
+            self.queue.put_nowait(chunk)
+        except queue.Full:
+            return False
+        return True
+
+    def put(self, chunk: Optional[bytes]):
+        # if the consumer stopped early (e.g. because of an invalid file), we
+        # drop the rest of the upload instead of blocking forever
+        while not self.consumer_done and not self.aborted:
+            try:
+                self.queue.put(chunk, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        self.put(None)
+
+    def abort(self):
+        self.aborted = True
+
+    def finish(self, error: Optional[BaseException] = None):
+        """Called by the consumer once it stopped reading, also if it never started"""
+        if error is not None:
+            self.error = error
+        self.consumer_done = True
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            while True:
+                try:
+                    chunk = self.queue.get(timeout=0.5)
+                except queue.Empty:
+                    chunk = b""
+                if self.aborted:
+                    raise UploadAborted()
+                if chunk is None:
+                    return
+                if chunk:
+                    self.content_hash.update(chunk)
+                    yield chunk
+        finally:
+            self.finish()
@@ -0,0 +1,103 @@
+import json
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Optional
+
+from .config import CACHE_DIR, DIARIZATION_CACHE_SIZE, RESULT_CACHE_SIZE
+
+# keys are made of hex digests, joined by "-"
+KEY_PREFIX = re.compile(r"[0-9a-f-]*")
+
+
+class DiskCache:
+    """
+    A size bounded cache of json values, stored as one file per key in a
+    directory. Once the cache grows beyond max_size bytes, the least recently
+    used entries are removed.
+    """
+
+    def __init__(self, directory: Path, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.directory.mkdir(exist_ok=True, parents=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                value = json.load(f)
+            # the modification time is used as the last access time for eviction
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any):
+        # write to a temporary file first, so readers never see partial entries
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.directory, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(value, f)
+        os.replace(f.name, self._path(key))
+        self.evict()
+
+    def delete(self, prefix: str = "") -> int:
+        """Removes all entries whose key starts with prefix"""
+        # the prefix becomes part of a glob pattern, it must not leave the directory
+        if not KEY_PREFIX.fullmatch(prefix):
+            raise ValueError(f"invalid cache key prefix {prefix!r}")
+        removed = 0
+        with self.lock:
+            for path in self.directory.glob(f"{prefix}*.json"):
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def _entries(self):
+        entries = []
+        for path in self.directory.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        with self.lock:
+            entries = self._entries()
+            size = sum(entry_size for _, entry_size, _ in entries)
+            for _, entry_size, path in entries:
+                if size <= self.max_size:
+                    break
+                path.unlink(missing_ok=True)
+                size -= entry_size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self._entries()
+        return {
+            "entries": len(entries),
+            "size": sum(entry_size for _, entry_size, _ in entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+result_cache = DiskCache(CACHE_DIR / "results", RESULT_CACHE_SIZE)
+diarization_cache = DiskCache(CACHE_DIR / "diarization", DIARIZATION_CACHE_SIZE)
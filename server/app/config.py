@@ -12,3 +12,93 @@ CACHE_DIR = Path(
     os.environ.get("AUDAPOLIS_CACHE_DIR", appdirs.user_cache_dir("audapolis"))
 )
 CACHE_DIR.mkdir(exist_ok=True, parents=True)
+
+# Upper bound for the memory used by loaded models (in bytes). The size of a model
+# is estimated by its size on disk.
+MODEL_CACHE_SIZE = int(os.environ.get("AUDAPOLIS_MODEL_CACHE_SIZE", 4 * 1024**3))
+# Number of seconds after which unused models are unloaded
+MODEL_CACHE_IDLE_TIMEOUT = float(
+    os.environ.get("AUDAPOLIS_MODEL_CACHE_IDLE_TIMEOUT", 30 * 60)
+)
+# Comma separated list of model ids that are loaded (and kept loaded) on startup
+PRELOAD_MODELS = [
+    model_id.strip()
+    for model_id in os.environ.get("AUDAPOLIS_PRELOAD_MODELS", "").split(",")
+    if model_id.strip()
+]
+# Maximum number of recognizers that exist per loaded model, this also limits how
+# many segments of one file are transcribed in parallel
+RECOGNIZER_POOL_SIZE = int(
+    os.environ.get("AUDAPOLIS_RECOGNIZER_POOL_SIZE", os.cpu_count() or 1)
+)
+# Maximum number of jobs of each type that run at the same time
+MAX_CONCURRENT_TRANSCRIPTIONS = int(
+    os.environ.get("AUDAPOLIS_MAX_CONCURRENT_TRANSCRIPTIONS", os.cpu_count() or 1)
+)
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("AUDAPOLIS_MAX_CONCURRENT_DOWNLOADS", 2))
+MAX_CONCURRENT_PRELOADS = 1
+# Number of worker threads that run queued jobs (transcriptions, downloads, ...).
+# By default every job type can use all of its limit at the same time, so running
+# transcriptions can't starve downloads and preloads
+WORKERS = int(
+    os.environ.get(
+        "AUDAPOLIS_WORKERS",
+        MAX_CONCURRENT_TRANSCRIPTIONS
+        + MAX_CONCURRENT_DOWNLOADS
+        + MAX_CONCURRENT_PRELOADS,
+    )
+)
+# Default number of files of a batch (see /tasks/start_transcription_batch/) that
+# are transcribed at the same time
+BATCH_CONCURRENCY = int(os.environ.get("AUDAPOLIS_BATCH_CONCURRENCY", 2))
+# Long files are split into chunks of roughly this many seconds (cut at the
+# quietest point near each boundary) that are transcribed in parallel. 0 disables
+# the splitting
+PARALLEL_CHUNK_SIZE = float(os.environ.get("AUDAPOLIS_PARALLEL_CHUNK_SIZE", 300))
+# Where the segments of a file are transcribed: "thread" runs them in threads of
+# the server process, "process" in a pool of AUDAPOLIS_PROCESS_WORKERS worker
+# processes that each load their own copy of the model
+TRANSCRIPTION_BACKEND = os.environ.get("AUDAPOLIS_TRANSCRIPTION_BACKEND", "thread")
+PROCESS_WORKERS = int(os.environ.get("AUDAPOLIS_PROCESS_WORKERS", os.cpu_count() or 1))
+# Maximum size of the on-disk cache of transcription results (in bytes)
+RESULT_CACHE_SIZE = int(os.environ.get("AUDAPOLIS_RESULT_CACHE_SIZE", 1024**3))
+# Maximum size of the on-disk cache of speaker diarization segments (in bytes)
+DIARIZATION_CACHE_SIZE = int(
+    os.environ.get("AUDAPOLIS_DIARIZATION_CACHE_SIZE", 256 * 1024**2)
+)
+# Number of seconds between saves of the task database
+TASK_SAVE_INTERVAL = float(os.environ.get("AUDAPOLIS_TASK_SAVE_INTERVAL", 2))
+# Transcriptions of at least this many seconds of audio save their finished
+# utterances (and a copy of the audio), so they can be resumed after a restart
+CHECKPOINT_MIN_DURATION = float(
+    os.environ.get("AUDAPOLIS_CHECKPOINT_MIN_DURATION", 10 * 60)
+)
+# Number of seconds after which the results of finished tasks are dropped from
+# memory if nobody requested them. They stay in the task database and are loaded
+# again when needed
+RESULT_IDLE_TIMEOUT = float(os.environ.get("AUDAPOLIS_RESULT_IDLE_TIMEOUT", 10 * 60))
+# Upper bound for the memory used by results of finished tasks (in bytes), the
+# least recently used ones are dropped from memory first
+RESULT_MEMORY_LIMIT = int(
+    os.environ.get("AUDAPOLIS_RESULT_MEMORY_LIMIT", 512 * 1024**2)
+)
+# Number of seconds after which finished tasks are deleted, 0 keeps them until a
+# client deletes them
+TASK_TTL = float(os.environ.get("AUDAPOLIS_TASK_TTL", 7 * 24 * 60 * 60))
+# ffmpeg executable used to decode uploads that are not wav files (compressed
+# audio and video)
+FFMPEG_PATH = os.environ.get("AUDAPOLIS_FFMPEG", "ffmpeg")
+# Directories (separated by os.pathsep) whose files can be transcribed by their
+# path instead of being uploaded, see /tasks/start_transcription_local/. Empty by
+# default, which disables transcribing by path
+ALLOWED_ROOTS = [
+    Path(root).expanduser().resolve()
+    for root in os.environ.get("AUDAPOLIS_ALLOWED_ROOTS", "").split(os.pathsep)
+    if root
+]
+# Number of parallel connections used to download a model, if the server supports
+# range requests
+DOWNLOAD_CONNECTIONS = int(os.environ.get("AUDAPOLIS_DOWNLOAD_CONNECTIONS", 4))
+# Size of the parts (in bytes) a model download is split into. Interrupted
+# downloads continue with the first part that was not finished
+DOWNLOAD_PART_SIZE = int(os.environ.get("AUDAPOLIS_DOWNLOAD_PART_SIZE", 16 * 1024**2))
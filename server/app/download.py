@@ -0,0 +1,406 @@
+"""
+Downloads of big files (e.g. models) over several connections, using HTTP range
+requests. The downloaded parts are recorded in the directory of the download, so
+an interrupted download continues where it stopped, also after a restart.
+"""
+
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from .config import DOWNLOAD_CONNECTIONS, DOWNLOAD_PART_SIZE
+
+CHUNK_SIZE = 1024 * 1024
+# Number of times a part is retried after a failed request, continuing from where
+# the last attempt stopped
+RETRIES = 3
+TIMEOUT = (10, 60)
+
+
+class DownloadCanceled(Exception):
+    pass
+
+
+class DownloadFailed(Exception):
+    pass
+
+
+class FileChanged(DownloadFailed):
+    pass
+
+
+@dataclass
+class DownloadState:
+    url: str
+    size: int
+    # ETag or Last-Modified of the file, parts of different versions of a file
+    # are never mixed
+    validator: Optional[str]
+    # (start, end) of the finished parts
+    done: List[Tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def downloaded(self) -> int:
+        return sum(end - start for start, end in self.done)
+
+
+@dataclass
+class RemoteFile:
+    size: Optional[int]
+    validator: Optional[str]
+    accepts_ranges: bool
+
+
+def probe(session: requests.Session, url: str) -> RemoteFile:
+    """Asks for the first byte, which tells the size and whether ranges work"""
+    with session.get(
+        url, headers={"Range": "bytes=0-0"}, stream=True, timeout=TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        etag = response.headers.get("ETag")
+        validator = (
+            etag
+            if etag is not None and not etag.startswith("W/")
+            else response.headers.get("Last-Modified")
+        )
+        if response.status_code == 206:
+            size = int(response.headers["Content-Range"].split("/")[1])
+            return RemoteFile(size, validator, True)
+        size = response.headers.get("Content-Length")
+        return RemoteFile(int(size) if size is not None else None, validator, False)
+
+
+def load_state(path: Path) -> Optional[DownloadState]:
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return DownloadState(
+        data["url"],
+        data["size"],
+        data["validator"],
+        [tuple(part) for part in data["done"]],
+    )
+
+
+def save_state(path: Path, state: DownloadState):
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(asdict(state), f)
+    os.replace(tmp_path, path)
+
+
+def missing_parts(state: DownloadState, part_size: int) -> List[Tuple[int, int]]:
+    done = set(state.done)
+    return [
+        (start, min(start + part_size, state.size))
+        for start in range(0, state.size, part_size)
+        if (start, min(start + part_size, state.size)) not in done
+    ]
+
+
+class RangeDownload:
+    """
+    A download running in the background (see start and wait). The file can be
+    read while it is downloaded, reads wait until their bytes arrived.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        directory: Path,
+        progress_callback: Callable[[int, int], None],
+        canceled: Callable[[], bool] = lambda: False,
+        connections: int = DOWNLOAD_CONNECTIONS,
+        part_size: int = DOWNLOAD_PART_SIZE,
+    ):
+        self.url = url
+        self.directory = directory
+        self.progress_callback = progress_callback
+        self.canceled = canceled
+        self.connections = connections
+        self.part_size = part_size
+        self.data_path = directory / "data"
+        self.state_path = directory / "state.json"
+        # guards everything below, notified whenever data was written
+        self.condition = threading.Condition()
+        self.stop = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.state: Optional[DownloadState] = None
+        self.size: Optional[int] = None
+        self.processed = 0
+        # (start, end) of all parts, in order
+        self.parts: List[Tuple[int, int]] = []
+        # how far each part was written, by the end of the part
+        self.positions: Dict[int, int] = {}
+        self.finished = False
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> "RangeDownload":
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def wait(self) -> Path:
+        """Waits for the download and returns the path of the file"""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.data_path
+
+    def reader(self) -> "DownloadReader":
+        return DownloadReader(self)
+
+    def _run(self):
+        try:
+            self._download()
+        except BaseException as e:
+            with self.condition:
+                if self.error is None:
+                    self.error = e
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def _written(self, part_end: int, position: int, added: int):
+        with self.condition:
+            self.positions[part_end] = position
+            self.processed += added
+            self.progress_callback(self.processed, self.size or 0)
+            self.condition.notify_all()
+
+    def available(self) -> int:
+        """Number of bytes from the start of the file that were downloaded"""
+        with self.condition:
+            if self.finished and self.error is None:
+                return self.processed if self.size is None else self.size
+            for _, end in self.parts:
+                if self.positions[end] < end:
+                    return self.positions[end]
+            return self.parts[-1][1] if self.parts else 0
+
+    def wait_for(self, end: int):
+        """Waits until the first end bytes of the file were downloaded"""
+        with self.condition:
+            while True:
+                if self.error is not None:
+                    raise self.error
+                if self.size is not None:
+                    end = min(end, self.size)
+                if self.finished or self.available() >= end:
+                    return
+                self.condition.wait()
+
+    def _check_stop(self):
+        if self.canceled():
+            self.stop.set()
+            raise DownloadCanceled()
+        if self.stop.is_set():
+            raise DownloadCanceled()
+
+    def _download(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with requests.Session() as session:
+            remote = probe(session, self.url)
+        if not remote.accepts_ranges or remote.size is None:
+            self._download_whole()
+            return
+
+        state = load_state(self.state_path)
+        if (
+            state is None
+            or state.url != self.url
+            or state.size != remote.size
+            or state.validator != remote.validator
+            or not self.data_path.exists()
+        ):
+            # the file changed on the server (or nothing was downloaded yet)
+            self.data_path.unlink(missing_ok=True)
+            state = DownloadState(self.url, remote.size, remote.validator)
+            save_state(self.state_path, state)
+
+        parts = queue.Queue()
+        for part in missing_parts(state, self.part_size):
+            parts.put(part)
+        fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT)
+        try:
+            os.ftruncate(fd, state.size)
+            with self.condition:
+                self.state = state
+                self.size = state.size
+                self.processed = state.downloaded
+                self.parts = sorted(state.done + list(parts.queue))
+                done = set(state.done)
+                self.positions = {
+                    end: end if (start, end) in done else start
+                    for start, end in self.parts
+                }
+                self.progress_callback(self.processed, state.size)
+            workers = [
+                threading.Thread(target=self._work, args=(parts, fd), daemon=True)
+                for _ in range(min(self.connections, parts.qsize()))
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if self.error is not None:
+            raise self.error
+        if state.downloaded != state.size:
+            raise DownloadFailed(f"only got {state.downloaded} of {state.size} bytes")
+
+    def _work(self, parts: queue.Queue, fd: int):
+        with requests.Session() as session:
+            while not self.stop.is_set():
+                try:
+                    part = parts.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self._download_part(session, fd, *part)
+                except BaseException as e:
+                    with self.condition:
+                        if self.error is None:
+                            self.error = e
+                        self.condition.notify_all()
+                    self.stop.set()
+                    return
+                # the part is only recorded once its data is on disk
+                os.fsync(fd)
+                with self.condition:
+                    self.state.done.append(part)
+                    save_state(self.state_path, self.state)
+
+    def _download_part(self, session: requests.Session, fd: int, start: int, end: int):
+        position = start
+        for attempt in range(RETRIES + 1):
+            try:
+                for written in self._write_range(session, fd, position, end):
+                    position += written
+                if position != end:
+                    raise DownloadFailed(f"range ended at {position} instead of {end}")
+                return
+            except FileChanged:
+                raise
+            except (requests.RequestException, DownloadFailed):
+                if attempt == RETRIES:
+                    raise
+                traceback.print_exc()
+                time.sleep(attempt + 1)
+                self._check_stop()
+
+    def _write_range(
+        self, session: requests.Session, fd: int, position: int, end: int
+    ) -> Iterator[int]:
+        """Requests the range from position to end, yields the written sizes"""
+        headers = {"Range": f"bytes={position}-{end - 1}"}
+        if self.state.validator is not None:
+            # the server sends the whole (new) file instead, if it changed
+            headers["If-Range"] = self.state.validator
+        with session.get(
+            self.url, headers=headers, stream=True, timeout=TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            content_range = f"bytes {position}-{end - 1}/{self.state.size}"
+            if (
+                response.status_code != 206
+                or response.headers.get("Content-Range") != content_range
+            ):
+                # the next download starts over
+                self.state_path.unlink(missing_ok=True)
+                raise FileChanged("the file changed on the server")
+            for data in response.iter_content(CHUNK_SIZE):
+                self._check_stop()
+                data = data[: end - position]
+                os.pwrite(fd, data, position)
+                position += len(data)
+                self._written(end, position, len(data))
+                yield len(data)
+
+    def _download_whole(self):
+        """Fallback for servers without range requests, this can't be resumed"""
+        self.state_path.unlink(missing_ok=True)
+        with requests.get(self.url, stream=True, timeout=TIMEOUT) as response:
+            response.raise_for_status()
+            size = response.headers.get("Content-Length")
+            self.data_path.write_bytes(b"")
+            with self.condition:
+                self.size = int(size) if size is not None else None
+                self.parts = [(0, self.size or sys.maxsize)]
+                self.positions = {self.parts[0][1]: 0}
+            with open(self.data_path, "r+b") as f:
+                for data in response.iter_content(CHUNK_SIZE):
+                    self._check_stop()
+                    f.write(data)
+                    # readers use their own file
+                    f.flush()
+                    self._written(
+                        self.parts[0][1], self.processed + len(data), len(data)
+                    )
+        if self.size is not None and self.processed != self.size:
+            raise DownloadFailed(f"only got {self.processed} of {self.size} bytes")
+
+
+class DownloadReader(io.RawIOBase):
+    """Reads a file from the start while it is downloaded"""
+
+    def __init__(self, download: RangeDownload):
+        self.download = download
+        self.position = 0
+        self.file = None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        self.download.wait_for(self.position + len(buffer))
+        if self.file is None:
+            self.file = open(self.download.data_path, "rb")
+        available = self.download.available() - self.position
+        self.file.seek(self.position)
+        n = self.file.readinto(memoryview(buffer)[: max(available, 0)])
+        self.position += n
+        return n
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        super().close()
+
+
+def download_file(
+    url: str,
+    directory: Path,
+    progress_callback: Callable[[int, int], None],
+    canceled: Callable[[], bool] = lambda: False,
+    connections: int = DOWNLOAD_CONNECTIONS,
+    part_size: int = DOWNLOAD_PART_SIZE,
+) -> Path:
+    """
+    Downloads url into directory and returns the path of the file. The progress
+    callback gets the number of downloaded bytes and the size of the file. Calling
+    this again with the same directory continues an interrupted download.
+    """
+    return (
+        RangeDownload(
+            url, directory, progress_callback, canceled, connections, part_size
+        )
+        .start()
+        .wait()
+    )
@@ -0,0 +1,63 @@
+import asyncio
+import threading
+from typing import Any, List, Tuple
+
+
+class Notifier:
+    """
+    Wakes up request handlers that wait for something to change, from any
+    thread. Handlers take a waiter before checking their condition, so they
+    can't miss a notification that happens in between.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def waiter(self) -> asyncio.Event:
+        waiter = asyncio.Event()
+        with self.lock:
+            self.waiters.append((asyncio.get_running_loop(), waiter))
+        return waiter
+
+    def notify(self):
+        with self.lock:
+            waiters, self.waiters = self.waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(waiter.set)
+            except RuntimeError:
+                # the loop of a disconnected client might be closed already
+                pass
+
+
+class EventLog:
+    """
+    An append only list of events. Events are added by worker threads, request
+    handlers can wait for new ones without blocking a thread.
+    """
+
+    def __init__(self):
+        self.events: List[Any] = []
+        self.closed = False
+        self.notifier = Notifier()
+
+    def append(self, event: Any):
+        self.events.append(event)
+        self.notifier.notify()
+
+    def close(self):
+        self.closed = True
+        self.notifier.notify()
+
+    async def wait(self, since: int) -> Tuple[List[Any], bool]:
+        """
+        Waits until there are events after the first since events or the log is
+        closed. Returns the new events and whether the log is closed.
+        """
+        while True:
+            waiter = self.notifier.waiter()
+            closed = self.closed
+            if len(self.events) > since or closed:
+                return self.events[since:], closed
+            await waiter.wait()
@@ -1,33 +1,62 @@
+import asyncio
 import base64
 import json
 import os
+from concurrent.futures import Future
 from typing import List, Optional
 
 from fastapi import (
-    BackgroundTasks,
     Depends,
     FastAPI,
     File,
     Form,
     HTTPException,
+    Query,
     Request,
     UploadFile,
 )
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.requests import ClientDisconnect
 from starlette.status import HTTP_401_UNAUTHORIZED
 
+from .audio import ChunkStream, UnsupportedAudioFormat, file_hash
+from .cache import diarization_cache, result_cache
+from .config import BATCH_CONCURRENCY, PRELOAD_MODELS
 from .models import (
+    DownloadModelState,
     DownloadModelTask,
     LanguageDoesNotExist,
     ModelDoesNotExist,
     ModelNotDownloaded,
     ModelTypeNotSupported,
+    PreloadModelTask,
     models,
 )
 from .otio import Segment, convert_otio
-from .tasks import TaskNotFoundError, tasks
-from .transcribe import TranscriptionState, TranscriptionTask, process_audio
+from .results import encode_json, result_response
+from .scheduler import JobType, scheduler
+from .tasks import TaskNotFoundError, task_changes, tasks
+from .transcribe import (
+    BatchTranscriptionState,
+    BatchTranscriptionTask,
+    LocalFileNotFound,
+    PathNotAllowed,
+    TranscriptionState,
+    TranscriptionTask,
+    answer_from_cache,
+    live_transcripts,
+    local_file,
+    process_audio,
+    process_audio_stream,
+    process_local_file,
+    resume_transcription,
+    source_hash,
+    start_batch,
+)
+from .transcript import Transcript
 
 app = FastAPI()
 origins = ["*"]
@@ -40,9 +69,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Seconds after which an idle event stream sends a comment, so proxies keep the
+# connection open
+EVENT_STREAM_KEEPALIVE = 15
+# Minimum number of seconds between two batches of task events sent to a client,
+# changes in between are coalesced
+TASK_EVENT_INTERVAL = 0.1
+# Seconds between attempts to hand a chunk of a streaming upload to its job, while
+# the job is queued or decodes slower than the upload
+STREAM_RETRY_INTERVAL = 0.02
+# Upper bound for the time a long poll for task changes waits
+MAX_LONG_POLL_TIMEOUT = 60
+
+# sha256 hex digests, or a prefix of one
+AUDIO_HASH_PATTERN = r"^[0-9a-f]{1,64}$"
+
 AUTH_TOKEN = base64.b64encode(os.urandom(64)).decode()
 
 
+def encode_task(task, result=None):
+    """
+    The public json of a task. result replaces the result of the task, which is not
+    in memory if it was not used for a while (see Tasks.load_result).
+    Transcription results are kept as columns and only converted into paragraphs
+    here.
+    """
+    if task.result_field is None:
+        return jsonable_encoder(task)
+    if result is None:
+        result = getattr(task, task.result_field)
+    data = jsonable_encoder(task, exclude={task.result_field})
+    data[task.result_field] = jsonable_encoder(
+        result, custom_encoder={Transcript: Transcript.to_list}
+    )
+    return data
+
+
 def token_auth(request: Request):
     authorization: str = request.headers.get("Authorization")
     if authorization != f"Bearer {AUTH_TOKEN}":
@@ -52,15 +114,42 @@ def token_auth(request: Request):
 
 @app.on_event("startup")
 def startup_event():
+    # continue the jobs that were interrupted by the last shutdown
+    for task in tasks.restore():
+        if isinstance(task, TranscriptionTask) and task.state not in (
+            TranscriptionState.DONE,
+            TranscriptionState.FAILED,
+        ):
+            scheduler.submit(
+                task, JobType.TRANSCRIPTION, resume_transcription, task.uuid
+            )
+        elif isinstance(task, DownloadModelTask) and task.state not in (
+            DownloadModelState.DONE,
+            DownloadModelState.CANCELED,
+            DownloadModelState.FAILED,
+        ):
+            scheduler.submit(
+                task, JobType.DOWNLOAD, models.download, task.model_id, task.uuid
+            )
+    for model_id in PRELOAD_MODELS:
+        task = tasks.add(PreloadModelTask(model_id))
+        scheduler.submit(
+            task, JobType.PRELOAD, models.preload, model_id, task.uuid, priority=1
+        )
     print(json.dumps({"msg": "server_started", "token": AUTH_TOKEN}), flush=True)
 
 
+@app.on_event("shutdown")
+def shutdown_event():
+    tasks.save()
+
+
 @app.post("/tasks/start_transcription/")
 async def start_transcription(
-    background_tasks: BackgroundTasks,
     transcription_model: str,
     diarize_max_speakers: Optional[int] = None,
     diarize: bool = False,
+    priority: int = 0,
     file: UploadFile = File(...),
     fileName: str = Form(...),
     auth: str = Depends(token_auth),
@@ -71,7 +160,21 @@ async def start_transcription(
             TranscriptionState.QUEUED,
         )
     )
-    background_tasks.add_task(
+    # the spooled upload is still in the page cache, so hashing it is cheap
+    audio_hash = await run_in_threadpool(file_hash, file.file)
+    if await run_in_threadpool(
+        answer_from_cache,
+        task,
+        audio_hash,
+        transcription_model,
+        fileName,
+        diarize,
+        diarize_max_speakers,
+    ):
+        return encode_task(task)
+    scheduler.submit(
+        task,
+        JobType.TRANSCRIPTION,
         process_audio,
         transcription_model,
         file.file,
@@ -79,35 +182,397 @@ async def start_transcription(
         task.uuid,
         diarize,
         diarize_max_speakers,
+        audio_hash,
+        priority=priority,
     )
-    return task
+    return encode_task(task)
+
+
+async def put_chunk(stream: ChunkStream, chunk: Optional[bytes]):
+    # waits in the event loop: uploads of queued jobs would otherwise hold a
+    # threadpool thread each until their job starts
+    while not stream.offer(chunk):
+        await asyncio.sleep(STREAM_RETRY_INTERVAL)
+    if stream.error is not None:
+        # the job failed or was dropped, the rest of the upload isn't read
+        raise stream.error
+
+
+@app.post("/tasks/start_transcription_stream/")
+async def start_transcription_stream(
+    request: Request,
+    transcription_model: str,
+    fileName: str,
+    diarize_max_speakers: Optional[int] = None,
+    diarize: bool = False,
+    priority: int = 0,
+    audio_hash: Optional[str] = Query(None, regex=r"^[0-9a-f]{64}$"),
+    auth: str = Depends(token_auth),
+):
+    """
+    Like start_transcription, but takes the raw file as the request body. wav files
+    are decoded directly, other audio and video formats with ffmpeg (formats that
+    need to seek, like mp4 with its index at the end, only work with
+    start_transcription). Decoding and recognition start while the upload is still
+    in progress.
+    While the job is queued, the upload is stalled.
+    The server only knows the hash of the file once the upload is complete.
+    Clients that know it (the sha256 of the file) can pass it as audio_hash, a
+    cached result is then returned without reading the upload.
+    """
+    task = tasks.add(
+        TranscriptionTask(
+            fileName,
+            TranscriptionState.QUEUED,
+        )
+    )
+    if audio_hash is not None and await run_in_threadpool(
+        answer_from_cache,
+        task,
+        audio_hash,
+        transcription_model,
+        fileName,
+        diarize,
+        diarize_max_speakers,
+    ):
+        return encode_task(task)
+    content_length = request.headers.get("content-length")
+    stream = ChunkStream()
+    future = scheduler.submit(
+        task,
+        JobType.TRANSCRIPTION,
+        process_audio_stream,
+        transcription_model,
+        stream,
+        fileName,
+        task.uuid,
+        diarize,
+        diarize_max_speakers,
+        int(content_length) if content_length else None,
+        priority=priority,
+    )
+
+    def job_done(future: Future):
+        # the job is dropped without running if the task is deleted while queued
+        if future.cancelled():
+            stream.finish(TaskNotFoundError("the task was deleted"))
+
+    future.add_done_callback(job_done)
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await put_chunk(stream, chunk)
+        await put_chunk(stream, None)
+    except ClientDisconnect:
+        stream.abort()
+        tasks.delete(task.uuid)
+        scheduler.drop_deleted()
+        raise
+    except Exception as e:
+        if e is stream.error and task.uuid in tasks.tasks:
+            tasks.delete(task.uuid)
+        raise
+    return encode_task(task)
+
+
+@app.post("/tasks/start_transcription_local/")
+async def start_transcription_local(
+    transcription_model: str,
+    path: str,
+    fileName: Optional[str] = None,
+    diarize_max_speakers: Optional[int] = None,
+    diarize: bool = False,
+    priority: int = 0,
+    auth: str = Depends(token_auth),
+):
+    """
+    Like start_transcription, but for a file on this machine, given by its path
+    (which has to be in one of the AUDAPOLIS_ALLOWED_ROOTS, there are none by
+    default). The file is read where it is instead of being uploaded, and long
+    transcriptions are resumed from it instead of a copy of the audio. Only files
+    that are not 16 kHz mono wav are converted into a temporary file first.
+    """
+    resolved = local_file(path)
+    try:
+        audio_hash = await run_in_threadpool(source_hash, resolved)
+    except OSError as e:
+        raise LocalFileNotFound(f"{path} can't be read: {e.strerror}")
+    task = tasks.add(
+        TranscriptionTask(
+            fileName or resolved.name,
+            TranscriptionState.QUEUED,
+        )
+    )
+    if await run_in_threadpool(
+        answer_from_cache,
+        task,
+        audio_hash,
+        transcription_model,
+        fileName or resolved.name,
+        diarize,
+        diarize_max_speakers,
+    ):
+        return encode_task(task)
+    scheduler.submit(
+        task,
+        JobType.TRANSCRIPTION,
+        process_local_file,
+        transcription_model,
+        resolved,
+        fileName or resolved.name,
+        task.uuid,
+        diarize,
+        diarize_max_speakers,
+        audio_hash,
+        priority=priority,
+    )
+    return encode_task(task)
+
+
+@app.post("/tasks/start_transcription_batch/")
+async def start_transcription_batch(
+    transcription_model: str,
+    diarize_max_speakers: Optional[int] = None,
+    diarize: bool = False,
+    priority: int = 0,
+    max_parallel: int = BATCH_CONCURRENCY,
+    files: List[UploadFile] = File([]),
+    paths: List[str] = Form([]),
+    auth: str = Depends(token_auth),
+):
+    """
+    Transcribes several files with the same model and settings: uploaded files
+    and/or files on this machine, given by their paths (like
+    start_transcription_local). The model is loaded once for the whole batch and
+    at most max_parallel files are transcribed at the same time. Files with a
+    cached result are answered without a job.
+    Every file gets a transcription task of its own, which holds its result. The
+    batch task lists them with their state and progress, and the aggregate
+    progress of the batch.
+    """
+    if not files and not paths:
+        raise HTTPException(status_code=400, detail="No files given")
+    models.get_model_description(transcription_model)
+    resolved = [local_file(path) for path in paths]
+
+    sources = [file.file for file in files] + resolved
+    children = [
+        tasks.add(TranscriptionTask(name, TranscriptionState.QUEUED))
+        for name in [file.filename for file in files] + [path.name for path in resolved]
+    ]
+    batch = tasks.add(
+        BatchTranscriptionTask(
+            transcription_model,
+            diarize,
+            diarize_max_speakers,
+            BatchTranscriptionState.TRANSCRIBING,
+        )
+    )
+    batch.update(children)
+    start_batch(batch, children, sources, max(max_parallel, 1), priority)
+    return encode_task(batch)
 
 
 @app.post("/tasks/download_model/")
 async def download_model(
-    background_tasks: BackgroundTasks,
     model_id: str,
+    priority: int = 0,
     auth: str = Depends(token_auth),
 ):
+    # concurrent requests for the same model share one download
+    task = models.find_download(model_id)
+    if task is not None:
+        return task
     task = tasks.add(DownloadModelTask(model_id))
-    background_tasks.add_task(models.download, model_id, task.uuid)
+    scheduler.submit(
+        task, JobType.DOWNLOAD, models.download, model_id, task.uuid, priority=priority
+    )
     return task
 
 
 # FIXME: this needs to be removed / put behind proper auth for security reasons
 @app.get("/tasks/list/")
-async def list_tasks(auth: str = Depends(token_auth)):
-    return sorted(tasks.list(), key=lambda x: x.uuid)
+async def list_tasks(
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    changed_since: Optional[int] = None,
+    auth: str = Depends(token_auth),
+):
+    """
+    Summaries of the tasks, ordered by uuid. Pass the returned next_cursor as
+    cursor to get the next page. With changed_since, only tasks that changed after
+    that version are listed, together with the uuids of deleted tasks.
+    """
+    version = tasks.latest_version()
+    if changed_since is None:
+        selected, deleted = list(tasks.list()), None
+    else:
+        selected, deleted = tasks.changes(changed_since)
+    selected = sorted(
+        (task for task in selected if cursor is None or task.uuid > cursor),
+        key=lambda task: task.uuid,
+    )
+    page = selected[: max(limit, 1)]
+    response = {
+        "tasks": [task.summary() for task in page],
+        "next_cursor": page[-1].uuid if len(selected) > len(page) else None,
+        "version": version,
+    }
+    if deleted is not None:
+        response["deleted"] = deleted
+    return response
+
+
+@app.get("/tasks/scheduler")
+async def get_scheduler_stats(auth: str = Depends(token_auth)):
+    return scheduler.stats()
+
+
+@app.get("/tasks/stats")
+async def get_task_stats(auth: str = Depends(token_auth)):
+    """Numbers of tasks and the memory used by their results"""
+    return tasks.stats()
+
+
+@app.get("/tasks/events")
+async def task_events(since: int = 0, auth: str = Depends(token_auth)):
+    """
+    Server-sent events for all changes of tasks after the version since: a "task"
+    event with the summary of a new or changed task and a "deleted" event with the
+    uuid of a removed task.
+    """
+
+    async def events():
+        sent = since
+        while True:
+            waiter = task_changes.waiter()
+            latest = tasks.latest_version()
+            changed, deleted = tasks.changes(sent)
+            for task in sorted(changed, key=lambda task: task.version):
+                data = json.dumps(jsonable_encoder(task.summary()))
+                yield f"event: task\nid: {task.version}\ndata: {data}\n\n"
+            for task_uuid in deleted:
+                data = json.dumps({"uuid": task_uuid})
+                yield f"event: deleted\nid: {latest}\ndata: {data}\n\n"
+            sent = max(sent, latest)
+            try:
+                await asyncio.wait_for(waiter.wait(), EVENT_STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            await asyncio.sleep(TASK_EVENT_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 @app.get("/tasks/{task_uuid}/")
-async def get_task(task_uuid: str, auth: str = Depends(token_auth)):
-    return tasks.get(task_uuid)
+async def get_task(
+    task_uuid: str,
+    since: Optional[int] = None,
+    timeout: float = 30,
+    auth: str = Depends(token_auth),
+):
+    """
+    Returns the task. With since, this waits (up to timeout seconds) until the
+    version of the task is newer than since.
+    """
+    task = tasks.get(task_uuid)
+    if since is not None:
+        deadline = asyncio.get_running_loop().time() + min(
+            timeout, MAX_LONG_POLL_TIMEOUT
+        )
+        while task.version <= since:
+            waiter = task_changes.waiter()
+            task = tasks.get(task_uuid)
+            if task.version > since:
+                break
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(waiter.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+    # the full task includes the result, which is big for long transcriptions
+    data = await run_in_threadpool(
+        lambda: encode_json(encode_task(task, tasks.load_result(task)))
+    )
+    return Response(data, media_type="application/json")
+
+
+@app.get("/tasks/{task_uuid}/result")
+async def get_task_result(
+    request: Request,
+    task_uuid: str,
+    format: str = "json",
+    auth: str = Depends(token_auth),
+):
+    """
+    The content of a finished transcription, compressed with zstd or gzip if the
+    client accepts it. With format=columnar, the items are returned as parallel
+    arrays instead of a list of objects.
+    """
+    task = tasks.get(task_uuid)
+    if not isinstance(task, TranscriptionTask):
+        raise HTTPException(status_code=400, detail="Not a transcription task")
+    if task.state != TranscriptionState.DONE:
+        raise HTTPException(status_code=409, detail="Transcription is not done")
+    if format not in ("json", "columnar"):
+        raise HTTPException(status_code=400, detail="Unknown format")
+    accept_encoding = request.headers.get("accept-encoding", "")
+    return await run_in_threadpool(
+        lambda: result_response(
+            tasks.load_result(task), format == "columnar", accept_encoding
+        )
+    )
+
+
+@app.get("/tasks/{task_uuid}/transcript")
+async def stream_transcript(task_uuid: str, auth: str = Depends(token_auth)):
+    """
+    Server-sent events with the finalized parts of a running transcription: a
+    "words" event with new items of a paragraph whenever vosk finalizes an
+    utterance, and a "done" event once the task finished.
+    """
+    task = tasks.get(task_uuid)
+    if not isinstance(task, TranscriptionTask):
+        raise HTTPException(status_code=400, detail="Not a transcription task")
+
+    async def events():
+        # wait for the job to start
+        live = live_transcripts.get(task_uuid)
+        while live is None and task.state not in (
+            TranscriptionState.DONE,
+            TranscriptionState.FAILED,
+        ):
+            await asyncio.sleep(0.5)
+            live = live_transcripts.get(task_uuid)
+
+        if live is not None:
+            sent = 0
+            while True:
+                try:
+                    new, closed = await asyncio.wait_for(
+                        live.events.wait(sent), EVENT_STREAM_KEEPALIVE
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                for event in new:
+                    yield f"event: words\ndata: {json.dumps(event)}\n\n"
+                sent += len(new)
+                if closed:
+                    break
+        yield f"event: done\ndata: {json.dumps({'state': task.state})}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 @app.delete("/tasks/{task_uuid}/")
 async def remove_task(task_uuid: str, auth: str = Depends(token_auth)):
-    return tasks.delete(task_uuid)
+    result = tasks.delete(task_uuid)
+    scheduler.drop_deleted()
+    return result
 
 
 @app.get("/models/available")
@@ -115,6 +580,24 @@ async def get_all_models(auth: str = Depends(token_auth)):
     return models.available
 
 
+@app.post("/models/preload")
+async def preload_model(
+    model_id: str,
+    priority: int = 1,
+    auth: str = Depends(token_auth),
+):
+    task = tasks.add(PreloadModelTask(model_id))
+    scheduler.submit(
+        task, JobType.PRELOAD, models.preload, model_id, task.uuid, priority=priority
+    )
+    return task
+
+
+@app.get("/models/cache")
+async def get_model_cache_stats(auth: str = Depends(token_auth)):
+    return models.cache.stats()
+
+
 @app.post("/models/delete")
 async def delete_model(model_id: str, auth: str = Depends(token_auth)):
     models.delete(model_id)
@@ -126,6 +609,39 @@ async def get_downloaded_models(auth: str = Depends(token_auth)):
     return models.downloaded
 
 
+@app.get("/models/disk_usage")
+async def get_model_disk_usage(auth: str = Depends(token_auth)):
+    """The space used by the downloaded models, least recently used first"""
+    return models.index.disk_usage()
+
+
+@app.get("/cache/results")
+async def get_result_cache_stats(auth: str = Depends(token_auth)):
+    return result_cache.stats()
+
+
+@app.delete("/cache/results")
+async def clear_result_cache(
+    audio_hash: Optional[str] = Query(None, regex=AUDIO_HASH_PATTERN),
+    auth: str = Depends(token_auth),
+):
+    # without a hash, all cached results are removed
+    return {"removed": result_cache.delete(audio_hash or "")}
+
+
+@app.get("/cache/diarization")
+async def get_diarization_cache_stats(auth: str = Depends(token_auth)):
+    return diarization_cache.stats()
+
+
+@app.delete("/cache/diarization")
+async def clear_diarization_cache(
+    audio_hash: Optional[str] = Query(None, regex=AUDIO_HASH_PATTERN),
+    auth: str = Depends(token_auth),
+):
+    return {"removed": diarization_cache.delete(audio_hash or "")}
+
+
 @app.post("/util/otio/convert")
 async def convert_otio_http(
     name: str,
@@ -142,6 +658,21 @@ async def task_not_found_error_handler(request, exc):
     return PlainTextResponse(str(exc), status_code=404)
 
 
+@app.exception_handler(UnsupportedAudioFormat)
+async def unsupported_audio_format_handler(request, exc):
+    return PlainTextResponse(str(exc), status_code=415)
+
+
+@app.exception_handler(PathNotAllowed)
+async def path_not_allowed_handler(request, exc):
+    return PlainTextResponse(str(exc), status_code=403)
+
+
+@app.exception_handler(LocalFileNotFound)
+async def local_file_not_found_handler(request, exc):
+    return PlainTextResponse(str(exc), status_code=404)
+
+
 @app.exception_handler(LanguageDoesNotExist)
 async def language_does_not_exist_handler(request, exc):
     return PlainTextResponse(str(exc), status_code=404)
@@ -1,19 +1,49 @@
 import enum
+import io
+import json
+import os
 import shutil
-import tempfile
-from collections import defaultdict
-from dataclasses import dataclass, field
+import threading
+import time
+import traceback
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional
 from urllib.parse import urlparse
-from zipfile import ZipFile
+from zipfile import BadZipFile, ZipFile
+
+import numpy as np
+
+from .audio import SAMPLE_RATE, SAMPLE_WIDTH
+from .config import (
+    CACHE_DIR,
+    DATA_DIR,
+    MODEL_CACHE_IDLE_TIMEOUT,
+    MODEL_CACHE_SIZE,
+    RECOGNIZER_POOL_SIZE,
+    TRANSCRIPTION_BACKEND,
+)
+from .tasks import Task, tasks
+from .zipstream import UnsupportedZip, extract_zip_stream, member_path
 
-import requests
-import yaml
-from vosk import Model
+if TYPE_CHECKING:
+    from vosk import KaldiRecognizer, Model
 
-from .config import CACHE_DIR, DATA_DIR
-from .tasks import Task, tasks
+    from .download import RangeDownload
+
+# Downloaded models. They have their own directory, so the modification time of it
+# only changes with the models (see ModelIndex)
+MODELS_DIR = DATA_DIR / "models"
+# Partial model downloads, see RangeDownload
+DOWNLOAD_DIR = CACHE_DIR / "downloads"
+# Downloaded models with their size and last use, see ModelIndex
+INDEX_PATH = CACHE_DIR / "model_index.json"
+# The available models, compiled from models.yml by scripts/generate_models_list.py
+# as parsing the yaml is slow
+CATALOG_PATH = Path(__file__).parent / "models.json"
+CATALOG_SOURCE_PATH = Path(__file__).parent / "models.yml"
 
 
 class LanguageDoesNotExist(Exception):
@@ -48,11 +78,17 @@ class ModelDescription:
 
     def path(self) -> Path:
         url = urlparse(self.url)
-        return DATA_DIR / (Path(url.path).name + ".model")
+        return MODELS_DIR / (Path(url.path).name + ".model")
 
     def is_downloaded(self) -> bool:
         return self.path().exists()
 
+    def size_on_disk(self) -> int:
+        path = self.path()
+        if path.is_dir():
+            return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+        return path.stat().st_size
+
 
 @dataclass
 class Language:
@@ -69,104 +105,624 @@ class ModelDefaultDict(defaultdict):
         return self[key]
 
 
+class PooledRecognizer:
+    """
+    A KaldiRecognizer that is reset and reused for many segments. vosk keeps
+    counting the samples fed before Reset() in the word times of later results,
+    so they are subtracted again here.
+    """
+
+    def __init__(self, rec: "KaldiRecognizer"):
+        self.rec = rec
+        # samples fed since the recognizer was created and before the last Reset()
+        self.fed = 0
+        self.fed_before_reset = 0
+
+    def AcceptWaveform(self, data) -> int:
+        self.fed += len(data) // SAMPLE_WIDTH
+        return self.rec.AcceptWaveform(data)
+
+    def Result(self) -> str:
+        return self._shift(self.rec.Result())
+
+    def FinalResult(self) -> str:
+        return self._shift(self.rec.FinalResult())
+
+    def Reset(self):
+        self.rec.Reset()
+        self.fed_before_reset = self.fed
+
+    def _shift(self, result: str) -> str:
+        if not self.fed_before_reset:
+            return result
+        shift = self.fed_before_reset / SAMPLE_RATE
+        data = json.loads(result)
+        for word in data.get("result", []):
+            word["start"] = round(word["start"] - shift, 6)
+            word["end"] = round(word["end"] - shift, 6)
+        return json.dumps(data)
+
+
+class RecognizerPool:
+    """
+    Hands out recognizers for one model. Recognizers are reset and reused
+    instead of constructing a new one for every (possibly very short) segment.
+    At most max_size recognizers exist at the same time, further requests wait
+    until one is returned.
+    The model is loaded in this process when the first recognizer needs it, the
+    process backend only passes model_path to its workers.
+    """
+
+    def __init__(self, model_path: str, max_size: int, model: Optional["Model"] = None):
+        self.model_path = model_path
+        self.max_size = max_size
+        self.model = model
+        self.model_lock = threading.Lock()
+        self.idle: List[PooledRecognizer] = []
+        self.created = 0
+        self.condition = threading.Condition()
+
+    def load(self) -> "Model":
+        from vosk import Model
+
+        with self.model_lock:
+            if self.model is None:
+                self.model = Model(self.model_path)
+            return self.model
+
+    @contextmanager
+    def recognizer(self) -> Iterator[PooledRecognizer]:
+        from vosk import KaldiRecognizer
+
+        with self.condition:
+            while not self.idle and self.created >= self.max_size:
+                self.condition.wait()
+            rec = self.idle.pop() if self.idle else None
+            if rec is None:
+                self.created += 1
+
+        if rec is None:
+            try:
+                rec = PooledRecognizer(KaldiRecognizer(self.load(), SAMPLE_RATE))
+                rec.rec.SetWords(True)
+            except BaseException:
+                with self.condition:
+                    self.created -= 1
+                    self.condition.notify()
+                raise
+
+        try:
+            yield rec
+        finally:
+            rec.Reset()
+            with self.condition:
+                self.idle.append(rec)
+                self.condition.notify()
+
+
+@dataclass
+class CachedModel:
+    model_id: str
+    size: int = 0
+    recognizers: Optional[RecognizerPool] = None
+    error: Optional[BaseException] = None
+    refcount: int = 0
+    # pinned models are not evicted when idle, only if the cache is full
+    pinned: bool = False
+    last_used: float = field(default_factory=time.monotonic)
+    loaded: threading.Event = field(default_factory=threading.Event)
+
+
+class ModelCache:
+    """
+    Keeps loaded models in memory, as long as they fit into max_size.
+
+    Models are evicted in least recently used order or once they were not used
+    for idle_timeout seconds. Models that are currently in use (see acquire /
+    release) are never evicted. Concurrent requests for a model that is still
+    loading wait for that load to finish.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[str], RecognizerPool],
+        size_of: Callable[[str], int],
+        max_size: int,
+        idle_timeout: float,
+    ):
+        self.load = load
+        self.size_of = size_of
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.entries: "OrderedDict[str, CachedModel]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.idle_timer: Optional[threading.Timer] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, model_id: str, pin: bool = False) -> RecognizerPool:
+        with self.lock:
+            entry = self.entries.get(model_id)
+            is_loader = entry is None
+            if is_loader:
+                self.misses += 1
+                entry = CachedModel(model_id)
+                self.entries[model_id] = entry
+            else:
+                self.hits += 1
+                self.entries.move_to_end(model_id)
+            entry.refcount += 1
+            entry.pinned |= pin
+            entry.last_used = time.monotonic()
+
+        if is_loader:
+            try:
+                entry.size = self.size_of(model_id)
+                with self.lock:
+                    self._evict()
+                entry.recognizers = self.load(model_id)
+            except BaseException as e:
+                entry.error = e
+                with self.lock:
+                    self.entries.pop(model_id, None)
+                raise
+            finally:
+                entry.loaded.set()
+        else:
+            entry.loaded.wait()
+            if entry.error is not None:
+                with self.lock:
+                    entry.refcount -= 1
+                raise entry.error
+        return entry.recognizers
+
+    def release(self, model_id: str):
+        with self.lock:
+            entry = self.entries.get(model_id)
+            if entry is None:
+                return
+            entry.refcount -= 1
+            entry.last_used = time.monotonic()
+            self._evict()
+            self._schedule_idle_check()
+
+    def evict_idle(self):
+        with self.lock:
+            self.idle_timer = None
+            self._evict()
+            self._schedule_idle_check()
+
+    def _schedule_idle_check(self):
+        if self.idle_timer is not None:
+            return
+        idle_since = [
+            entry.last_used for entry in self._evictable() if not entry.pinned
+        ]
+        if not idle_since:
+            return
+        delay = min(idle_since) + self.idle_timeout - time.monotonic()
+        self.idle_timer = threading.Timer(max(delay, 0) + 1, self.evict_idle)
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
+
+    def discard(self, model_id: str):
+        with self.lock:
+            entry = self.entries.get(model_id)
+            if entry is not None and entry.refcount == 0:
+                self._remove(entry)
+
+    def _evictable(self) -> Iterator[CachedModel]:
+        for entry in list(self.entries.values()):
+            if entry.refcount == 0 and entry.loaded.is_set():
+                yield entry
+
+    def _remove(self, entry: CachedModel):
+        del self.entries[entry.model_id]
+        self.evictions += 1
+
+    def _evict(self):
+        now = time.monotonic()
+        for entry in self._evictable():
+            if not entry.pinned and now - entry.last_used > self.idle_timeout:
+                self._remove(entry)
+        # entries are ordered from least to most recently used
+        for entry in self._evictable():
+            if self.size <= self.max_size:
+                break
+            self._remove(entry)
+
+    @property
+    def size(self) -> int:
+        return sum(entry.size for entry in self.entries.values())
+
+    def stats(self) -> dict:
+        with self.lock:
+            now = time.monotonic()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": self.size,
+                "max_size": self.max_size,
+                "models": [
+                    {
+                        "model_id": entry.model_id,
+                        "size": entry.size,
+                        "in_use": entry.refcount,
+                        "pinned": entry.pinned,
+                        "recognizers": (
+                            entry.recognizers.created if entry.recognizers else 0
+                        ),
+                        "idle_seconds": now - entry.last_used,
+                    }
+                    for entry in self.entries.values()
+                ],
+            }
+
+
+@dataclass
+class InstalledModel:
+    model_id: str
+    size: int
+    # modification time of the model when its size was measured
+    mtime_ns: int
+    # time of the last use of the model (time.time()), None if it was never used
+    last_used: Optional[float] = None
+
+
+class ModelIndex:
+    """
+    The downloaded models, so checking for a model doesn't stat its files. Models
+    added or removed by hand are picked up by scanning MODELS_DIR again when its
+    modification time changed. The index (with sizes and last use) is
+    kept in path, sizes are only measured again for models that changed.
+    """
+
+    # directory modification times this close to now might not catch changes in
+    # the same clock tick (e.g. on filesystems with a coarse mtime resolution)
+    MTIME_GRACE_NS = 2 * 10**9
+
+    def __init__(self, descriptions: Dict[str, ModelDescription], path: Path):
+        self.descriptions = {
+            description.path().name: description
+            for description in descriptions.values()
+        }
+        self.path = path
+        self.lock = threading.Lock()
+        self.models: Dict[str, InstalledModel] = {}
+        self.directory_mtime_ns: Optional[int] = None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            model_ids = {d.model_id for d in self.descriptions.values()}
+            self.models = {
+                model["model_id"]: InstalledModel(**model)
+                for model in data["models"]
+                if model["model_id"] in model_ids
+            }
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def __contains__(self, model_id: str) -> bool:
+        with self.lock:
+            self._refresh()
+            return model_id in self.models
+
+    def size(self, model_id: str) -> int:
+        with self.lock:
+            self._refresh()
+            return self.models[model_id].size
+
+    def installed(self) -> List[InstalledModel]:
+        """The downloaded models, from least to most recently used"""
+        with self.lock:
+            self._refresh()
+            return sorted(self.models.values(), key=lambda model: model.last_used or 0)
+
+    def add(self, model: ModelDescription):
+        """Records a model that was just downloaded"""
+        installed = InstalledModel(
+            model.model_id, model.size_on_disk(), model.path().stat().st_mtime_ns
+        )
+        with self.lock:
+            self.models[model.model_id] = installed
+            self._save()
+
+    def remove(self, model_id: str):
+        with self.lock:
+            if self.models.pop(model_id, None) is not None:
+                self._save()
+
+    def touch(self, model_id: str):
+        with self.lock:
+            model = self.models.get(model_id)
+            if model is not None:
+                model.last_used = time.time()
+                self._save()
+
+    def _refresh(self):
+        mtime_ns = MODELS_DIR.stat().st_mtime_ns
+        if mtime_ns == self.directory_mtime_ns:
+            return
+        found = {}
+        with os.scandir(MODELS_DIR) as entries:
+            for entry in entries:
+                description = self.descriptions.get(entry.name)
+                if description is None:
+                    continue
+                model_mtime_ns = entry.stat().st_mtime_ns
+                known = self.models.get(description.model_id)
+                if known is None or known.mtime_ns != model_mtime_ns:
+                    known = InstalledModel(
+                        description.model_id,
+                        description.size_on_disk(),
+                        model_mtime_ns,
+                        known.last_used if known is not None else None,
+                    )
+                found[description.model_id] = known
+        changed = found != self.models
+        self.models = found
+        if time.time_ns() - mtime_ns > self.MTIME_GRACE_NS:
+            self.directory_mtime_ns = mtime_ns
+        if changed:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"models": [asdict(model) for model in self.models.values()]}, f)
+        os.replace(tmp_path, self.path)
+
+    def disk_usage(self) -> dict:
+        installed = self.installed()
+        return {
+            "total": sum(model.size for model in installed),
+            "models": [
+                {
+                    "model_id": model.model_id,
+                    "size": model.size,
+                    "last_used": model.last_used,
+                }
+                for model in installed
+            ],
+        }
+
+
 class Models:
     def __init__(self):
-        with open(Path(__file__).parent / "models.yml", "r") as f:
-            models_raw = yaml.safe_load(f)
-            languages = ModelDefaultDict()
-            models = {}
-            for lang, lang_models in list(models_raw.items()):
-                for model in lang_models:
-                    model_description = ModelDescription(lang=lang, **model)
-                    models[model_description.model_id] = model_description
-                    if model["type"] == "transcription":
-                        languages[lang].transcription_models.append(model_description)
+        languages = ModelDefaultDict()
+        models = {}
+        for lang, lang_models in list(load_catalog().items()):
+            for model in lang_models:
+                model_description = ModelDescription(lang=lang, **model)
+                models[model_description.model_id] = model_description
+                if model["type"] == "transcription":
+                    languages[lang].transcription_models.append(model_description)
         self.available = dict(languages)
         self.model_descriptions = models
+        move_legacy_models(models)
+        self.index = ModelIndex(models, INDEX_PATH)
 
-        # TODO: does it make sense to cache the models in memory
-        #  if we have more than one? also maybe add some time based
-        #  heuristics if it is smart to still keep the model in ram
-        self.loaded = {}
+        self.cache = ModelCache(
+            lambda model_id: self._load_model(self.model_descriptions[model_id]),
+            self.index.size,
+            MODEL_CACHE_SIZE,
+            MODEL_CACHE_IDLE_TIMEOUT,
+        )
 
     @property
     def downloaded(self) -> Dict[str, ModelDescription]:
         filtered = {}
         for lang_name, lang in list(self.available.items()):
             for model in lang.all_models():
-                if model.is_downloaded():
+                if model.model_id in self.index:
                     filtered[model.model_id] = model
         return filtered
 
     def get_model_description(self, model_id) -> ModelDescription:
         if model_id not in self.model_descriptions:
-            raise ModelDoesNotExist
+            raise ModelDoesNotExist(f"model {model_id} does not exist")
 
         return self.model_descriptions[model_id]
 
-    def _load_model(self, model):
-        if model.type == "transcription":
-            return Model(str(model.path()))
-        else:
+    def _load_model(self, model: ModelDescription) -> RecognizerPool:
+        if model.type != "transcription":
             raise ModelTypeNotSupported()
-
-    def get(self, model_id: str) -> Union[Model]:
+        recognizers = RecognizerPool(str(model.path()), RECOGNIZER_POOL_SIZE)
+        if TRANSCRIPTION_BACKEND != "process":
+            # the worker processes of the process backend load their own copies,
+            # one in this process would only double the memory use
+            recognizers.load()
+        return recognizers
+
+    def check_downloaded(self, model_id: str) -> ModelDescription:
+        """Raises if the model does not exist or is not downloaded"""
         model = self.get_model_description(model_id)
-        if not model.is_downloaded():
-            raise ModelNotDownloaded()
-
-        if model_id not in self.loaded:
-            self.loaded[model_id] = self._load_model(model)
-        return self.loaded[model_id]
+        if model_id not in self.index:
+            raise ModelNotDownloaded(f"model {model_id} is not downloaded")
+        return model
+
+    @contextmanager
+    def use(self, model_id: str, pin: bool = False) -> Iterator[RecognizerPool]:
+        """
+        Loads the model (if necessary) and keeps it loaded while in use.
+        Yields the recognizer pool of the model.
+        """
+        self.check_downloaded(model_id)
+        loaded = self.cache.acquire(model_id, pin)
+        self.index.touch(model_id)
+        try:
+            yield loaded
+        finally:
+            self.cache.release(model_id)
+
+    def preload(self, model_id: str, task_uuid: str):
+        """
+        Loads a model into the cache and runs a short decode through it, so the
+        first transcription with it doesn't have to wait for that.
+        Transcriptions started in the meantime wait for this load.
+        """
+        task: PreloadModelTask = tasks.get(task_uuid)
+        task.state = PreloadModelState.LOADING
+        try:
+            with self.use(model_id, pin=True) as recognizers:
+                task.progress = 0.5
+                task.state = PreloadModelState.WARMING_UP
+                if TRANSCRIPTION_BACKEND != "process":
+                    warmup(recognizers)
+        except Exception:
+            traceback.print_exc()
+            task.state = PreloadModelState.FAILED
+            return
+        task.progress = 1
+        task.state = PreloadModelState.DONE
+
+    def find_download(self, model_id: str) -> Optional["DownloadModelTask"]:
+        """The unfinished download task of the model, if there is one"""
+        for task in list(tasks.list()):
+            if (
+                isinstance(task, DownloadModelTask)
+                and task.model_id == model_id
+                and task.finished_at is None
+            ):
+                return task
+        return None
 
     def download(self, model_id: str, task_uuid: str):
+        """
+        Downloads the model over several connections. The partial download is kept
+        in DOWNLOAD_DIR until it is extracted, so a download that failed or was
+        interrupted by a restart continues from there. Compressed models are
+        extracted while they are downloaded, into a staging directory that is
+        renamed to the model path at the end, so is_downloaded never sees a half
+        extracted model.
+        """
+        # requests is only needed for downloads, it is slow to import
+        from .download import DownloadCanceled, RangeDownload
+
         task: DownloadModelTask = tasks.get(task_uuid)
         model = self.get_model_description(model_id)
-        with tempfile.TemporaryFile(dir=CACHE_DIR) as f:
-            response = requests.get(model.url, stream=True)
-            task.total = int(response.headers.get("content-length"))
-            task.state = DownloadModelState.DOWNLOADING
-
-            for data in response.iter_content(
-                chunk_size=max(int(task.total / 1000), 1024 * 1024)
-            ):
-                task.add_progress(len(data))
-
-                f.write(data)
-                if task.canceled:
-                    return
-
-            task.state = DownloadModelState.EXTRACTING
+        directory = DOWNLOAD_DIR / model_id
+        staging = model.path().with_name(model.path().name + ".partial")
+        remove_path(staging)
+        task.state = DownloadModelState.DOWNLOADING
+        try:
+            download = RangeDownload(
+                model.url, directory, task.set_progress, lambda: task.canceled
+            ).start()
             if model.compressed:
-                with ZipFile(f) as archive:
-                    target_dir = model.path()
-                    for info in archive.infolist():
-                        if info.is_dir():
-                            continue
-                        path = target_dir / Path("/".join(info.filename.split("/")[1:]))
-                        path.parent.mkdir(exist_ok=True, parents=True)
-
-                        source = archive.open(info.filename)
-                        target = open(path, "wb")
-                        with source, target:
-                            shutil.copyfileobj(source, target)
+                extracted = extract_while_downloading(download, staging)
+                path = download.wait()
+                task.state = DownloadModelState.EXTRACTING
+                try:
+                    with ZipFile(path) as archive:
+                        members = {
+                            str(member)
+                            for member in map(member_path, archive.namelist())
+                            if member is not None
+                        }
+                    if extracted is None or set(extracted) != members:
+                        # the local headers don't match the central directory
+                        remove_path(staging)
+                        extract_model(path, staging)
+                except BadZipFile:
+                    # the checksums of the archive don't match, download it again
+                    shutil.rmtree(directory, ignore_errors=True)
+                    raise
             else:
-                f.seek(0)
-                with open(model.path(), "wb") as target:
-                    shutil.copyfileobj(f, target)
-
+                shutil.move(download.wait(), staging)
+            remove_path(model.path())
+            os.replace(staging, model.path())
+            self.index.add(model)
+        except DownloadCanceled:
+            remove_path(staging)
+            shutil.rmtree(directory, ignore_errors=True)
+            return
+        except Exception:
+            remove_path(staging)
+            task.state = DownloadModelState.FAILED
+            raise
+        shutil.rmtree(directory, ignore_errors=True)
         task.state = DownloadModelState.DONE
 
     def delete(self, model_id: str):
         model = self.get_model_description(model_id)
-        if model.is_downloaded():
-            path = model.path()
-            if path.is_dir():
-                shutil.rmtree(path)
-            else:
-                path.unlink()
+        self.cache.discard(model_id)
+        if model_id in self.index:
+            remove_path(model.path())
+            self.index.remove(model_id)
         else:
-            raise ModelNotDownloaded()
+            raise ModelNotDownloaded(f"model {model_id} is not downloaded")
+
+
+def load_catalog() -> Dict[str, List[dict]]:
+    """The descriptions of the available models by language"""
+    try:
+        with open(CATALOG_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        # e.g. in a checkout where the catalog was not compiled
+        import yaml
+
+        with open(CATALOG_SOURCE_PATH) as f:
+            return yaml.safe_load(f)
+
+
+def move_legacy_models(descriptions: Dict[str, ModelDescription]):
+    """Moves models that were downloaded into DATA_DIR itself to MODELS_DIR"""
+    MODELS_DIR.mkdir(exist_ok=True, parents=True)
+    for description in descriptions.values():
+        legacy_path = DATA_DIR / description.path().name
+        if legacy_path.exists() and not description.path().exists():
+            os.replace(legacy_path, description.path())
+
+
+def extract_model(archive_path: Path, target_dir: Path):
+    """Extracts a model zip, without the top level directory of the archive"""
+    with ZipFile(archive_path) as archive:
+        for info in archive.infolist():
+            member = member_path(info.filename)
+            if member is None:
+                continue
+            path = target_dir / member
+            path.parent.mkdir(exist_ok=True, parents=True)
+
+            # reading an entry checks its CRC
+            source = archive.open(info.filename)
+            target = open(path, "wb")
+            with source, target:
+                shutil.copyfileobj(source, target)
+
+
+def extract_while_downloading(
+    download: "RangeDownload", target_dir: Path
+) -> Optional[List[str]]:
+    """
+    Extracts a model zip from the start of the file while it is downloaded.
+    Returns the extracted files, or None if the archive has to be extracted with
+    extract_model once it is complete.
+    """
+    with download.reader() as reader:
+        try:
+            return extract_zip_stream(io.BufferedReader(reader), target_dir)
+        except (UnsupportedZip, BadZipFile):
+            traceback.print_exc()
+            return None
+
+
+def remove_path(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def warmup(recognizers: RecognizerPool):
+    noise = np.random.default_rng(0).normal(0, 500, SAMPLE_RATE).astype(np.int16)
+    with recognizers.recognizer() as rec:
+        rec.AcceptWaveform(noise.tobytes())
+        rec.FinalResult()
 
 
 models = Models()
@@ -178,6 +734,7 @@ class DownloadModelState(str, enum.Enum):
     EXTRACTING = "extracting"
     DONE = "done"
     CANCELED = "canceled"
+    FAILED = "failed"
 
 
 @dataclass
@@ -188,12 +745,40 @@ class DownloadModelTask(Task):
     processed: float = 0
     progress: float = 0
 
+    persistent = True
+    summary_fields = ("state", "progress", "model_id")
+    final_states = (
+        DownloadModelState.DONE,
+        DownloadModelState.CANCELED,
+        DownloadModelState.FAILED,
+    )
+
     def __post_init__(self):
         self.canceled = False
 
-    def add_progress(self, added):
-        self.processed += added
-        self.progress = self.processed / self.total
+    def set_progress(self, processed: int, total: int):
+        self.total = total
+        self.processed = processed
+        if total:
+            self.progress = processed / total
 
     def cancel(self):
         self.canceled = True
+
+
+class PreloadModelState(str, enum.Enum):
+    QUEUED = "queued"
+    LOADING = "loading"
+    WARMING_UP = "warming up"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class PreloadModelTask(Task):
+    model_id: str
+    state: PreloadModelState = PreloadModelState.QUEUED
+    progress: float = 0
+
+    summary_fields = ("state", "progress", "model_id")
+    final_states = (PreloadModelState.DONE, PreloadModelState.FAILED)
@@ -1,7 +1,5 @@
 from typing import List
 
-import opentimelineio as otio
-from opentimelineio.opentime import TimeRange, from_seconds
 from pydantic import BaseModel
 
 
@@ -16,10 +14,16 @@ class Segment(BaseModel):
 
 
 def otio_seconds(s: float):
+    from opentimelineio.opentime import from_seconds
+
     return from_seconds(s, 30)
 
 
 def convert_otio(timeline: List[Segment], timeline_name: str, adapter_name: str):
+    # opentimelineio is only imported on the first export, it slows down startup
+    import opentimelineio as otio
+    from opentimelineio.opentime import TimeRange
+
     tl = otio.schema.Timeline(name=timeline_name)
     aSpeakers = set(s.speaker for s in timeline)
     vSpeakers = set(s.speaker for s in timeline if s.has_video)
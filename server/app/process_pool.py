@@ -0,0 +1,197 @@
+"""
+Process based execution backend for transcribing the segments of a file.
+
+The decoded audio is copied once into shared memory and the worker processes only
+get (offset, length) descriptors of their segments. Every worker keeps its own
+model loaded, progress is reported back to the parent through a queue.
+"""
+
+import itertools
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .audio import SAMPLE_RATE
+from .config import PROCESS_WORKERS
+from .recognition import recognize_samples, transform_vosk_result
+from .transcript import Transcript
+
+if TYPE_CHECKING:
+    from vosk import Model
+
+# (model path, model) of the model loaded in this worker process
+_worker_model: Optional[Tuple[str, "Model"]] = None
+_worker_progress: Optional[multiprocessing.Queue] = None
+
+
+def _init_worker(progress: multiprocessing.Queue):
+    global _worker_progress
+    _worker_progress = progress
+
+
+def _get_model(model_path: str) -> "Model":
+    from vosk import Model
+
+    global _worker_model
+    if _worker_model is None or _worker_model[0] != model_path:
+        # only keep one model per worker, big models need gigabytes of memory
+        _worker_model = None
+        _worker_model = (model_path, Model(model_path))
+    return _worker_model[1]
+
+
+def _transcribe_segment(
+    job_id: int,
+    model_path: str,
+    shm_name: str,
+    n_samples: int,
+    segment: int,
+    name: str,
+    offset: float,
+    duration: float,
+    resume_position: float,
+    words: List[dict],
+    report_utterances: bool,
+) -> Transcript:
+    from vosk import KaldiRecognizer
+
+    shm = SharedMemory(shm_name)
+    try:
+        samples = np.ndarray((n_samples,), dtype=np.int16, buffer=shm.buf)
+        rec = KaldiRecognizer(_get_model(model_path), SAMPLE_RATE)
+        rec.SetWords(True)
+        vosk_result = recognize_samples(
+            rec,
+            samples,
+            offset,
+            duration,
+            lambda processed: _worker_progress.put((job_id, "progress", processed)),
+            resume_position,
+            words,
+            (
+                (
+                    lambda position, utterance: _worker_progress.put(
+                        (job_id, "utterance", (segment, position, utterance))
+                    )
+                )
+                if report_utterances
+                else None
+            ),
+        )
+        # the shared memory can't be closed while views of it exist
+        del rec, samples
+    finally:
+        shm.close()
+        # tells the parent that all messages of this segment were sent
+        _worker_progress.put((job_id, "done", None))
+    return transform_vosk_result(name, vosk_result, duration, offset)
+
+
+@dataclass
+class ProgressListener:
+    callback: Callable[[float], None]
+    utterance_callback: Optional[Callable[[int, float, List[dict]], None]]
+    remaining_segments: int
+    done: threading.Event = field(default_factory=threading.Event)
+
+
+class ProcessBackend:
+    """
+    Transcribes segments in a pool of worker processes, so the python code
+    between the vosk calls doesn't compete for the GIL of the server process.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.progress: Optional[multiprocessing.Queue] = None
+        self.listeners: Dict[int, ProgressListener] = {}
+        self.job_ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.executor is not None:
+                return
+            # forking a process with running threads is not safe
+            context = multiprocessing.get_context("spawn")
+            self.progress = context.Queue()
+            self.executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(self.progress,),
+            )
+            threading.Thread(target=self._forward_progress, daemon=True).start()
+
+    def _forward_progress(self):
+        while True:
+            job_id, kind, payload = self.progress.get()
+            listener = self.listeners.get(job_id)
+            if listener is None:
+                continue
+            if kind == "done":
+                listener.remaining_segments -= 1
+                if listener.remaining_segments == 0:
+                    listener.done.set()
+            elif kind == "utterance":
+                listener.utterance_callback(*payload)
+            else:
+                listener.callback(payload)
+
+    def transcribe_segments(
+        self,
+        model_path: str,
+        samples: np.ndarray,
+        segments: List[Tuple[str, float, float]],
+        process_callback: Callable[[float], None],
+        resume: List[Tuple[float, List[dict]]],
+        utterance_callback: Optional[Callable[[int, float, List[dict]], None]] = None,
+    ) -> List[Transcript]:
+        """
+        resume has the position to start at and the words before it for each
+        segment. utterance_callback is called with the segment index, position
+        and words of each finalized utterance.
+        """
+        self._start()
+        job_id = next(self.job_ids)
+        listener = ProgressListener(process_callback, utterance_callback, len(segments))
+        self.listeners[job_id] = listener
+        shm = SharedMemory(create=True, size=max(samples.nbytes, 1))
+        try:
+            np.ndarray(samples.shape, dtype=np.int16, buffer=shm.buf)[:] = samples
+            futures = [
+                self.executor.submit(
+                    _transcribe_segment,
+                    job_id,
+                    model_path,
+                    shm.name,
+                    len(samples),
+                    segment,
+                    name,
+                    offset,
+                    duration,
+                    resume_position,
+                    words,
+                    utterance_callback is not None,
+                )
+                for segment, ((name, offset, duration), (resume_position, words)) in (
+                    enumerate(zip(segments, resume))
+                )
+            ]
+            results = [future.result() for future in futures]
+            # progress messages can arrive after the results
+            listener.done.wait(timeout=10)
+            return results
+        finally:
+            shm.close()
+            shm.unlink()
+            self.listeners.pop(job_id, None)
+
+
+process_backend = ProcessBackend(PROCESS_WORKERS)
@@ -0,0 +1,208 @@
+import json
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+import numpy as np
+
+from .audio import SAMPLE_RATE, SAMPLE_WIDTH
+from .transcript import SILENCE, Transcript
+
+if TYPE_CHECKING:
+    from vosk import KaldiRecognizer
+
+# Number of seconds that should be fed into vosk.
+# Smaller = better progress estimates, but also slightly higher python overhead.
+# Feeding a block costs a few microseconds (see scripts/benchmark_block_feeding.py),
+# so this can be small without hurting throughput
+VOSK_BLOCK_SIZE = 0.5
+EPSILON = 0.00001
+
+
+def accept_waveform(rec: "KaldiRecognizer", data: memoryview):
+    """
+    Feeds a buffer into the recognizer. KaldiRecognizer.AcceptWaveform only takes
+    bytes or cffi buffers, so we wrap the memoryview instead of copying it.
+    """
+    from vosk import _ffi as vosk_ffi
+
+    return rec.AcceptWaveform(vosk_ffi.from_buffer(data))
+
+
+def feed_samples(
+    rec: "KaldiRecognizer",
+    samples: np.ndarray,
+    offset: float,
+    duration: float,
+    process_callback: Callable[[float], None],
+    utterance_callback: Callable[[float, List[dict]], None],
+):
+    """
+    Feeds a part of the mono SAMPLE_RATE samples into the recognizer in blocks.
+    The utterance is finalized whenever vosk detects an endpoint and its words
+    are passed to the utterance_callback, together with the number of seconds fed
+    so far. Words of the last, unfinished utterance stay in the recognizer.
+    """
+    data = memoryview(samples).cast("B")
+    start = int(offset * SAMPLE_RATE) * SAMPLE_WIDTH
+    end = min(int((offset + duration) * SAMPLE_RATE) * SAMPLE_WIDTH, len(data))
+    block_size = int(VOSK_BLOCK_SIZE * SAMPLE_RATE) * SAMPLE_WIDTH
+    bytes_per_second = SAMPLE_RATE * SAMPLE_WIDTH
+
+    for block_start in range(start, end, block_size):
+        block_end = min(block_start + block_size, end)
+        endpoint = accept_waveform(rec, data[block_start:block_end])
+        process_callback((block_end - block_start) / bytes_per_second)
+        if endpoint:
+            utterance_callback(
+                (block_end - start) / bytes_per_second,
+                json.loads(rec.Result()).get("result", []),
+            )
+
+
+def shift_words(words: List[dict], shift: float) -> List[dict]:
+    if not shift:
+        return words
+    return [
+        {**word, "start": word["start"] + shift, "end": word["end"] + shift}
+        for word in words
+    ]
+
+
+def recognize_samples(
+    rec: "KaldiRecognizer",
+    samples: np.ndarray,
+    offset: float,
+    duration: float,
+    process_callback: Callable[[float], None],
+    resume_position: float = 0,
+    words: Optional[List[dict]] = None,
+    utterance_callback: Optional[Callable[[float, List[dict]], None]] = None,
+) -> dict:
+    """
+    Recognizes a part of the samples and returns the vosk result for it. The
+    recognition can start at resume_position (relative to offset), words then
+    are the words that were already recognized before it. Word times and the
+    positions passed to the utterance_callback are relative to offset.
+    """
+    words = list(words or [])
+
+    def on_utterance(position: float, utterance: List[dict]):
+        utterance = shift_words(utterance, resume_position)
+        words.extend(utterance)
+        if utterance_callback is not None:
+            utterance_callback(resume_position + position, utterance)
+
+    feed_samples(
+        rec,
+        samples,
+        offset + resume_position,
+        duration - resume_position,
+        process_callback,
+        on_utterance,
+    )
+    final = shift_words(
+        json.loads(rec.FinalResult()).get("result", []), resume_position
+    )
+    words.extend(final)
+    if utterance_callback is not None:
+        utterance_callback(duration, final)
+    return {"result": words}
+
+
+def stitch_chunks(name: str, chunks: List[Transcript]) -> Transcript:
+    """
+    Joins the paragraphs of consecutive chunks of the audio into one. Silences
+    that touch at a chunk border are merged.
+    """
+    joined = Transcript.concat(chunks)
+    silence = joined.word == SILENCE
+    borders = joined.paragraph_starts[
+        (joined.paragraph_starts > 0) & (joined.paragraph_starts < joined.n_items)
+    ]
+    merge = np.zeros(joined.n_items, dtype=bool)
+    merge[borders] = silence[borders] & silence[borders - 1]
+    keep = ~merge
+    # merged silences are added to the length of the item before them
+    length = np.bincount(np.cumsum(keep) - 1, weights=joined.length)
+    return Transcript(
+        [name],
+        [0],
+        joined.word[keep],
+        joined.source_start[keep],
+        length,
+        joined.conf[keep],
+        joined.vocabulary,
+    )
+
+
+def transform_words(
+    name: str,
+    words: List[dict],
+    offset: float = 0,
+    current_time: float = 0,
+    length: Optional[float] = None,
+) -> Transcript:
+    """
+    Converts vosk words into a paragraph. Gaps between words become silences and
+    if length is given, the paragraph is filled up with silence until then. Word
+    times are relative to the start of the paragraph and current_time is the end
+    of the words before these, offset is added to the times in the output.
+    """
+    # a loop, most calls get the words of a single utterance and numpy's per call
+    # overhead is more than the loop takes for them
+    item_word, item_start, item_length, item_conf = [], [], [], []
+    for index, word in enumerate(words):
+        word_start = word["start"]
+        if word_start > current_time:
+            if word_start - current_time > 10 * EPSILON:
+                item_word.append(SILENCE)
+                item_start.append(current_time)
+                item_length.append(word_start - current_time)
+                item_conf.append(0)
+            else:
+                word_start = current_time
+        item_word.append(index)
+        item_start.append(word_start)
+        item_length.append(word["end"] - word["start"])
+        item_conf.append(word["conf"])
+        current_time = word["end"]
+
+    if length is not None and current_time < length:
+        if length - current_time < 10 * EPSILON and item_length:
+            item_length[-1] += length - current_time
+        else:
+            item_word.append(SILENCE)
+            item_start.append(current_time)
+            item_length.append(length - current_time)
+            item_conf.append(0)
+
+    return Transcript.paragraph(
+        name,
+        [word["word"] for word in words],
+        np.array(item_word, dtype=np.int32),
+        np.array(item_start) + offset,
+        item_length,
+        item_conf,
+    )
+
+
+class ResultTransformer:
+    """
+    Converts the vosk words of a paragraph into its items (in the public format),
+    one utterance at a time.
+    """
+
+    def __init__(self, offset: float = 0):
+        self.offset = offset
+        self.current_time = 0
+
+    def add_words(self, words: List[dict]) -> List[dict]:
+        items = transform_words("", words, self.offset, self.current_time).items()
+        if words:
+            self.current_time = words[-1]["end"]
+        return items
+
+
+def transform_vosk_result(
+    name: str, result: dict, length: float, offset: float = 0
+) -> Transcript:
+    return transform_words(name, result.get("result", []), offset, length=length)
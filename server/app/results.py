@@ -0,0 +1,82 @@
+"""
+Serialization of transcription results for the result endpoint. Large transcripts
+have hundreds of thousands of items, so they are encoded without going through
+FastAPI's jsonable_encoder and compressed if the client accepts it.
+"""
+
+import gzip
+import json
+from typing import Dict, Optional, Tuple
+
+from fastapi.responses import Response
+
+from .transcript import Transcript
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+# Smaller responses are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+
+def encode_json(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def parse_accept_encoding(accept_encoding: str) -> Dict[str, float]:
+    """The q-value of every coding in an Accept-Encoding header"""
+    qvalues = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding.lower()] = qvalue
+    return qvalues
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """The supported coding with the highest q-value, zstd wins ties"""
+    qvalues = parse_accept_encoding(accept_encoding)
+    supported = ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+    wildcard = qvalues.get("*", 0.0)
+    best = max(supported, key=lambda coding: qvalues.get(coding, wildcard))
+    if qvalues.get(best, wildcard) <= 0:
+        return None
+    return best
+
+
+def compress(data: bytes, encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    if encoding is None or len(data) < MIN_COMPRESS_SIZE:
+        return data, None
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), encoding
+    return gzip.compress(data, compresslevel=GZIP_LEVEL), encoding
+
+
+def result_response(content: Transcript, columnar: bool, accept_encoding: str):
+    """Encodes a result, this takes a while for big ones and should run in a thread"""
+    data = encode_json(content.to_columnar() if columnar else content.to_list())
+    data, encoding = compress(data, negotiate_encoding(accept_encoding))
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(data, media_type="application/json", headers=headers)
@@ -0,0 +1,145 @@
+import enum
+import itertools
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Tuple
+
+from .config import (
+    MAX_CONCURRENT_DOWNLOADS,
+    MAX_CONCURRENT_PRELOADS,
+    MAX_CONCURRENT_TRANSCRIPTIONS,
+    WORKERS,
+)
+from .tasks import Task, tasks
+
+
+class JobType(str, enum.Enum):
+    TRANSCRIPTION = "transcription"
+    DOWNLOAD = "download"
+    PRELOAD = "preload"
+
+
+@dataclass
+class Job:
+    task: Task
+    job_type: JobType
+    priority: int
+    sequence: int
+    fn: Callable
+    args: Tuple[Any, ...]
+    future: Future = field(default_factory=Future)
+
+    @property
+    def sort_key(self):
+        # higher priorities first, FIFO within the same priority
+        return -self.priority, self.sequence
+
+
+class Scheduler:
+    """
+    Runs jobs on a bounded pool of worker threads.
+
+    Queued jobs are started in priority order (FIFO within a priority), as long as
+    fewer than limits[job_type] jobs of the same type are running. The position of
+    each waiting job is written to the queue_position of its task. Jobs of deleted
+    tasks are dropped, their futures are cancelled.
+    """
+
+    def __init__(self, workers: int, limits: Dict[JobType, int]):
+        self.workers = workers
+        self.limits = limits
+        self.queue: List[Job] = []
+        self.running: Dict[JobType, int] = {job_type: 0 for job_type in JobType}
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.threads: List[threading.Thread] = []
+
+    def submit(
+        self, task: Task, job_type: JobType, fn: Callable, *args, priority: int = 0
+    ) -> Future:
+        job = Job(task, job_type, priority, next(self.sequence), fn, args)
+        with self.condition:
+            self._start_workers()
+            self.queue.append(job)
+            self.queue.sort(key=lambda job: job.sort_key)
+            self._update_positions()
+            self.condition.notify()
+        return job.future
+
+    def _start_workers(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _update_positions(self):
+        for position, job in enumerate(self.queue):
+            job.task.queue_position = position
+
+    def drop_deleted(self):
+        """Drops the queued jobs of deleted tasks without running them"""
+        with self.condition:
+            dropped = [job for job in self.queue if job.task.uuid not in tasks.tasks]
+            if not dropped:
+                return
+            self.queue = [job for job in self.queue if job.task.uuid in tasks.tasks]
+            self._update_positions()
+        for job in dropped:
+            # runs the done callbacks, e.g. to stop waiting for the job
+            job.future.cancel()
+
+    def _next_job(self) -> Job:
+        while True:
+            self.drop_deleted()
+            for i, job in enumerate(self.queue):
+                if self.running[job.job_type] < self.limits.get(job.job_type, 1):
+                    del self.queue[i]
+                    self.running[job.job_type] += 1
+                    job.task.queue_position = None
+                    self._update_positions()
+                    return job
+            self.condition.wait()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    job.future.set_result(job.fn(*job.args))
+            except BaseException as e:
+                traceback.print_exc()
+                job.future.set_exception(e)
+            finally:
+                with self.condition:
+                    self.running[job.job_type] -= 1
+                    self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "workers": self.workers,
+                "limits": self.limits,
+                "running": dict(self.running),
+                "queued": {
+                    job_type: sum(1 for job in self.queue if job.job_type == job_type)
+                    for job_type in JobType
+                },
+            }
+
+
+scheduler = Scheduler(
+    WORKERS,
+    {
+        JobType.TRANSCRIPTION: MAX_CONCURRENT_TRANSCRIPTIONS,
+        JobType.DOWNLOAD: MAX_CONCURRENT_DOWNLOADS,
+        JobType.PRELOAD: MAX_CONCURRENT_PRELOADS,
+    },
+)
+
+# Shared by all jobs for the work they do in parallel (e.g. the speaker segments
+# of a diarized transcription), so the number of threads stays bounded no matter
+# how many jobs are running
+segment_executor = ThreadPoolExecutor(WORKERS)
@@ -1,22 +1,279 @@
-# This holds the tasks state. TODO(@pajowu), check if we should store this on disk
+# This holds the tasks state. Tasks that are marked as persistent (and the
+# checkpoints of their jobs) are saved to a sqlite database in DATA_DIR, so they
+# survive restarts of the server. Big results of finished tasks are only kept in
+# memory while they are used, finished tasks are deleted after TASK_TTL.
+import enum
+import itertools
+import json
+import sqlite3
+import threading
+import time
+import traceback
+import typing
 import uuid
-from dataclasses import dataclass, field
+from collections import deque
+from dataclasses import MISSING, asdict, dataclass, field, fields
+from pathlib import Path
+from typing import Any, ClassVar, Dict, List, Optional, Set, Tuple, Union
+
+from .config import (
+    DATA_DIR,
+    RESULT_IDLE_TIMEOUT,
+    RESULT_MEMORY_LIMIT,
+    TASK_SAVE_INTERVAL,
+    TASK_TTL,
+)
+from .events import Notifier
+
+_versions = itertools.count(1)
+_task_types: Dict[str, type] = {}
+
+# Fields that only make sense for the running server and are not saved
+TRANSIENT_FIELDS = {"queue_position", "version"}
+# Fields that change with every processed block of a job. Changes of progress only
+# count as a change of the task once they add up to PROGRESS_STEP (or it reaches
+# 0 or 1), processed always changes together with progress.
+PROGRESS_STEP = 0.001
+UNVERSIONED_FIELDS = {"version", "processed"}
+
+# Notified whenever a task is added, changed or deleted
+task_changes = Notifier()
 
 
 @dataclass
 class Task:
     uuid: str = field(default_factory=lambda: str(uuid.uuid4()), init=False)
+    # number of jobs that will be started before this one, None if not queued
+    queue_position: Optional[int] = field(default=None, init=False)
+    # increases whenever the task changes
+    version: int = field(default=0, init=False)
+    # unix time at which the task reached one of its final_states
+    finished_at: Optional[float] = field(default=None, init=False)
+
+    # whether the task is saved in the task database
+    persistent: ClassVar[bool] = False
+    # states in which the job of the task is over
+    final_states: ClassVar[Tuple[Any, ...]] = ()
+    # field that holds a big result. It is saved separately from the task (once,
+    # results don't change after they are set) and of persistent tasks only kept
+    # in memory while it is used, see Tasks.load_result
+    result_field: ClassVar[Optional[str]] = None
+    # fields that are part of the summary of the task, besides uuid and version
+    summary_fields: ClassVar[Tuple[str, ...]] = ("state", "progress")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _task_types[cls.__name__] = cls
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in UNVERSIONED_FIELDS:
+            return
+        if name == "state" and value in self.final_states:
+            object.__setattr__(self, "finished_at", time.time())
+        if name == "progress":
+            published = self.__dict__.get("_published_progress", 0)
+            if abs(value - published) < PROGRESS_STEP and value not in (0, 1):
+                return
+            object.__setattr__(self, "_published_progress", value)
+        object.__setattr__(self, "version", next(_versions))
+        task_changes.notify()
+
+    def summary(self) -> dict:
+        """A small projection of the task, for lists and event feeds"""
+        summary = {
+            "uuid": self.uuid,
+            "type": type(self).__name__,
+            "version": self.version,
+        }
+        for name in self.summary_fields:
+            summary[name] = getattr(self, name)
+        return summary
 
     def cancel(self):
         pass
 
 
+def _encode_field(value):
+    # values of other types are saved in the format of their to_json method
+    return value.to_json()
+
+
+def _field_class(field_type) -> Optional[type]:
+    """The class of a field, also for Optional fields"""
+    if typing.get_origin(field_type) is Union:
+        field_type = next(
+            arg for arg in typing.get_args(field_type) if arg is not type(None)
+        )
+    return field_type if isinstance(field_type, type) else None
+
+
+def _result_type(task: Task):
+    return next(f.type for f in fields(task) if f.name == task.result_field)
+
+
+def serialize_task(task: Task) -> str:
+    data = asdict(task)
+    for name in TRANSIENT_FIELDS:
+        data.pop(name, None)
+    if task.result_field is not None:
+        data.pop(task.result_field)
+    return json.dumps(data, default=_encode_field)
+
+
+def deserialize_task(task_type: str, data: str) -> Task:
+    cls = _task_types[task_type]
+    values = json.loads(data)
+    task = cls.__new__(cls)
+    for f in fields(cls):
+        if f.name in values:
+            value = values[f.name]
+            field_class = _field_class(f.type)
+            if value is None or field_class is None:
+                pass
+            elif issubclass(field_class, enum.Enum):
+                value = field_class(value)
+            elif hasattr(field_class, "from_json"):
+                value = field_class.from_json(value)
+        elif f.name == "queue_position":
+            value = None
+        elif f.name == "version":
+            value = next(_versions)
+        elif f.name == cls.result_field:
+            # loaded on demand
+            value = None
+        elif f.default is not MISSING:
+            value = f.default
+        else:
+            raise ValueError(f"saved {task_type} has no field {f.name}")
+        object.__setattr__(task, f.name, value)
+    if hasattr(task, "__post_init__"):
+        task.__post_init__()
+    return task
+
+
+@dataclass
+class Checkpoint:
+    """
+    The finished parts of a long running job, so it can continue from there after
+    a restart. Parts are (segment, position, data) tuples, their meaning is up to
+    the job. path is a file that belongs to the checkpoint (e.g. the input of the
+    job) and is deleted together with it.
+    """
+
+    uuid: str
+    params: dict
+    path: Path
+    parts: List[Tuple[int, float, Any]] = field(default_factory=list)
+    # parts that were not written to the database yet
+    pending: List[Tuple[int, float, Any]] = field(default_factory=list)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add(self, segment: int, position: float, data: Any):
+        with self.lock:
+            self.parts.append((segment, position, data))
+            self.pending.append((segment, position, data))
+
+    def take_pending(self) -> List[Tuple[int, float, Any]]:
+        with self.lock:
+            pending, self.pending = self.pending, []
+        return pending
+
+    def segment_parts(self, segment: int) -> List[Tuple[float, Any]]:
+        with self.lock:
+            return [(p, data) for s, p, data in self.parts if s == segment]
+
+
+class TaskStore:
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS tasks"
+                " (uuid TEXT PRIMARY KEY, type TEXT NOT NULL, data TEXT NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints"
+                " (uuid TEXT PRIMARY KEY, params TEXT NOT NULL, path TEXT NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint_parts (uuid TEXT NOT NULL,"
+                " segment INTEGER NOT NULL, position REAL NOT NULL, data TEXT NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS checkpoint_parts_uuid"
+                " ON checkpoint_parts (uuid)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS results"
+                " (uuid TEXT PRIMARY KEY, data TEXT NOT NULL)"
+            )
+
+    def load_tasks(self) -> List[Task]:
+        loaded = []
+        for task_uuid, task_type, data in self.db.execute(
+            "SELECT uuid, type, data FROM tasks"
+        ):
+            try:
+                loaded.append(deserialize_task(task_type, data))
+            except (KeyError, ValueError):
+                print(f"could not restore task {task_uuid}")
+                traceback.print_exc()
+        return loaded
+
+    def load_result_uuids(self) -> List[str]:
+        return [row[0] for row in self.db.execute("SELECT uuid FROM results")]
+
+    def load_result(self, task_uuid: str) -> Optional[Any]:
+        row = self.db.execute(
+            "SELECT data FROM results WHERE uuid = ?", (task_uuid,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def load_checkpoints(self) -> List[Checkpoint]:
+        checkpoints = {
+            task_uuid: Checkpoint(task_uuid, json.loads(params), Path(path))
+            for task_uuid, params, path in self.db.execute(
+                "SELECT uuid, params, path FROM checkpoints"
+            )
+        }
+        for task_uuid, segment, position, data in self.db.execute(
+            "SELECT uuid, segment, position, data FROM checkpoint_parts ORDER BY rowid"
+        ):
+            if task_uuid in checkpoints:
+                checkpoints[task_uuid].parts.append(
+                    (segment, position, json.loads(data))
+                )
+        return list(checkpoints.values())
+
+
 class Tasks:
     def __init__(self):
         self.tasks = {}
+        self.checkpoints: Dict[str, Checkpoint] = {}
+        self.store: Optional[TaskStore] = None
+        # version of each task in the database
+        self.saved_versions: Dict[str, int] = {}
+        self.new_checkpoints: List[Checkpoint] = []
+        self.removed_checkpoints: List[Checkpoint] = []
+        self.checkpoint_lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        # (version, uuid) of recently deleted tasks, for the event feeds
+        self.deleted = deque(maxlen=1000)
+        # uuids of tasks with a result in the database
+        self.saved_results: Set[str] = set()
+        # uuids of tasks with a result that is only in the database
+        self.unloaded_results: Set[str] = set()
+        # unix time of the last use of each result in memory
+        self.result_used: Dict[str, float] = {}
+        self.expired = 0
+        self.unloaded = 0
 
     def add(self, task: Task):
         self.tasks[task.uuid] = task
+        task_changes.notify()
         return task
 
     def get(self, uuid: str):
@@ -35,6 +292,242 @@ class Tasks:
             self.tasks.pop(uuid)
         except KeyError:
             raise TaskNotFoundError()
+        self.deleted.append((next(_versions), uuid))
+        self.result_used.pop(uuid, None)
+        task_changes.notify()
+        self.remove_checkpoint(uuid)
+
+    def changes(self, since: int) -> Tuple[List[Task], List[str]]:
+        """The tasks that changed and the uuids of tasks deleted after version since"""
+        changed = [task for task in list(self.tasks.values()) if task.version > since]
+        deleted = [uuid for version, uuid in list(self.deleted) if version > since]
+        return changed, deleted
+
+    def latest_version(self) -> int:
+        versions = [task.version for task in list(self.tasks.values())]
+        versions += [version for version, _ in list(self.deleted)]
+        return max(versions, default=0)
+
+    def add_checkpoint(
+        self, uuid: str, params: dict, path: Path
+    ) -> Optional[Checkpoint]:
+        """Returns None if tasks are not saved"""
+        if self.store is None:
+            return None
+        checkpoint = Checkpoint(uuid, params, path)
+        with self.checkpoint_lock:
+            self.checkpoints[uuid] = checkpoint
+            self.new_checkpoints.append(checkpoint)
+        return checkpoint
+
+    def update_checkpoint(self, checkpoint: Checkpoint, params: dict):
+        """Replaces the params of the checkpoint, they are saved with the next save"""
+        with self.checkpoint_lock:
+            checkpoint.params = params
+            if checkpoint.uuid in self.checkpoints:
+                self.new_checkpoints.append(checkpoint)
+
+    def get_checkpoint(self, uuid: str) -> Optional[Checkpoint]:
+        return self.checkpoints.get(uuid)
+
+    def load_result(self, task: Task) -> Optional[Any]:
+        """
+        Returns the result of the task, after reading it from the database if it
+        is not in memory. Results should only be accessed through this method,
+        unused ones are dropped from memory again.
+        """
+        if task.result_field is None:
+            return None
+        result = getattr(task, task.result_field)
+        if result is None and task.uuid in self.unloaded_results:
+            with self.save_lock:
+                data = self.store.load_result(task.uuid)
+            if data is not None:
+                result = _field_class(_result_type(task)).from_json(data)
+                # this is not a change of the task
+                object.__setattr__(task, task.result_field, result)
+            self.unloaded_results.discard(task.uuid)
+        if result is not None:
+            self.result_used[task.uuid] = time.time()
+        return result
+
+    def result_memory(self) -> int:
+        """Approximate number of bytes used by results in memory"""
+        return sum(
+            getattr(getattr(task, task.result_field), "nbytes", 0)
+            for task in list(self.tasks.values())
+            if task.result_field is not None
+        )
+
+    def stats(self) -> dict:
+        results = [
+            task for task in list(self.tasks.values()) if task.result_field is not None
+        ]
+        return {
+            "tasks": len(self.tasks),
+            "finished_tasks": sum(
+                task.finished_at is not None for task in list(self.tasks.values())
+            ),
+            "results_in_memory": sum(
+                getattr(task, task.result_field) is not None for task in results
+            ),
+            "results_on_disk": len(self.unloaded_results),
+            "result_memory": self.result_memory(),
+            "result_memory_limit": RESULT_MEMORY_LIMIT,
+            "unloaded": self.unloaded,
+            "expired": self.expired,
+        }
+
+    def remove_checkpoint(self, uuid: str):
+        with self.checkpoint_lock:
+            checkpoint = self.checkpoints.pop(uuid, None)
+            if checkpoint is not None:
+                self.removed_checkpoints.append(checkpoint)
+
+    def restore(self, path: Path = DATA_DIR / "tasks.sqlite") -> List[Task]:
+        """
+        Loads the tasks and checkpoints that were saved by a previous run of the
+        server and starts saving changes in the background.
+        """
+        self.store = TaskStore(path)
+        restored = self.store.load_tasks()
+        self.saved_results = set(self.store.load_result_uuids())
+        for task in restored:
+            self.tasks[task.uuid] = task
+            # older versions saved results in the row of the task, those tasks
+            # are saved again to move the result into the results table
+            if task.result_field is None or getattr(task, task.result_field) is None:
+                self.saved_versions[task.uuid] = task.version
+                if task.uuid in self.saved_results:
+                    self.unloaded_results.add(task.uuid)
+            state = getattr(task, "state", None)
+            if task.finished_at is None and state in task.final_states:
+                # finished before finish times were saved
+                object.__setattr__(task, "finished_at", time.time())
+        for checkpoint in self.store.load_checkpoints():
+            self.checkpoints[checkpoint.uuid] = checkpoint
+        threading.Thread(target=self._save_periodically, daemon=True).start()
+        return restored
+
+    def _save_periodically(self):
+        while True:
+            time.sleep(TASK_SAVE_INTERVAL)
+            try:
+                self.save()
+                self.expire()
+            except Exception:
+                traceback.print_exc()
+
+    def expire(self):
+        """
+        Deletes tasks that finished more than TASK_TTL seconds ago and drops saved
+        results from memory that are unused or exceed RESULT_MEMORY_LIMIT
+        """
+        now = time.time()
+        in_memory = []
+        for task in list(self.tasks.values()):
+            if task.finished_at is None:
+                continue
+            if TASK_TTL and now - task.finished_at > TASK_TTL:
+                try:
+                    self.delete(task.uuid)
+                    self.expired += 1
+                except TaskNotFoundError:
+                    pass
+            elif (
+                task.result_field is not None
+                and task.uuid in self.saved_results
+                and getattr(task, task.result_field) is not None
+            ):
+                in_memory.append(task)
+
+        in_memory.sort(
+            key=lambda task: self.result_used.get(task.uuid, task.finished_at)
+        )
+        memory = self.result_memory()
+        for task in in_memory:
+            used = self.result_used.get(task.uuid, task.finished_at)
+            if memory <= RESULT_MEMORY_LIMIT and now - used < RESULT_IDLE_TIMEOUT:
+                break
+            memory -= getattr(getattr(task, task.result_field), "nbytes", 0)
+            self._unload_result(task)
+
+    def _unload_result(self, task: Task):
+        self.unloaded_results.add(task.uuid)
+        object.__setattr__(task, task.result_field, None)
+        self.result_used.pop(task.uuid, None)
+        self.unloaded += 1
+
+    def save(self):
+        """Writes all changes since the last save to the database"""
+        if self.store is None:
+            return
+        with self.save_lock, self.store.db as db:
+            current = {
+                task.uuid: task for task in list(self.tasks.values()) if task.persistent
+            }
+            for task_uuid in list(self.saved_versions):
+                if task_uuid not in current:
+                    db.execute("DELETE FROM tasks WHERE uuid = ?", (task_uuid,))
+                    del self.saved_versions[task_uuid]
+            for task_uuid in list(self.saved_results):
+                if task_uuid not in current:
+                    db.execute("DELETE FROM results WHERE uuid = ?", (task_uuid,))
+                    self.saved_results.discard(task_uuid)
+                    self.unloaded_results.discard(task_uuid)
+                    self.result_used.pop(task_uuid, None)
+            for task_uuid, task in current.items():
+                version = task.version
+                if self.saved_versions.get(task_uuid) == version:
+                    continue
+                db.execute(
+                    "INSERT OR REPLACE INTO tasks (uuid, type, data) VALUES (?, ?, ?)",
+                    (task_uuid, type(task).__name__, serialize_task(task)),
+                )
+                self.saved_versions[task_uuid] = version
+                result = (
+                    getattr(task, task.result_field)
+                    if task.result_field is not None
+                    else None
+                )
+                if result is not None and task_uuid not in self.saved_results:
+                    db.execute(
+                        "INSERT OR REPLACE INTO results (uuid, data) VALUES (?, ?)",
+                        (task_uuid, json.dumps(result, default=_encode_field)),
+                    )
+                    self.saved_results.add(task_uuid)
+
+            with self.checkpoint_lock:
+                new_checkpoints, self.new_checkpoints = self.new_checkpoints, []
+                removed_checkpoints = self.removed_checkpoints
+                self.removed_checkpoints = []
+                checkpoints = list(self.checkpoints.values())
+            for checkpoint in new_checkpoints:
+                db.execute(
+                    "INSERT OR REPLACE INTO checkpoints (uuid, params, path)"
+                    " VALUES (?, ?, ?)",
+                    (
+                        checkpoint.uuid,
+                        json.dumps(checkpoint.params),
+                        str(checkpoint.path),
+                    ),
+                )
+            for checkpoint in checkpoints:
+                db.executemany(
+                    "INSERT INTO checkpoint_parts (uuid, segment, position, data)"
+                    " VALUES (?, ?, ?, ?)",
+                    [
+                        (checkpoint.uuid, segment, position, json.dumps(data))
+                        for segment, position, data in checkpoint.take_pending()
+                    ],
+                )
+
+            for checkpoint in removed_checkpoints:
+                db.execute("DELETE FROM checkpoints WHERE uuid = ?", (checkpoint.uuid,))
+                db.execute(
+                    "DELETE FROM checkpoint_parts WHERE uuid = ?", (checkpoint.uuid,)
+                )
+                checkpoint.path.unlink(missing_ok=True)
 
 
 class TaskNotFoundError(Exception):
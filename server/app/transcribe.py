@@ -1,25 +1,76 @@
 import enum
+import hashlib
 import json
+import queue
+import tempfile
+import threading
+import time
 import traceback
-import warnings
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
-from typing import Optional
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
-import numpy as np
 from fastapi import UploadFile
-from pydiar.models import BinaryKeyDiarizationModel, Segment
-from pydiar.util.misc import optimize_segments
-from pydub import AudioSegment
-from vosk import KaldiRecognizer, Model
 
-from .models import models
-from .tasks import Task, tasks
+from .audio import (
+    SAMPLE_RATE,
+    SAMPLE_WIDTH,
+    AudioSource,
+    ChunkStream,
+    MediaStreamDecoder,
+    file_hash,
+    find_split_points,
+)
+from .cache import diarization_cache, result_cache
+from .config import (
+    ALLOWED_ROOTS,
+    CACHE_DIR,
+    CHECKPOINT_MIN_DURATION,
+    DATA_DIR,
+    PARALLEL_CHUNK_SIZE,
+    TRANSCRIPTION_BACKEND,
+)
+from .events import EventLog
+from .models import RecognizerPool, models
+from .process_pool import process_backend
+from .recognition import (
+    ResultTransformer,
+    recognize_samples,
+    stitch_chunks,
+    transform_vosk_result,
+)
+from .scheduler import JobType, scheduler, segment_executor
+from .tasks import Checkpoint, Task, tasks
+from .transcript import Transcript
 
-SAMPLE_RATE = 16000
-# Number of seconds that should be fed into vosk.
-# Smaller = better progress estimates, but also slightly higher python overhead
-VOSK_BLOCK_SIZE = 2
+if TYPE_CHECKING:
+    from pydiar.models import Segment
+
+CHECKPOINT_DIR = DATA_DIR / "checkpoints"
+# Samples per write of the audio of a checkpoint
+CHECKPOINT_BLOCK_SIZE = 60 * SAMPLE_RATE
+# Seconds between updates of the aggregate progress of a batch
+BATCH_PROGRESS_INTERVAL = 0.5
+
+
+class PathNotAllowed(Exception):
+    pass
+
+
+class LocalFileNotFound(Exception):
+    pass
 
 
 class TranscriptionState(str, enum.Enum):
@@ -29,6 +80,7 @@ class TranscriptionState(str, enum.Enum):
     DIARIZING = "diarizing"
     TRANSCRIBING = "transcribing"
     DONE = "done"
+    FAILED = "failed"
 
 
 @dataclass
@@ -37,36 +89,280 @@ class TranscriptionTask(Task):
     state: TranscriptionState
     total: float = 0
     processed: float = 0
-    content: Optional[dict] = None
+    content: Optional[Transcript] = None
     progress: float = 0
+    from_cache: bool = False
+    # None if the job was not diarized
+    diarization_from_cache: Optional[bool] = None
+    diarization_time_saved: float = 0
+    # why the transcription failed
+    error: Optional[str] = None
+
+    persistent = True
+    summary_fields = ("state", "progress", "filename")
+    final_states = (TranscriptionState.DONE, TranscriptionState.FAILED)
+    result_field = "content"
 
     def set_transcription_progress(self, processed):
         self.processed += processed
-        self.progress = self.processed / self.total
-
-
-def transcribe_raw_data(model: Model, name, audio, offset, duration, process_callback):
-    rec = KaldiRecognizer(model, SAMPLE_RATE)
-    rec.SetWords(True)
-
-    finished = False
-    processed = offset
-    while not finished:
-        block_start = processed
-        block_end = processed + VOSK_BLOCK_SIZE
-        if block_end > offset + duration:
-            block_end = offset + duration
-            finished = True
-        data = audio[block_start * 1000 : block_end * 1000]
-        rec.AcceptWaveform(data.get_array_of_samples().tobytes())
-        processed = block_end
-        process_callback(processed - block_start)
-
-    vosk_result = json.loads(rec.FinalResult())
+        if self.total:
+            self.progress = min(self.processed / self.total, 1)
+
+    def fail(self, error: str):
+        self.error = error
+        self.state = TranscriptionState.FAILED
+
+
+class BatchTranscriptionState(str, enum.Enum):
+    LOADING_TRANSCRIPTION_MODEL = "loading transcription model"
+    TRANSCRIBING = "transcribing"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class BatchFile:
+    # uuid of the TranscriptionTask of the file, which holds its result
+    uuid: str
+    filename: str
+    state: TranscriptionState
+    progress: float = 0
+    error: Optional[str] = None
+
+
+@dataclass
+class BatchTranscriptionTask(Task):
+    transcription_model: str
+    diarize: bool
+    diarize_max_speakers: Optional[int]
+    state: BatchTranscriptionState
+    files: List[BatchFile] = field(default_factory=list)
+    # number of files that are done / failed
+    done: int = 0
+    failed: int = 0
+    # mean progress of the files, failed files count as finished
+    progress: float = 0
+
+    summary_fields = ("state", "progress", "done", "failed")
+    final_states = (BatchTranscriptionState.DONE, BatchTranscriptionState.FAILED)
+
+    def __post_init__(self):
+        self.canceled = False
+
+    def update(self, children: List[TranscriptionTask]):
+        files = [
+            BatchFile(task.uuid, task.filename, task.state, task.progress, task.error)
+            for task in children
+        ]
+        # only assigning changes, every assignment is a new version of the task
+        if files != self.files:
+            self.files = files
+        done = sum(1 for task in children if task.state == TranscriptionState.DONE)
+        failed = sum(1 for task in children if task.state == TranscriptionState.FAILED)
+        if done != self.done:
+            self.done = done
+        if failed != self.failed:
+            self.failed = failed
+        self.progress = sum(
+            1 if task.state in task.final_states else task.progress for task in children
+        ) / len(children)
+
+    def cancel(self):
+        self.canceled = True
+
+
+class LiveTranscript:
+    """
+    The finalized words (and the silences between them) of a running
+    transcription, in the format of the final content. Every event holds new
+    items of one segment, which are appended to the items sent for it before.
+    When stitching, all segments are consecutive parts of the same paragraph.
+    """
+
+    def __init__(self, segments: List[Tuple[str, float, float]], stitch: bool):
+        self.segments = segments
+        self.stitch = stitch
+        self.events = EventLog()
+        self.transformers = [ResultTransformer(offset) for _, offset, _ in segments]
+        self.sent = [0] * len(segments)
+
+    def _send(self, segment: int, items: List[dict]):
+        self.sent[segment] += len(items)
+        if items:
+            self.events.append(
+                {
+                    "paragraph": 0 if self.stitch else segment,
+                    "segment": segment,
+                    "speaker": self.segments[segment][0],
+                    "content": items,
+                }
+            )
+
+    def add_words(self, segment: int, words: List[dict]):
+        self._send(segment, self.transformers[segment].add_words(words))
+
+    def finish_segment(self, segment: int, paragraph: Transcript):
+        # the final content of the segment only adds the silence at its end
+        self._send(segment, paragraph.paragraph_items(0, self.sent[segment]))
+
+
+live_transcripts: Dict[str, LiveTranscript] = {}
+
+
+def start_live_transcript(
+    task_uuid: str, segments: List[Tuple[str, float, float]], stitch: bool
+) -> LiveTranscript:
+    live = LiveTranscript(segments, stitch)
+    live_transcripts[task_uuid] = live
+    return live
+
+
+def end_live_transcript(task_uuid: str):
+    live = live_transcripts.pop(task_uuid, None)
+    if live is not None:
+        live.events.close()
+
+
+def result_cache_key(
+    audio_hash: str,
+    transcription_model: str,
+    diarize: bool,
+    diarize_max_speakers: Optional[int],
+) -> str:
+    # the audio hash comes first, so all results of a file can be invalidated at once
+    options = json.dumps([transcription_model, diarize, diarize_max_speakers])
+    return f"{audio_hash}-{hashlib.sha256(options.encode()).hexdigest()[:16]}"
+
+
+def rename_paragraphs(content: Transcript, old_name: str, new_name: str):
+    """Replaces the file name in the speaker names of a cached result"""
+    if old_name == new_name:
+        return content
+    speakers = []
+    for speaker in content.speakers:
+        if speaker == old_name:
+            speaker = new_name
+        elif speaker.endswith(f"({old_name})"):
+            speaker = f"{speaker[: -len(old_name) - 2]}({new_name})"
+        speakers.append(speaker)
+    return content.with_speakers(speakers)
+
+
+def load_cached_result(key: str, fileName: str) -> Optional[Transcript]:
+    cached = result_cache.get(key)
+    if cached is None:
+        return None
+    content = Transcript.from_json(cached["content"])
+    return rename_paragraphs(content, cached["file_name"], fileName)
+
+
+def answer_from_cache(
+    task: TranscriptionTask,
+    audio_hash: str,
+    transcription_model: str,
+    fileName: str,
+    diarize: bool,
+    diarize_max_speakers: Optional[int],
+) -> bool:
+    """Finishes the task with a cached result, if there is one, without a job"""
+    content = load_cached_result(
+        result_cache_key(
+            audio_hash, transcription_model, diarize, diarize_max_speakers
+        ),
+        fileName,
+    )
+    if content is None:
+        return False
+    task.total = task.processed = content.duration
+    task.from_cache = True
+    task.progress = 1
+    task.content = content
+    task.state = TranscriptionState.DONE
+    return True
+
+
+def source_hash(source: Union[Path, BinaryIO]) -> str:
+    """sha256 of an uploaded file or of a file on this machine"""
+    if isinstance(source, Path):
+        with open(source, "rb") as f:
+            return file_hash(f)
+    return file_hash(source)
+
+
+def store_result(key: str, fileName: str, content: Transcript):
+    if not content.n_items:
+        # more likely a decoding problem than a result worth keeping
+        return
+    try:
+        result_cache.put(key, {"file_name": fileName, "content": content.to_json()})
+    except OSError:
+        # a full disk should not fail an otherwise finished transcription
+        traceback.print_exc()
+
+
+def transcribe_raw_data(
+    recognizers: RecognizerPool,
+    name,
+    audio: AudioSource,
+    offset,
+    duration,
+    process_callback,
+    resume_position: float = 0,
+    words: Optional[List[dict]] = None,
+    utterance_callback=None,
+):
+    if resume_position < duration:
+        with recognizers.recognizer() as rec:
+            vosk_result = recognize_samples(
+                rec,
+                audio.samples,
+                offset,
+                duration,
+                process_callback,
+                resume_position,
+                words,
+                utterance_callback,
+            )
+    else:
+        vosk_result = {"result": words or []}
     return transform_vosk_result(name, vosk_result, duration, offset)
 
 
-EPSILON = 0.00001
+def transcribe_stream(
+    recognizers: RecognizerPool,
+    name,
+    pcm_chunks: Iterable[bytes],
+    process_callback,
+    utterance_callback=None,
+) -> Transcript:
+    """
+    Feeds mono SAMPLE_RATE pcm into the recognizer as it is produced, so
+    recognition can run while the upload is still in progress.
+    """
+    samples = 0
+    words = []
+    with recognizers.recognizer() as rec:
+        for chunk in pcm_chunks:
+            endpoint = rec.AcceptWaveform(chunk)
+            samples += len(chunk) // SAMPLE_WIDTH
+            process_callback(len(chunk) / SAMPLE_WIDTH / SAMPLE_RATE)
+            if endpoint:
+                utterance = json.loads(rec.Result()).get("result", [])
+                words.extend(utterance)
+                if utterance_callback is not None:
+                    utterance_callback(samples / SAMPLE_RATE, utterance)
+
+        final = json.loads(rec.FinalResult()).get("result", [])
+        words.extend(final)
+        if utterance_callback is not None:
+            utterance_callback(samples / SAMPLE_RATE, final)
+    return transform_vosk_result(name, {"result": words}, samples / SAMPLE_RATE)
+
+
+def fail_transcription(task: TranscriptionTask, error: Exception):
+    """Marks the task as failed, failed transcriptions are not resumed"""
+    task.fail(str(error) or type(error).__name__)
+    tasks.remove_checkpoint(task.uuid)
 
 
 def process_audio(
@@ -76,21 +372,507 @@ def process_audio(
     task_uuid: str,
     diarize: bool,
     diarize_max_speakers: Optional[int],
+    audio_hash: Optional[str] = None,
+    source_path: Optional[Path] = None,
 ):
     task = tasks.get(task_uuid)
 
-    content = transcribe(
-        task,
-        transcription_model,
-        file,
-        fileName,
-        task_uuid,
-        diarize,
-        diarize_max_speakers,
+    try:
+        content = transcribe(
+            task,
+            transcription_model,
+            file,
+            fileName,
+            task_uuid,
+            diarize,
+            diarize_max_speakers,
+            audio_hash,
+            source_path,
+        )
+
+        task.content = content
+        task.state = TranscriptionState.DONE
+        tasks.remove_checkpoint(task_uuid)
+    except Exception as e:
+        fail_transcription(task, e)
+        raise
+    finally:
+        end_live_transcript(task_uuid)
+
+
+def local_file(path: str) -> Path:
+    """The resolved path of a file in one of the ALLOWED_ROOTS"""
+    resolved = Path(path).expanduser().resolve()
+    # resolving first, so symlinks can't point outside of the roots
+    if not ALLOWED_ROOTS:
+        raise PathNotAllowed(
+            "transcribing files by path is disabled, see AUDAPOLIS_ALLOWED_ROOTS"
+        )
+    if not any(root == resolved or root in resolved.parents for root in ALLOWED_ROOTS):
+        raise PathNotAllowed(f"{path} is not in an allowed directory")
+    if not resolved.is_file():
+        raise LocalFileNotFound(f"{path} is not a file")
+    return resolved
+
+
+def process_local_file(
+    transcription_model: str,
+    path: Path,
+    fileName: str,
+    task_uuid: str,
+    diarize: bool,
+    diarize_max_speakers: Optional[int],
+    audio_hash: Optional[str] = None,
+):
+    """
+    Transcribes a file on this machine, which is memory mapped instead of copied.
+    Checkpoints of long files refer to the file instead of saving its audio.
+    """
+    try:
+        file = open(path, "rb")
+    except OSError as e:
+        fail_transcription(tasks.get(task_uuid), e)
+        raise
+    with file:
+        process_audio(
+            transcription_model,
+            file,
+            fileName,
+            task_uuid,
+            diarize,
+            diarize_max_speakers,
+            audio_hash,
+            path,
+        )
+
+
+def start_batch(
+    batch: BatchTranscriptionTask,
+    children: List[TranscriptionTask],
+    sources: List[Union[Path, BinaryIO]],
+    max_parallel: int,
+    priority: int,
+):
+    """
+    Starts transcribing the files of a batch in the background. sources holds the
+    file of each child task, paths for files on this machine.
+    """
+    threading.Thread(
+        target=process_batch,
+        args=(batch, children, sources, max_parallel, priority),
+        daemon=True,
+    ).start()
+
+
+def process_batch(
+    batch: BatchTranscriptionTask,
+    children: List[TranscriptionTask],
+    sources: List[Union[Path, BinaryIO]],
+    max_parallel: int,
+    priority: int,
+):
+    """
+    Keeps the model of the batch loaded while its files are transcribed, so it is
+    loaded once. Files with a cached result are answered right away, the others
+    are submitted to the scheduler as transcription jobs, at most max_parallel at
+    a time, so they also count towards MAX_CONCURRENT_TRANSCRIPTIONS. Deleting
+    the batch drops the files that were not started yet.
+    """
+    pending = list(zip(children, sources))
+    running: Dict[Future, TranscriptionTask] = {}
+    try:
+        with ExitStack() as stack:
+            model_loaded = False
+            while pending or running:
+                if batch.canceled:
+                    for task, _ in pending:
+                        if task.uuid in tasks.tasks:
+                            tasks.delete(task.uuid)
+                    pending = []
+                while pending and len(running) < max_parallel:
+                    task, source = pending.pop(0)
+                    try:
+                        audio_hash = source_hash(source)
+                    except OSError as e:
+                        fail_transcription(task, e)
+                        continue
+                    if answer_from_cache(
+                        task,
+                        audio_hash,
+                        batch.transcription_model,
+                        task.filename,
+                        batch.diarize,
+                        batch.diarize_max_speakers,
+                    ):
+                        continue
+                    if not model_loaded:
+                        batch.state = (
+                            BatchTranscriptionState.LOADING_TRANSCRIPTION_MODEL
+                        )
+                        stack.enter_context(models.use(batch.transcription_model))
+                        batch.state = BatchTranscriptionState.TRANSCRIBING
+                        model_loaded = True
+                    future = scheduler.submit(
+                        task,
+                        JobType.TRANSCRIPTION,
+                        (
+                            process_local_file
+                            if isinstance(source, Path)
+                            else process_audio
+                        ),
+                        batch.transcription_model,
+                        source,
+                        task.filename,
+                        task.uuid,
+                        batch.diarize,
+                        batch.diarize_max_speakers,
+                        audio_hash,
+                        priority=priority,
+                    )
+                    running[future] = task
+                finished, _ = wait(
+                    running,
+                    timeout=BATCH_PROGRESS_INTERVAL,
+                    return_when=FIRST_COMPLETED,
+                )
+                for future, task in list(running.items()):
+                    # the scheduler drops the jobs of deleted tasks without running them
+                    if future in finished or (
+                        task.uuid not in tasks.tasks and not future.running()
+                    ):
+                        del running[future]
+                        if task.state not in task.final_states:
+                            task.fail("the transcription was not started")
+                batch.update(children)
+    except Exception as e:
+        traceback.print_exc()
+        for task in children:
+            if task.state not in task.final_states:
+                task.fail(str(e) or type(e).__name__)
+        batch.update(children)
+        batch.state = BatchTranscriptionState.FAILED
+        return
+    batch.state = BatchTranscriptionState.DONE
+
+
+def process_audio_stream(
+    transcription_model: str,
+    stream: ChunkStream,
+    fileName: str,
+    task_uuid: str,
+    diarize: bool,
+    diarize_max_speakers: Optional[int],
+    expected_size: Optional[int],
+):
+    task = tasks.get(task_uuid)
+    task.state = TranscriptionState.LOADING_TRANSCRIPTION_MODEL
+    try:
+        with models.use(transcription_model) as recognizers:
+            content = transcribe_audio_stream(
+                task,
+                recognizers,
+                stream,
+                transcription_model,
+                fileName,
+                diarize,
+                diarize_max_speakers,
+                expected_size,
+            )
+        task.content = content
+        task.state = TranscriptionState.DONE
+        tasks.remove_checkpoint(task_uuid)
+    except Exception as e:
+        # the rest of the upload is dropped and the upload request fails with e
+        stream.finish(e)
+        fail_transcription(task, e)
+        raise
+    finally:
+        stream.finish()
+        end_live_transcript(task_uuid)
+
+
+def resume_transcription(task_uuid: str):
+    """Continues a transcription that was interrupted by a restart of the server"""
+    task = tasks.get(task_uuid)
+    checkpoint = tasks.get_checkpoint(task_uuid)
+    if checkpoint is None:
+        task.fail("the audio of the interrupted transcription is missing")
+        return
+    params = checkpoint.params
+    source = params.get("source")
+    segments = [tuple(segment) for segment in params["segments"]]
+    end = max(offset + duration for _, offset, duration in segments)
+    if source is not None:
+        if not Path(source).is_file():
+            task.fail(f"{source} is missing")
+            tasks.remove_checkpoint(task_uuid)
+            return
+    elif not checkpoint.path.exists():
+        task.fail("the audio of the interrupted transcription is missing")
+        tasks.remove_checkpoint(task_uuid)
+        return
+    elif not params.get("complete", True):
+        task.fail("the server stopped before the whole file was uploaded")
+        tasks.remove_checkpoint(task_uuid)
+        return
+    elif checkpoint.path.stat().st_size < int(end * SAMPLE_RATE) * SAMPLE_WIDTH:
+        # the server stopped before the audio was written
+        task.fail("the server stopped before the audio was saved completely")
+        tasks.remove_checkpoint(task_uuid)
+        return
+
+    task.processed = 0
+    task.state = TranscriptionState.LOADING
+    try:
+        with open(source or checkpoint.path, "rb") as f:
+            if source is not None and file_hash(f) != params["source_hash"]:
+                task.fail(f"{source} changed since the transcription started")
+                tasks.remove_checkpoint(task_uuid)
+                return
+            audio = (
+                AudioSource.from_file(f, params["source_hash"])
+                if source is not None
+                else AudioSource.from_pcm(f)
+            )
+            task.state = TranscriptionState.LOADING_TRANSCRIPTION_MODEL
+            with audio, models.use(params["transcription_model"]) as recognizers:
+                content = finish_transcription(
+                    task, recognizers, audio, segments, params["stitch"], checkpoint
+                )
+        if params["cache_key"] is not None:
+            store_result(params["cache_key"], task.filename, content)
+        task.content = content
+        task.state = TranscriptionState.DONE
+        tasks.remove_checkpoint(task_uuid)
+    except Exception as e:
+        fail_transcription(task, e)
+        raise
+    finally:
+        end_live_transcript(task_uuid)
+
+
+def start_checkpoint(
+    task: TranscriptionTask,
+    transcription_model: str,
+    segments: List[Tuple[str, float, float]],
+    stitch: bool,
+    cache_key: Optional[str],
+    source_path: Optional[Path] = None,
+    source_hash: Optional[str] = None,
+    complete: bool = True,
+) -> Optional[Checkpoint]:
+    """
+    Starts saving the finalized utterances of long transcriptions, so they can be
+    resumed after a restart. The audio itself needs to be written to the path of
+    the returned checkpoint, unless it is read from source_path (a file on this
+    machine with the hash source_hash) again. Checkpoints that are not complete
+    yet (because the audio is still being uploaded) are not resumed.
+    """
+    duration = max(offset + length for _, offset, length in segments)
+    if duration < CHECKPOINT_MIN_DURATION:
+        return None
+    CHECKPOINT_DIR.mkdir(exist_ok=True, parents=True)
+    return tasks.add_checkpoint(
+        task.uuid,
+        {
+            "transcription_model": transcription_model,
+            "segments": segments,
+            "stitch": stitch,
+            "cache_key": cache_key,
+            "source": str(source_path) if source_path is not None else None,
+            "source_hash": source_hash,
+            "complete": complete,
+        },
+        CHECKPOINT_DIR / f"{task.uuid}.pcm",
     )
 
-    task.content = content
-    task.state = TranscriptionState.DONE
+
+class CheckpointAudioWriter:
+    """
+    Writes the audio of a checkpoint from a background thread, so the transcription
+    does not wait for it. Leaving the context waits for the queued writes, or
+    drops them if it is left with an exception. A checkpoint whose audio was not
+    written completely is rejected when it is resumed.
+    """
+
+    def __init__(self, path: Path):
+        self.file = open(path, "wb")
+        self.queue: "queue.Queue[Optional[memoryview]]" = queue.Queue()
+        self.aborted = False
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        self.queue.put(memoryview(data).cast("B"))
+
+    def write_samples(self, samples):
+        for start in range(0, len(samples), CHECKPOINT_BLOCK_SIZE):
+            self.write(samples[start : start + CHECKPOINT_BLOCK_SIZE])
+
+    def _write(self):
+        try:
+            for data in iter(self.queue.get, None):
+                if not self.aborted:
+                    self.file.write(data)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.file.close()
+
+    def __enter__(self) -> "CheckpointAudioWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.aborted = exc_type is not None
+        self.queue.put(None)
+        self.thread.join()
+
+
+def transcribe_audio_stream(
+    task: TranscriptionTask,
+    recognizers: RecognizerPool,
+    stream: ChunkStream,
+    transcription_model: str,
+    fileName: str,
+    diarize: bool,
+    diarize_max_speakers: Optional[int],
+    expected_size: Optional[int],
+):
+    decoder = MediaStreamDecoder(expected_size)
+    checkpoint = None
+    # until it is clear whether the file is long enough for a checkpoint, its
+    # first chunks and utterances are kept, so the checkpoint starts with them
+    pending_chunks: Optional[List[bytes]] = None if diarize else []
+    pending_utterances: List[Tuple[float, List[dict]]] = []
+
+    def pcm_chunks():
+        nonlocal checkpoint, pending_chunks
+        decoded = 0
+        # chunks are passed on once the next one is decoded, so the checkpoint is
+        # complete before the end of the audio is transcribed
+        previous = None
+        with ExitStack() as stack:
+            writer = None
+            for chunk in decoder.decode(stream):
+                decoded += len(chunk)
+                if not task.total and decoder.duration_seconds:
+                    task.total = decoder.duration_seconds
+                if pending_chunks is not None:
+                    pending_chunks.append(chunk)
+                    checkpoint = start_checkpoint(
+                        task,
+                        transcription_model,
+                        [
+                            (
+                                fileName,
+                                0,
+                                decoder.duration_seconds
+                                or decoded / SAMPLE_WIDTH / SAMPLE_RATE,
+                            )
+                        ],
+                        True,
+                        None,
+                        complete=False,
+                    )
+                    if checkpoint is not None:
+                        writer = stack.enter_context(
+                            CheckpointAudioWriter(checkpoint.path)
+                        )
+                        for pending in pending_chunks:
+                            writer.write(pending)
+                        for position, words in pending_utterances:
+                            checkpoint.add(0, position, words)
+                        pending_chunks = None
+                    elif decoder.duration_seconds is not None:
+                        # too short for a checkpoint
+                        pending_chunks = None
+                elif writer is not None:
+                    writer.write(chunk)
+                if previous is not None:
+                    yield previous
+                previous = chunk
+        pending_chunks = None
+        if checkpoint is not None:
+            # the estimated duration is replaced by the length of the decoded audio
+            tasks.update_checkpoint(
+                checkpoint,
+                {
+                    **checkpoint.params,
+                    "segments": [(fileName, 0, decoded / SAMPLE_WIDTH / SAMPLE_RATE)],
+                    "complete": True,
+                },
+            )
+        if previous is not None:
+            yield previous
+
+    def utterance_callback(position, words):
+        if checkpoint is not None:
+            checkpoint.add(0, position, words)
+        elif pending_chunks is not None:
+            pending_utterances.append((position, words))
+        live.add_words(0, words)
+
+    if diarize:
+        # diarization needs to see the whole file, so we can only overlap the
+        # upload with decoding here
+        task.state = TranscriptionState.LOADING
+        with tempfile.TemporaryFile(dir=CACHE_DIR) as pcm_file:
+            for chunk in pcm_chunks():
+                pcm_file.write(chunk)
+            cached = load_cached_result(
+                result_cache_key(
+                    stream.content_hash.hexdigest(),
+                    transcription_model,
+                    diarize,
+                    diarize_max_speakers,
+                ),
+                fileName,
+            )
+            if cached is not None:
+                task.from_cache = True
+                task.progress = 1
+                return cached
+            with AudioSource.from_pcm(pcm_file) as audio:
+                content = transcribe_audio(
+                    task,
+                    recognizers,
+                    transcription_model,
+                    audio,
+                    fileName,
+                    diarize,
+                    diarize_max_speakers,
+                    stream.content_hash.hexdigest(),
+                )
+    else:
+        task.state = TranscriptionState.TRANSCRIBING
+        live = start_live_transcript(task.uuid, [(fileName, 0, 0)], True)
+        paragraph = transcribe_stream(
+            recognizers,
+            fileName,
+            pcm_chunks(),
+            task.set_transcription_progress,
+            utterance_callback,
+        )
+        live.finish_segment(0, paragraph)
+        content = paragraph
+        if decoder.duration_seconds is None:
+            # ffmpeg doesn't know the duration of some streamed formats, results
+            # of those are not cached as it can't tell whether they are complete
+            task.total = task.processed
+            task.progress = 1
+            return content
+    # the hash is only complete once the whole upload was consumed
+    store_result(
+        result_cache_key(
+            stream.content_hash.hexdigest(),
+            transcription_model,
+            diarize,
+            diarize_max_speakers,
+        ),
+        fileName,
+        content,
+    )
+    return content
 
 
 def transcribe(
@@ -101,118 +883,270 @@ def transcribe(
     task_uuid: str,
     diarize: bool,
     diarize_max_speakers: Optional[int],
+    audio_hash: Optional[str] = None,
+    source_path: Optional[Path] = None,
 ):
-    task.state = TranscriptionState.LOADING_TRANSCRIPTION_MODEL
+    # fail before decoding the file if the model can't be used anyway
+    models.check_downloaded(transcription_model)
+    with AudioSource.from_file(file, audio_hash) as audio:
+        audio_hash = audio.content_hash()
+        key = result_cache_key(
+            audio_hash, transcription_model, diarize, diarize_max_speakers
+        )
+        cached = load_cached_result(key, fileName)
+        if cached is not None:
+            task.total = task.processed = audio.duration_seconds
+            task.from_cache = True
+            task.progress = 1
+            return cached
 
-    # TODO: Set error state if model does not exist
-    model = models.get(transcription_model)
+        task.state = TranscriptionState.LOADING_TRANSCRIPTION_MODEL
+        with models.use(transcription_model) as recognizers:
+            content = transcribe_audio(
+                task,
+                recognizers,
+                transcription_model,
+                audio,
+                fileName,
+                diarize,
+                diarize_max_speakers,
+                audio_hash,
+                source_path,
+            )
+        store_result(key, fileName, content)
+        return content
 
-    with warnings.catch_warnings():
-        # we ignore the warning that ffmpeg is not found as we
-        # don't need ffmpeg to decode wav files
-        warnings.filterwarnings("ignore", ".*ffmpeg.*")
-        audio = AudioSegment.from_wav(file)
-    audio = audio.set_frame_rate(SAMPLE_RATE)
-    audio = audio.set_channels(1)
 
+def transcribe_audio(
+    task: TranscriptionTask,
+    recognizers: RecognizerPool,
+    transcription_model: str,
+    audio: AudioSource,
+    fileName: str,
+    diarize: bool,
+    diarize_max_speakers: Optional[int],
+    audio_hash: Optional[str] = None,
+    source_path: Optional[Path] = None,
+):
+    """source_path is the file on this machine the audio was read from, if any"""
     # TODO: can we make this atomic?
     task.total = audio.duration_seconds
     task.processed = 0
 
     if not diarize:
-        task.state = TranscriptionState.TRANSCRIBING
-        return [
-            transcribe_raw_data(
-                model,
-                fileName,
-                audio,
-                0,
-                audio.duration_seconds,
-                task.set_transcription_progress,
-            )
-        ]
-
+        segments = split_segments(fileName, audio)
     else:
-        task.state = TranscriptionState.DIARIZING
-        try:
-            diarization_model = BinaryKeyDiarizationModel()
-            if diarize_max_speakers is not None:
-                diarization_model.CLUSTERING_SELECTION_MAX_SPEAKERS = (
-                    diarize_max_speakers
-                )
-            segments = diarization_model.diarize(
-                SAMPLE_RATE, np.array(audio.get_array_of_samples())
-            )
-            optimized_segments = optimize_segments(segments)
-        except:  # noqa: E722
-            traceback.print_exc()
-            optimized_segments = []
+        optimized_segments = diarize_audio(
+            task, audio, diarize_max_speakers, audio_hash
+        )
         if optimized_segments:
             optimized_segments[-1].length = (
                 audio.duration_seconds - optimized_segments[-1].start
             )
         else:
+            from pydiar.models import Segment
+
             optimized_segments = [
                 Segment(start=0, length=audio.duration_seconds, speaker_id=1)
             ]
-        with ThreadPoolExecutor() as executor:
-            task.state = TranscriptionState.TRANSCRIBING
-            return list(
-                executor.map(
-                    lambda segment: transcribe_raw_data(
-                        model,
-                        f"Speaker {int(segment.speaker_id)} ({fileName})",
-                        audio,
-                        segment.start,
-                        segment.length,
-                        task.set_transcription_progress,
-                    ),
-                    optimized_segments,
-                )
+        segments = [
+            (
+                f"Speaker {int(segment.speaker_id)} ({fileName})",
+                float(segment.start),
+                float(segment.length),
             )
+            for segment in optimized_segments
+        ]
+
+    checkpoint = start_checkpoint(
+        task,
+        transcription_model,
+        segments,
+        not diarize,
+        (
+            result_cache_key(
+                audio_hash, transcription_model, diarize, diarize_max_speakers
+            )
+            if audio_hash is not None
+            else None
+        ),
+        source_path,
+        audio_hash,
+    )
+    if checkpoint is None or source_path is not None:
+        return finish_transcription(
+            task, recognizers, audio, segments, not diarize, checkpoint
+        )
+    with CheckpointAudioWriter(checkpoint.path) as writer:
+        writer.write_samples(audio.samples)
+        return finish_transcription(
+            task, recognizers, audio, segments, not diarize, checkpoint
+        )
 
 
-def transform_vosk_result(
-    name: str, result: dict, length: float, offset: float = 0
-) -> dict:
-    content = []
-    current_time = 0
+def finish_transcription(
+    task: TranscriptionTask,
+    recognizers: RecognizerPool,
+    audio: AudioSource,
+    segments: List[Tuple[str, float, float]],
+    stitch: bool,
+    checkpoint: Optional[Checkpoint],
+) -> Transcript:
+    """
+    Transcribes the segments. If stitch is set, they are the chunks of a single
+    paragraph, otherwise every segment becomes a paragraph.
+    """
+    task.state = TranscriptionState.TRANSCRIBING
+    paragraphs = transcribe_segments(
+        recognizers,
+        audio,
+        segments,
+        task.set_transcription_progress,
+        checkpoint,
+        start_live_transcript(task.uuid, segments, stitch),
+    )
+    if stitch:
+        return stitch_chunks(segments[0][0], paragraphs)
+    return Transcript.concat(paragraphs)
 
-    for word in result.get("result", []):
-        word_start = word["start"]
 
-        if word["start"] > current_time:
-            if (word["start"] - current_time) > 10 * EPSILON:
-                content.append(
-                    {
-                        "sourceStart": current_time + offset,
-                        "length": word["start"] - current_time,
-                        "type": "silence",
-                    }
-                )
-            else:
-                word_start = current_time
-
-        content.append(
-            {
-                "sourceStart": word_start + offset,
-                "length": word["end"] - word["start"],
-                "type": "word",
-                "word": word["word"],
-                "conf": word["conf"],
-            }
-        )
-        current_time = word["end"]
-    if current_time < length:
-        if (length - current_time) < 10 * EPSILON and content:
-            content[-1]["length"] += length - current_time
-        else:
-            content.append(
+def diarize_audio(
+    task: TranscriptionTask,
+    audio: AudioSource,
+    diarize_max_speakers: Optional[int],
+    audio_hash: Optional[str],
+) -> List["Segment"]:
+    """
+    Runs the speaker diarization, or takes its segments from the cache if the
+    same audio was diarized with the same settings before.
+    """
+    # pydiar pulls in scikit-learn and scipy, which take seconds to import
+    from pydiar.models import BinaryKeyDiarizationModel, Segment
+    from pydiar.util.misc import optimize_segments
+
+    key = f"{audio_hash}-{SAMPLE_RATE}-{diarize_max_speakers}"
+    cached = diarization_cache.get(key) if audio_hash is not None else None
+    if cached is not None:
+        task.diarization_from_cache = True
+        task.diarization_time_saved = cached["duration"]
+        return [Segment(*segment) for segment in cached["segments"]]
+
+    task.diarization_from_cache = False
+    task.state = TranscriptionState.DIARIZING
+    start = time.monotonic()
+    try:
+        diarization_model = BinaryKeyDiarizationModel()
+        if diarize_max_speakers is not None:
+            diarization_model.CLUSTERING_SELECTION_MAX_SPEAKERS = diarize_max_speakers
+        segments = diarization_model.diarize(SAMPLE_RATE, audio.samples)
+        optimized_segments = optimize_segments(segments)
+    except:  # noqa: E722
+        traceback.print_exc()
+        # failures are not cached, they might not happen on the next try
+        return []
+
+    if audio_hash is not None:
+        try:
+            diarization_cache.put(
+                key,
                 {
-                    "sourceStart": current_time + offset,
-                    "length": length - current_time,
-                    "type": "silence",
-                }
+                    "duration": time.monotonic() - start,
+                    "segments": [
+                        (
+                            float(segment.start),
+                            float(segment.length),
+                            int(segment.speaker_id),
+                        )
+                        for segment in optimized_segments
+                    ],
+                },
             )
+        except OSError:
+            traceback.print_exc()
+    return optimized_segments
+
+
+def transcribe_segments(
+    recognizers: RecognizerPool,
+    audio: AudioSource,
+    segments: List[Tuple[str, float, float]],
+    process_callback,
+    checkpoint: Optional[Checkpoint] = None,
+    live: Optional[LiveTranscript] = None,
+) -> List[Transcript]:
+    """
+    Transcribes (name, start, length) segments of the audio in parallel, using the
+    configured backend. Segments continue from the utterances in the checkpoint,
+    new utterances are added to it and to the live transcript.
+    """
+    resume = [resume_point(checkpoint, segment) for segment in range(len(segments))]
+    for segment, (resume_position, words) in enumerate(resume):
+        process_callback(resume_position)
+        if live is not None:
+            live.add_words(segment, words)
+
+    def utterance_callback(segment: int, position: float, words: List[dict]):
+        if checkpoint is not None:
+            checkpoint.add(segment, position, words)
+        if live is not None:
+            live.add_words(segment, words)
+
+    if TRANSCRIPTION_BACKEND == "process":
+        paragraphs = process_backend.transcribe_segments(
+            recognizers.model_path,
+            audio.samples,
+            segments,
+            process_callback,
+            resume,
+            utterance_callback,
+        )
+        if live is not None:
+            for segment, paragraph in enumerate(paragraphs):
+                live.finish_segment(segment, paragraph)
+        return paragraphs
+
+    def transcribe_segment(segment: int):
+        name, offset, duration = segments[segment]
+        resume_position, words = resume[segment]
+        paragraph = transcribe_raw_data(
+            recognizers,
+            name,
+            audio,
+            offset,
+            duration,
+            process_callback,
+            resume_position,
+            words,
+            partial(utterance_callback, segment),
+        )
+        if live is not None:
+            live.finish_segment(segment, paragraph)
+        return paragraph
+
+    return list(segment_executor.map(transcribe_segment, range(len(segments))))
+
+
+def resume_point(
+    checkpoint: Optional[Checkpoint], segment: int
+) -> Tuple[float, List[dict]]:
+    """The position up to which a segment was transcribed and the words until then"""
+    if checkpoint is None:
+        return 0, []
+    parts = checkpoint.segment_parts(segment)
+    words = [word for _, utterance in parts for word in utterance]
+    return max((position for position, _ in parts), default=0), words
+
 
-    return {"speaker": name, "content": content}
+def split_segments(name, audio: AudioSource) -> List[Tuple[str, float, float]]:
+    """
+    Splits long audio at quiet points into chunks that can be transcribed in
+    parallel and stitched back together into one paragraph.
+    """
+    split_points = []
+    if PARALLEL_CHUNK_SIZE and audio.duration_seconds > PARALLEL_CHUNK_SIZE * 1.5:
+        split_points = find_split_points(audio.samples, PARALLEL_CHUNK_SIZE)
+    boundaries = [0, *split_points, audio.duration_seconds]
+    return [
+        (name, float(start), float(end - start))
+        for start, end in zip(boundaries, boundaries[1:])
+    ]
@@ -0,0 +1,238 @@
+"""
+Compact storage of transcription results. A transcript of an hour of audio has
+tens of thousands of items, a dict per item needs an order of magnitude more memory
+than their data, so results are kept as columns and only converted to the public
+format of paragraph dicts when they are sent to a client.
+"""
+
+import sys
+from typing import List, Optional, Union
+
+import numpy as np
+
+# word of silence items
+SILENCE = -1
+
+
+class Transcript:
+    """
+    Paragraphs of items (words or silences), stored as one column per item field.
+    Word texts are interned in vocabulary, word holds their index or SILENCE. The
+    items of paragraph i start at paragraph_starts[i]. Transcripts are not changed
+    once built, so they can be shared between tasks and caches.
+    """
+
+    def __init__(
+        self,
+        speakers: List[str],
+        paragraph_starts: np.ndarray,
+        word: np.ndarray,
+        source_start: np.ndarray,
+        length: np.ndarray,
+        conf: np.ndarray,
+        vocabulary: List[str],
+    ):
+        self.speakers = speakers
+        self.paragraph_starts = np.asarray(paragraph_starts, dtype=np.int64)
+        self.word = np.asarray(word, dtype=np.int32)
+        self.source_start = np.asarray(source_start, dtype=np.float64)
+        self.length = np.asarray(length, dtype=np.float64)
+        # confidences are kept as doubles, so they are sent as vosk reported them
+        self.conf = np.asarray(conf, dtype=np.float64)
+        self.vocabulary = vocabulary
+
+    def __deepcopy__(self, memo):
+        # dataclasses.asdict deep copies the fields of tasks
+        return self
+
+    def __len__(self):
+        return len(self.speakers)
+
+    @property
+    def n_items(self) -> int:
+        return len(self.word)
+
+    @property
+    def duration(self) -> float:
+        """End of the last item, in seconds of the source"""
+        if not self.n_items:
+            return 0.0
+        return float(np.max(self.source_start + self.length))
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory used by the transcript"""
+        columns = (self.paragraph_starts, self.word, self.source_start)
+        columns += (self.length, self.conf)
+        return sum(column.nbytes for column in columns) + sum(
+            sys.getsizeof(word) for word in self.vocabulary
+        )
+
+    @classmethod
+    def paragraph(
+        cls,
+        speaker: str,
+        words: List[str],
+        word: np.ndarray,
+        source_start: np.ndarray,
+        length: np.ndarray,
+        conf: np.ndarray,
+    ) -> "Transcript":
+        """A transcript with a single paragraph, word are indices into words"""
+        vocabulary = {}
+        ids = np.fromiter(
+            (vocabulary.setdefault(text, len(vocabulary)) for text in words),
+            np.int32,
+            len(words),
+        )
+        # SILENCE is -1, so it picks the SILENCE appended to the end of ids
+        word = np.append(ids, SILENCE)[word]
+        return cls([speaker], [0], word, source_start, length, conf, list(vocabulary))
+
+    @classmethod
+    def concat(cls, transcripts: List["Transcript"]) -> "Transcript":
+        """Joins the paragraphs of the transcripts into one transcript"""
+        vocabulary = {}
+        speakers, paragraph_starts, word = [], [], []
+        n_items = 0
+        for transcript in transcripts:
+            ids = np.fromiter(
+                (
+                    vocabulary.setdefault(text, len(vocabulary))
+                    for text in transcript.vocabulary
+                ),
+                np.int32,
+                len(transcript.vocabulary),
+            )
+            word.append(np.append(ids, SILENCE)[transcript.word])
+            speakers += transcript.speakers
+            paragraph_starts.append(transcript.paragraph_starts + n_items)
+            n_items += transcript.n_items
+        return cls(
+            speakers,
+            np.concatenate([[], *paragraph_starts]),
+            np.concatenate([[], *word]),
+            np.concatenate([[], *(t.source_start for t in transcripts)]),
+            np.concatenate([[], *(t.length for t in transcripts)]),
+            np.concatenate([[], *(t.conf for t in transcripts)]),
+            list(vocabulary),
+        )
+
+    def with_speakers(self, speakers: List[str]) -> "Transcript":
+        return Transcript(
+            speakers,
+            self.paragraph_starts,
+            self.word,
+            self.source_start,
+            self.length,
+            self.conf,
+            self.vocabulary,
+        )
+
+    def _paragraph_ends(self) -> List[int]:
+        return [*self.paragraph_starts[1:].tolist(), self.n_items]
+
+    def items(self, start: int = 0, end: Optional[int] = None) -> List[dict]:
+        """The items from start to end, in the public format"""
+        texts = np.array([*self.vocabulary, None], dtype=object)[self.word[start:end]]
+        return [
+            (
+                {"sourceStart": s, "length": n, "type": "silence"}
+                if text is None
+                else {
+                    "sourceStart": s,
+                    "length": n,
+                    "type": "word",
+                    "word": text,
+                    "conf": c,
+                }
+            )
+            for s, n, text, c in zip(
+                self.source_start[start:end].tolist(),
+                self.length[start:end].tolist(),
+                texts.tolist(),
+                self.conf[start:end].tolist(),
+            )
+        ]
+
+    def paragraph_items(self, paragraph: int, start: int = 0) -> List[dict]:
+        """The items of a paragraph from its item start on, in the public format"""
+        end = self._paragraph_ends()[paragraph]
+        return self.items(int(self.paragraph_starts[paragraph]) + start, end)
+
+    def to_list(self) -> List[dict]:
+        """The paragraphs in the public format"""
+        items = self.items()
+        return [
+            {"speaker": speaker, "content": items[start:end]}
+            for speaker, start, end in zip(
+                self.speakers, self.paragraph_starts.tolist(), self._paragraph_ends()
+            )
+        ]
+
+    def to_columnar(self) -> dict:
+        """
+        The items as parallel arrays. Paragraph i consists of the items
+        paragraph_starts[i] to paragraph_starts[i + 1] (or the end). word and conf
+        are null for silences.
+        """
+        silence = self.word == SILENCE
+        return {
+            "speakers": self.speakers,
+            "paragraph_starts": self.paragraph_starts.tolist(),
+            "type": np.where(silence, "silence", "word").tolist(),
+            "sourceStart": self.source_start.tolist(),
+            "length": self.length.tolist(),
+            "word": np.array([*self.vocabulary, None], dtype=object)[
+                self.word
+            ].tolist(),
+            "conf": np.where(silence, None, self.conf.astype(object)).tolist(),
+        }
+
+    def to_json(self) -> dict:
+        """A compact json representation, for caches and the task database"""
+        return {
+            "speakers": self.speakers,
+            "paragraph_starts": self.paragraph_starts.tolist(),
+            "vocabulary": self.vocabulary,
+            "word": self.word.tolist(),
+            "source_start": self.source_start.tolist(),
+            "length": self.length.tolist(),
+            "conf": self.conf.tolist(),
+        }
+
+    @classmethod
+    def from_json(cls, data: Union[dict, List[dict]]) -> "Transcript":
+        """Reads to_json output or a list of paragraphs in the public format"""
+        if isinstance(data, dict):
+            return cls(
+                data["speakers"],
+                data["paragraph_starts"],
+                data["word"],
+                data["source_start"],
+                data["length"],
+                data["conf"],
+                data["vocabulary"],
+            )
+        return cls.from_list(data)
+
+    @classmethod
+    def from_list(cls, paragraphs: List[dict]) -> "Transcript":
+        items = [item for paragraph in paragraphs for item in paragraph["content"]]
+        texts = [item.get("word") for item in items]
+        vocabulary = {}
+        for text in texts:
+            if text is not None:
+                vocabulary.setdefault(text, len(vocabulary))
+        paragraph_starts = np.cumsum(
+            [0, *(len(paragraph["content"]) for paragraph in paragraphs[:-1])]
+        )
+        return cls(
+            [paragraph["speaker"] for paragraph in paragraphs],
+            paragraph_starts if paragraphs else [],
+            [SILENCE if text is None else vocabulary[text] for text in texts],
+            [item["sourceStart"] for item in items],
+            [item["length"] for item in items],
+            [item.get("conf", 0) for item in items],
+            list(vocabulary),
+        )
@@ -0,0 +1,156 @@
+"""
+Extraction of zip archives from a stream, reading the local headers in front of
+each member instead of the central directory at the end of the archive. This lets
+models be extracted while they are still downloaded.
+"""
+
+import struct
+import zlib
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, List, Optional
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipFile
+
+CHUNK_SIZE = 1024 * 1024
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+LOCAL_SIGNATURE = b"PK\x03\x04"
+DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+ZIP64_EXTRA = 0x0001
+ZIP64_LIMIT = 0xFFFFFFFF
+FLAG_ENCRYPTED = 0x1
+FLAG_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+
+
+class UnsupportedZip(Exception):
+    """The archive can't be extracted from a stream, use zipfile instead"""
+
+
+class PushbackReader:
+    def __init__(self, source: BinaryIO):
+        self.source = source
+        self.pushed = b""
+
+    def read(self, size: int) -> bytes:
+        if self.pushed:
+            data, self.pushed = self.pushed[:size], self.pushed[size:]
+            return data
+        return self.source.read(size)
+
+    def read_exact(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise BadZipFile("the archive is truncated")
+            data += chunk
+        return data
+
+    def unread(self, data: bytes):
+        self.pushed = data + self.pushed
+
+
+def member_path(name: str, strip_components: int = 1) -> Optional[PurePosixPath]:
+    """The path of a member without its first directories, None to skip it"""
+    parts = PurePosixPath(name).parts[strip_components:]
+    if not parts or name.endswith("/"):
+        return None
+    if ".." in parts or PurePosixPath(name).is_absolute():
+        raise BadZipFile(f"{name} is outside of the archive")
+    return PurePosixPath(*parts)
+
+
+def _zip64_sizes(extra: bytes, size: int, compressed_size: int):
+    position = 0
+    while position + 4 <= len(extra):
+        tag, length = struct.unpack_from("<HH", extra, position)
+        position += 4
+        if tag == ZIP64_EXTRA:
+            values = iter(struct.unpack_from(f"<{length // 8}Q", extra, position))
+            if size == ZIP64_LIMIT:
+                size = next(values)
+            if compressed_size == ZIP64_LIMIT:
+                compressed_size = next(values)
+            return size, compressed_size, True
+        position += length
+    return size, compressed_size, False
+
+
+def extract_zip_stream(
+    source: BinaryIO, target_dir: Path, strip_components: int = 1
+) -> List[str]:
+    """
+    Extracts the members of a zip archive read from source into target_dir and
+    returns their paths (relative to target_dir). The checksum of every member is
+    checked. Raises UnsupportedZip for archives that need the central directory.
+    """
+    stream = PushbackReader(source)
+    extracted = []
+    while True:
+        signature = stream.read_exact(4)
+        if signature != LOCAL_SIGNATURE:
+            # the central directory follows the last member
+            return extracted
+        header = LOCAL_HEADER.unpack(
+            signature + stream.read_exact(LOCAL_HEADER.size - 4)
+        )
+        flags, method = header[2:4]
+        crc, compressed_size, size, name_length, extra_length = header[6:]
+        raw_name = stream.read_exact(name_length)
+        extra = stream.read_exact(extra_length)
+        name = raw_name.decode("utf-8" if flags & FLAG_UTF8 else "cp437")
+        size, compressed_size, zip64 = _zip64_sizes(extra, size, compressed_size)
+        has_descriptor = bool(flags & FLAG_DESCRIPTOR)
+        if flags & FLAG_ENCRYPTED:
+            raise UnsupportedZip(f"{name} is encrypted")
+        if method == ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-15)
+        elif method == ZIP_STORED and not has_descriptor:
+            decompressor = None
+        else:
+            # stored members with a data descriptor have no known end
+            raise UnsupportedZip(f"{name} uses compression method {method}")
+
+        relative = member_path(name, strip_components)
+        path = target_dir / relative if relative is not None else None
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        target = open(path, "wb") if path is not None else None
+        actual_crc = 0
+        written = 0
+        remaining = compressed_size
+        try:
+            while not (decompressor.eof if has_descriptor else remaining == 0):
+                chunk = stream.read(
+                    CHUNK_SIZE if has_descriptor else min(CHUNK_SIZE, remaining)
+                )
+                if not chunk:
+                    raise BadZipFile("the archive is truncated")
+                remaining -= len(chunk)
+                try:
+                    data = (
+                        decompressor.decompress(chunk)
+                        if decompressor is not None
+                        else chunk
+                    )
+                except zlib.error as e:
+                    raise BadZipFile(f"{name} is corrupt: {e}")
+                actual_crc = zlib.crc32(data, actual_crc)
+                written += len(data)
+                if target is not None:
+                    target.write(data)
+        finally:
+            if target is not None:
+                target.close()
+
+        if has_descriptor:
+            stream.unread(decompressor.unused_data)
+            descriptor = stream.read_exact(4)
+            if descriptor == DESCRIPTOR_SIGNATURE:
+                descriptor = stream.read_exact(4)
+            crc = struct.unpack("<I", descriptor)[0]
+            sizes = stream.read_exact(16 if zip64 else 8)
+            size = struct.unpack("<QQ" if zip64 else "<II", sizes)[1]
+        if actual_crc != crc or written != size:
+            raise BadZipFile(f"{name} is corrupt")
+        if relative is not None:
+            extracted.append(str(relative))
@@ -0,0 +1,87 @@
+"""
+Measures the python overhead of cutting the audio into blocks and handing them to
+the recognizer, without the cost of the recognition itself.
+
+Compares the old way of slicing a pydub AudioSegment per block with the
+memoryview based slicing of transcribe_raw_data, for different block sizes.
+"""
+
+import argparse
+import time
+import warnings
+
+import numpy as np
+from vosk import _ffi as vosk_ffi
+
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", ".*ffmpeg.*")
+    from pydub import AudioSegment
+
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+
+class NullRecognizer:
+    def __init__(self):
+        self.fed = 0
+
+    def AcceptWaveform(self, data):
+        self.fed += len(data)
+
+
+def feed_audio_segment(audio: AudioSegment, block_size: float):
+    rec = NullRecognizer()
+    processed = 0
+    duration = audio.duration_seconds
+    while processed < duration:
+        block_end = min(processed + block_size, duration)
+        data = audio[processed * 1000 : block_end * 1000]
+        rec.AcceptWaveform(data.get_array_of_samples().tobytes())
+        processed = block_end
+    return rec.fed
+
+
+def feed_memoryview(samples: np.ndarray, block_size: float):
+    rec = NullRecognizer()
+    data = memoryview(samples).cast("B")
+    block_bytes = int(block_size * SAMPLE_RATE) * SAMPLE_WIDTH
+    for block_start in range(0, len(data), block_bytes):
+        block_end = min(block_start + block_bytes, len(data))
+        rec.AcceptWaveform(vosk_ffi.from_buffer(data[block_start:block_end]))
+    return rec.fed
+
+
+def measure(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=int, default=600)
+    parser.add_argument(
+        "--block-sizes", type=float, nargs="+", default=[2, 1, 0.5, 0.25, 0.1]
+    )
+    args = parser.parse_args()
+
+    samples = np.random.default_rng(0).integers(
+        -(2**15), 2**15, args.seconds * SAMPLE_RATE, dtype=np.int16
+    )
+    audio = AudioSegment(
+        samples.tobytes(), sample_width=SAMPLE_WIDTH, frame_rate=SAMPLE_RATE, channels=1
+    )
+
+    print(f"{args.seconds}s of audio")
+    print(f"{'block size':>10} {'blocks':>8} {'AudioSegment':>16} {'memoryview':>16}")
+    for block_size in args.block_sizes:
+        blocks = int(np.ceil(args.seconds / block_size))
+        old = measure(feed_audio_segment, audio, block_size)
+        new = measure(feed_memoryview, samples, block_size)
+        print(
+            f"{block_size:>9}s {blocks:>8} "
+            f"{old / blocks * 1e6:>11.1f}us/blk {new / blocks * 1e6:>11.1f}us/blk"
+        )
@@ -0,0 +1,94 @@
+"""
+Compares converting a compressed file to wav before the upload (what the clients
+did before the server could decode compressed formats) with streaming the
+original file into the server's ffmpeg decoder: bytes to upload, temporary disk
+usage and the time until the first samples reach the recognizer.
+
+Needs ffmpeg. Run from the server directory as
+`python -m scripts.benchmark_compressed_upload`.
+"""
+
+import argparse
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from app.audio import MediaStreamDecoder
+from app.config import FFMPEG_PATH
+
+CHUNK_SIZE = 64 * 1024
+
+
+def chunks(path: Path):
+    with open(path, "rb") as f:
+        yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+
+
+def decode(path: Path):
+    """(seconds until the first samples, seconds for everything, samples)"""
+    start = time.perf_counter()
+    first = None
+    n_bytes = 0
+    for pcm in MediaStreamDecoder().decode(chunks(path)):
+        if first is None:
+            first = time.perf_counter() - start
+        n_bytes += len(pcm)
+    return first, time.perf_counter() - start, n_bytes // 2
+
+
+def ffmpeg(*args):
+    subprocess.run([FFMPEG_PATH, "-y", "-loglevel", "error", *args], check=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=int, default=600)
+    parser.add_argument("--formats", nargs="+", default=["mp3", "ogg", "flac"])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        source = tmp / "source.wav"
+        # speech-like: noise with a slowly changing loudness, stereo 44.1kHz
+        ffmpeg(
+            "-f",
+            "lavfi",
+            "-i",
+            f"anoisesrc=d={args.duration}:c=pink:a=0.3,"
+            "volume='0.5+0.5*sin(2*PI*t/3)':eval=frame",
+            "-ac",
+            "2",
+            "-ar",
+            "44100",
+            str(source),
+        )
+        print(f"{args.duration}s of audio")
+        print(
+            f"{'format':>8} {'upload':>10} {'temp disk':>10}"
+            f" {'first samples':>14} {'decoded':>10}"
+        )
+        for extension in args.formats:
+            compressed = tmp / f"audio.{extension}"
+            ffmpeg("-i", str(source), str(compressed))
+
+            # before: convert to wav on the client, then upload the wav
+            start = time.perf_counter()
+            converted = tmp / "converted.wav"
+            ffmpeg("-i", str(compressed), str(converted))
+            conversion = time.perf_counter() - start
+            first, total, _ = decode(converted)
+            print(
+                f"{extension + ' wav':>8} {converted.stat().st_size / 1024**2:>8.1f}MB"
+                f" {converted.stat().st_size / 1024**2:>8.1f}MB"
+                f" {(conversion + first) * 1000:>12.0f}ms"
+                f" {(conversion + total) * 1000:>8.0f}ms"
+            )
+            converted.unlink()
+
+            # now: stream the original file into the decoder
+            first, total, _ = decode(compressed)
+            print(
+                f"{extension:>8} {compressed.stat().st_size / 1024**2:>8.1f}MB"
+                f" {0:>8.1f}MB {first * 1000:>12.0f}ms {total * 1000:>8.0f}ms"
+            )
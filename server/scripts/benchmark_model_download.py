@@ -0,0 +1,223 @@
+"""
+Downloads a fake model zip from a local HTTP server that limits the bandwidth of
+each connection, with one and with several parallel connections. Also checks that
+an interrupted download continues where it stopped and that broken connections
+are retried, and compares extracting the model after the download with extracting
+it while it is downloaded.
+
+Run from the server directory as `python -m scripts.benchmark_model_download`.
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from app.download import RangeDownload, download_file
+from app.models import extract_model, extract_while_downloading
+
+
+class FakeModelServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data: bytes, rate: float):
+        super().__init__(("127.0.0.1", 0), RangeHandler)
+        self.data = data
+        # bytes per second and connection
+        self.rate = rate
+        self.etag = '"v1"'
+        # the next response is cut off after this many bytes
+        self.fail_after = None
+        self.accepts_ranges = True
+        self.requests = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/vosk-model-fake.zip"
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server: FakeModelServer = self.server
+        server.requests += 1
+        data = server.data
+        start, end = 0, len(data)
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if (
+            server.accepts_ranges
+            and range_header is not None
+            and if_range in (None, server.etag)
+        ):
+            first, last = range_header.removeprefix("bytes=").split("-")
+            start, end = int(first), min(int(last) + 1, len(data))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("ETag", server.etag)
+        self.end_headers()
+
+        limit, server.fail_after = server.fail_after, None
+        block = max(int(server.rate / 100), 1)
+        for position in range(start, end, block):
+            if limit is not None and position - start >= limit:
+                # a broken connection
+                return
+            try:
+                self.wfile.write(data[position : min(position + block, end)])
+            except ConnectionError:
+                # the client stopped the download
+                return
+            time.sleep(block / server.rate)
+
+
+def fake_model_zip(size: int) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr("vosk-model-fake/conf/model.conf", "--sample-frequency=16000")
+        archive.writestr("vosk-model-fake/am/final.mdl", os.urandom(size))
+    return buffer.getvalue()
+
+
+def sha256(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=32 * 1024**2)
+    parser.add_argument("--rate", type=float, default=16 * 1024**2)
+    parser.add_argument("--part-size", type=int, default=2 * 1024**2)
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    data = fake_model_zip(args.size)
+    expected = hashlib.sha256(data).hexdigest()
+    server = FakeModelServer(data, args.rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print(
+            f"{len(data) / 1024**2:.0f}MB at {args.rate / 1024**2:.0f}MB/s per connection"
+        )
+        for connections in args.connections:
+            start = time.perf_counter()
+            path = download_file(
+                server.url,
+                tmp / f"parallel-{connections}",
+                lambda processed, total: None,
+                connections=connections,
+                part_size=args.part_size,
+            )
+            elapsed = time.perf_counter() - start
+            assert sha256(path) == expected
+            print(
+                f"{connections:>2} connections: {elapsed:6.2f}s"
+                f" {len(data) / elapsed / 1024**2:6.1f}MB/s"
+            )
+
+        # stop halfway, then continue
+        directory = tmp / "resumed"
+        stop_at = len(data) // 2
+        progress = {"processed": 0}
+
+        def on_progress(processed, total):
+            progress["processed"] = processed
+
+        try:
+            download_file(
+                server.url,
+                directory,
+                on_progress,
+                lambda: progress["processed"] >= stop_at,
+                connections=4,
+                part_size=args.part_size,
+            )
+        except Exception as e:
+            print(f"interrupted after {progress['processed']} bytes ({e!r})")
+        requests_before = server.requests
+        resumed_from = {}
+
+        def on_resume(processed, total):
+            resumed_from.setdefault("processed", processed)
+
+        path = download_file(
+            server.url, directory, on_resume, connections=4, part_size=args.part_size
+        )
+        assert sha256(path) == expected
+        print(
+            f"resumed at {resumed_from['processed']} bytes,"
+            f" {server.requests - requests_before} requests to finish"
+        )
+
+        # a connection that breaks in the middle of a part is retried
+        server.fail_after = args.part_size // 3
+        path = download_file(
+            server.url,
+            tmp / "retried",
+            lambda processed, total: None,
+            connections=4,
+            part_size=args.part_size,
+        )
+        assert sha256(path) == expected
+        print("broken connection retried")
+
+        # parts of a changed file are not reused
+        server.data = fake_model_zip(args.size)
+        server.etag = '"v2"'
+        path = download_file(
+            server.url,
+            directory,
+            lambda processed, total: None,
+            connections=4,
+            part_size=args.part_size,
+        )
+        assert sha256(path) == hashlib.sha256(server.data).hexdigest()
+        extract_model(path, tmp / "extracted")
+        assert (tmp / "extracted" / "conf" / "model.conf").exists()
+        print("changed file downloaded again and extracted")
+
+        # extracting after the download vs while downloading
+        start = time.perf_counter()
+        path = download_file(
+            server.url,
+            tmp / "sequential",
+            lambda processed, total: None,
+            part_size=args.part_size,
+        )
+        extract_model(path, tmp / "sequential-model")
+        print(f"download then extract: {time.perf_counter() - start:6.2f}s")
+        for accepts_ranges in (True, False):
+            server.accepts_ranges = accepts_ranges
+            start = time.perf_counter()
+            download = RangeDownload(
+                server.url,
+                tmp / f"pipelined-{accepts_ranges}",
+                lambda processed, total: None,
+                part_size=args.part_size,
+            ).start()
+            extracted = extract_while_downloading(download, tmp / "pipelined-model")
+            download.wait()
+            pipelined = time.perf_counter() - start
+            assert sorted(extracted) == ["am/final.mdl", "conf/model.conf"]
+            assert sha256(tmp / "pipelined-model" / "am" / "final.mdl") == sha256(
+                tmp / "sequential-model" / "am" / "final.mdl"
+            )
+            print(
+                f"extract while downloading: {pipelined:6.2f}s"
+                + ("" if accepts_ranges else " (without range requests)")
+            )
+    server.shutdown()
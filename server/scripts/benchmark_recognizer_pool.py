@@ -0,0 +1,71 @@
+"""
+Compares transcribing many short segments with a fresh KaldiRecognizer per segment
+to reusing the recognizers of a RecognizerPool, as the diarized transcription does.
+
+Run from the server directory:
+    poetry run python -m scripts.benchmark_recognizer_pool path/to/model
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from vosk import KaldiRecognizer, Model, SetLogLevel
+
+from app.audio import SAMPLE_RATE
+from app.models import RecognizerPool
+
+
+def transcribe_fresh(model: Model, segment: bytes):
+    rec = KaldiRecognizer(model, SAMPLE_RATE)
+    rec.SetWords(True)
+    rec.AcceptWaveform(segment)
+    return rec.FinalResult()
+
+
+def transcribe_pooled(pool: RecognizerPool, segment: bytes):
+    with pool.recognizer() as rec:
+        rec.AcceptWaveform(segment)
+        return rec.FinalResult()
+
+
+def run(fn, target, segments, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(lambda segment: fn(target, segment), segments))
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="path to an extracted vosk model")
+    parser.add_argument("--segments", type=int, default=300)
+    parser.add_argument("--segment-length", type=float, default=1.5)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    SetLogLevel(-1)
+    model = Model(args.model)
+    pool = RecognizerPool(args.model, args.threads, model)
+
+    rng = np.random.default_rng(0)
+    segment_samples = int(args.segment_length * SAMPLE_RATE)
+    segments = [
+        rng.normal(0, 500, segment_samples).astype(np.int16).tobytes()
+        for _ in range(args.segments)
+    ]
+    whole = b"".join(segments)
+
+    # warm up the page cache and the pool
+    run(transcribe_pooled, pool, segments[: args.threads], args.threads)
+
+    undiarized = run(transcribe_pooled, pool, [whole], 1)
+    fresh = run(transcribe_fresh, model, segments, args.threads)
+    pooled = run(transcribe_pooled, pool, segments, args.threads)
+
+    audio_seconds = args.segments * args.segment_length
+    print(f"{args.segments} segments of {args.segment_length}s ({audio_seconds}s)")
+    print(f"single segment (undiarized): {undiarized:8.2f}s")
+    print(f"fresh recognizer per segment: {fresh:8.2f}s")
+    print(f"pooled recognizers:           {pooled:8.2f}s")
@@ -0,0 +1,132 @@
+"""
+Measures how long it takes to encode a big transcription result and how large the
+response is, for the old jsonable_encoder based response and the encoders of
+app/results.py, with and without compression. Encode times include the conversion
+from the in memory columns. It also compares the conversion of a result for
+GET /tasks/{uuid}/ from paragraph dicts (as results used to be kept) and from
+columns.
+
+Run from the server directory as `python -m scripts.benchmark_result_encoding`.
+"""
+
+import argparse
+import gzip
+import json
+import random
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+from app.results import (
+    GZIP_LEVEL,
+    ZSTD_LEVEL,
+    encode_json,
+    orjson,
+    zstandard,
+)
+from app.transcript import Transcript
+
+WORDS = "the of and to a in is you that it he was for on are as with his they I".split()
+
+
+def synthetic_result(n_words: int, paragraph_length: int = 200):
+    rng = random.Random(0)
+    content = []
+    position = 0.0
+    for start in range(0, n_words, paragraph_length):
+        items = []
+        for _ in range(min(paragraph_length, n_words - start)):
+            length = round(rng.uniform(0.1, 0.8), 2)
+            items.append(
+                {
+                    "type": "word",
+                    "sourceStart": round(position, 2),
+                    "length": length,
+                    "word": rng.choice(WORDS),
+                    "conf": round(rng.random(), 6),
+                }
+            )
+            position += length
+            if rng.random() < 0.1:
+                silence = round(rng.uniform(0.1, 1), 2)
+                items.append(
+                    {
+                        "type": "silence",
+                        "sourceStart": round(position, 2),
+                        "length": silence,
+                    }
+                )
+                position += silence
+        content.append({"speaker": f"Speaker {len(content) % 3}", "content": items})
+    return content
+
+
+def measure(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def encode_jsonable(content: Transcript):
+    return json.dumps(jsonable_encoder(content.to_list())).encode()
+
+
+def encode_stdlib(content: Transcript):
+    return json.dumps(content.to_list(), separators=(",", ":")).encode()
+
+
+def encode_orjson(content: Transcript):
+    return orjson.dumps(content.to_list())
+
+
+def encode_columnar(content: Transcript):
+    return encode_json(content.to_columnar())
+
+
+def encode_columns_for_task(content: Transcript):
+    return jsonable_encoder(content, custom_encoder={Transcript: Transcript.to_list})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--words", type=int, default=100_000)
+    args = parser.parse_args()
+
+    paragraphs = synthetic_result(args.words)
+    content = Transcript.from_list(paragraphs)
+    encoders = [
+        ("jsonable_encoder", encode_jsonable),
+        ("json.dumps", encode_stdlib),
+    ]
+    if orjson is not None:
+        encoders.append(("orjson", encode_orjson))
+    encoders.append(("columnar", encode_columnar))
+
+    print(f"{args.words} words")
+    print(
+        f"{'encoder':>16} {'encode':>10} {'raw':>10}"
+        f" {'gzip':>10} {'gzip time':>10} {'zstd':>10} {'zstd time':>10}"
+    )
+    for name, encoder in encoders:
+        encode_time, data = measure(encoder, content)
+        gzip_time, gzipped = measure(gzip.compress, data, GZIP_LEVEL)
+        if zstandard is not None:
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            zstd_time, compressed = measure(compressor.compress, data)
+            zstd = f"{len(compressed) / 1024:>8.0f}KB {zstd_time * 1000:>8.1f}ms"
+        else:
+            zstd = f"{'-':>10} {'-':>10}"
+        print(
+            f"{name:>16} {encode_time * 1000:>8.1f}ms {len(data) / 1024:>8.0f}KB"
+            f" {len(gzipped) / 1024:>8.0f}KB {gzip_time * 1000:>8.1f}ms {zstd}"
+        )
+
+    print()
+    print("GET /tasks/{uuid}/ conversion (see encode_task in app/main.py)")
+    dicts_time, _ = measure(jsonable_encoder, paragraphs)
+    columns_time, _ = measure(encode_columns_for_task, content)
+    print(f"{'dicts':>16} {dicts_time * 1000:>8.1f}ms")
+    print(f"{'columns':>16} {columns_time * 1000:>8.1f}ms")
@@ -0,0 +1,65 @@
+"""
+Measures the memory used by a finished transcription result, as a list of item
+dicts and as a Transcript, and how long the conversion of vosk words takes.
+
+Run from the server directory as `python -m scripts.benchmark_result_memory`.
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+from app.recognition import transform_vosk_result
+
+from .benchmark_result_encoding import WORDS
+
+
+def synthetic_vosk_result(n_words: int):
+    words = []
+    position = 0.0
+    for i in range(n_words):
+        # a pause after every tenth word
+        start = position + (0.5 if i % 10 == 0 else 0)
+        end = start + 0.1 + (i % 7) * 0.05
+        words.append(
+            {"word": WORDS[i % len(WORDS)], "start": start, "end": end, "conf": 0.9}
+        )
+        position = end
+    # words from vosk are parsed from json, so they don't share float objects
+    return json.loads(json.dumps({"result": words})), position
+
+
+def allocated(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--words", type=int, default=100_000)
+    args = parser.parse_args()
+
+    vosk_result, length = synthetic_vosk_result(args.words)
+
+    start = time.perf_counter()
+    transcript = transform_vosk_result("speaker", vosk_result, length)
+    transform_time = time.perf_counter() - start
+    _, transcript_size, _ = allocated(
+        transform_vosk_result, "speaker", vosk_result, length
+    )
+    _, dicts_size, to_list_time = allocated(transcript.to_list)
+
+    print(f"{args.words} words, {transcript.n_items} items")
+    print(f"transform_vosk_result: {transform_time * 1000:.1f}ms")
+    print(f"to_list: {to_list_time * 1000:.1f}ms")
+    print(f"list of dicts: {dicts_size / 1024 / 1024:.1f}MB")
+    print(
+        f"Transcript: {transcript_size / 1024 / 1024:.1f}MB"
+        f" ({transcript.nbytes / 1024 / 1024:.1f}MB of columns)"
+    )
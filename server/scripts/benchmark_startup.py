@@ -0,0 +1,105 @@
+"""
+Measures how long importing the server takes, which the app waits for before the
+server reports that it started. Imports app.main in fresh interpreters with
+`python -X importtime` and breaks the time down by top level package, and by module
+of the app. Also compares loading the compiled model catalog with parsing
+models.yml.
+
+Run from the server directory as `python -m scripts.benchmark_startup`.
+"""
+
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from statistics import median
+
+from app.models import CATALOG_PATH, CATALOG_SOURCE_PATH
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_times(module: str):
+    """(wall time, self time by module, cumulative time of the top level imports)"""
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    wall = time.perf_counter() - start
+    self_times = {}
+    top_level = {}
+    for match in LINE.finditer(output):
+        self_us, cumulative_us, indent, name = match.groups()
+        self_times[name] = int(self_us) / 1e6
+        if len(indent) == 1:
+            top_level[name] = int(cumulative_us) / 1e6
+    return wall, self_times, top_level
+
+
+def measure(fn, repeat=20):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def load_yaml():
+    import yaml
+
+    with open(CATALOG_SOURCE_PATH) as f:
+        return yaml.safe_load(f)
+
+
+def load_json():
+    with open(CATALOG_PATH) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(args.repeat)]
+    by_package = defaultdict(list)
+    by_app_module = defaultdict(list)
+    for _, self_times, _ in runs:
+        packages = defaultdict(float)
+        for name, seconds in self_times.items():
+            packages[name.split(".")[0]] += seconds
+            if name.startswith("app."):
+                by_app_module[name].append(seconds)
+        for package, seconds in packages.items():
+            by_package[package].append(seconds)
+
+    print(
+        f"import {args.module}: {median(run[0] for run in runs) * 1000:.0f}ms"
+        f" (interpreter included),"
+        f" {median(sum(run[2].values()) for run in runs) * 1000:.0f}ms importing"
+    )
+    print(f"\n{'package':>24} {'self time':>10}")
+    for package, seconds in sorted(
+        by_package.items(), key=lambda item: -median(item[1])
+    )[: args.top]:
+        print(f"{package:>24} {median(seconds) * 1000:>8.1f}ms")
+    print(f"\n{'app module':>24} {'self time':>10}")
+    for name, seconds in sorted(
+        by_app_module.items(), key=lambda item: -median(item[1])
+    ):
+        print(f"{name:>24} {median(seconds) * 1000:>8.1f}ms")
+
+    assert load_yaml() == load_json(), "models.json is outdated"
+    print(
+        f"\nmodel catalog: models.yml {measure(load_yaml) * 1000:.1f}ms,"
+        f" models.json {measure(load_json) * 1000:.2f}ms"
+    )
@@ -1,5 +1,5 @@
 import argparse
-import time
+import json
 
 import requests
 from rich.live import Live
@@ -7,27 +7,53 @@ from rich.table import Table
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--server", default="http://127.0.0.1:8000")
+parser.add_argument("--token")
 args = parser.parse_args()
 
+headers = {}
+if args.token:
+    headers["Authorization"] = f"Bearer {args.token}"
 
-def generate_table() -> Table:
+
+def generate_table(tasks) -> Table:
     """Make a new table."""
-    tasks = requests.get(f"{args.server}/tasks/list/")
     table = Table(title="Tasks")
 
     table.add_column("UUID")
-    table.add_column("Filename")
+    table.add_column("Type")
+    table.add_column("Filename / Model")
     table.add_column("State")
 
-    for task in tasks.json():
+    for task in sorted(tasks.values(), key=lambda task: task["uuid"]):
         state = task["state"]
-        if state == "transcribing":
-            state += f" ({task['processed']/task['total']:%}%)"
-        table.add_row(task["uuid"], task["filename"], state)
+        if state in ("transcribing", "downloading"):
+            state += f" ({task['progress']:.1%})"
+        table.add_row(
+            task["uuid"],
+            task["type"],
+            task.get("filename", task.get("model_id", "")),
+            state,
+        )
     return table
 
 
-with Live(generate_table(), refresh_per_second=4) as live:
-    while True:
-        time.sleep(0.1)
-        live.update(generate_table())
+def task_events():
+    """Yields (event, data) of the server's task event stream"""
+    response = requests.get(f"{args.server}/tasks/events", headers=headers, stream=True)
+    response.raise_for_status()
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            event = line[len("event: ") :]
+        elif line.startswith("data: "):
+            yield event, json.loads(line[len("data: ") :])
+
+
+tasks = {}
+with Live(generate_table(tasks), refresh_per_second=4) as live:
+    for event, data in task_events():
+        if event == "task":
+            tasks[data["uuid"]] = data
+        elif event == "deleted":
+            tasks.pop(data["uuid"], None)
+        live.update(generate_table(tasks))
@@ -1,16 +1,36 @@
 import argparse
+import glob
 import hashlib
 import json
-import subprocess
-import tempfile
-import time
 import uuid
 import zipfile
+from collections import Counter
+from contextlib import ExitStack
 from pathlib import Path
+from typing import List
 
 import requests
 import tqdm
 
+# ffmpeg needs to seek in these containers (their index might be at the end of the
+# file), so they are uploaded as a whole instead of streamed
+SEEKING_FORMATS = {".mp4", ".m4a", ".m4v", ".mov", ".3gp"}
+# files of a directory that are transcribed
+MEDIA_FORMATS = {
+    ".wav",
+    ".mp3",
+    ".ogg",
+    ".oga",
+    ".opus",
+    ".flac",
+    ".aac",
+    ".wma",
+    ".webm",
+    ".mkv",
+    ".avi",
+    *SEEKING_FORMATS,
+}
+
 
 def sha256sum(filename, blocksize=65536):
     hash = hashlib.sha256()
@@ -87,60 +107,236 @@ def save_result(file, output_file, source_hash, content, language, diarize):
         audapolis_zip.writestr("document.json", json.dumps(document, indent=4))
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("file", type=Path)
-    parser.add_argument("--language")
-    parser.add_argument("--transcription-model")
-    parser.add_argument("--server", default="http://127.0.0.1:8000")
-    parser.add_argument("--token")
-    parser.add_argument("--diarize", action="store_true")
-    args = parser.parse_args()
+def fetch_result(server: str, task_uuid: str, headers: dict) -> list:
+    """The paragraphs of a finished transcription"""
+    result_req = requests.get(f"{server}/tasks/{task_uuid}/result", headers=headers)
+    result_req.raise_for_status()
+    return result_req.json()
 
-    headers = {}
-    if args.token:
-        headers["Authorization"] = f"Bearer {args.token}"
 
-    tmpfile = tempfile.NamedTemporaryFile(suffix=".wav")
-    if args.file.suffix != ".wav":
-        subprocess.check_call(["ffmpeg", "-y", "-i", str(args.file), tmpfile.name])
-        server_file = tmpfile.name
-    else:
-        server_file = args.file
-
-    print(f"Uploading {args.file}")
-    upload_req = requests.post(
-        f"{args.server}/tasks/start_transcription/",
-        files={"file": open(server_file, "rb")},
-        params={
-            "transcription_model": f"transcription-{args.language}-{args.transcription_model}",
-            "diarize": args.diarize,
-        },
-        data={"fileName": str(args.file)},
-        headers=headers,
+def save_task_result(file: Path, output_file: Path, content: list, language, diarize):
+    save_result(
+        file,
+        output_file,
+        sha256sum(file),
+        content,
+        language,
+        diarize,
     )
 
+
+def start_transcription(
+    server: str, file: Path, params: dict, headers: dict, local: bool
+) -> dict:
+    if local:
+        upload_req = requests.post(
+            f"{server}/tasks/start_transcription_local/",
+            params={**params, "path": str(file.resolve()), "fileName": str(file)},
+            headers=headers,
+        )
+        upload_req.raise_for_status()
+        return upload_req.json()
+
+    print(f"Uploading {file}")
+    # the server decodes compressed audio and video itself (with ffmpeg)
+    with open(file, "rb") as f:
+        if file.suffix.lower() in SEEKING_FORMATS:
+            upload_req = requests.post(
+                f"{server}/tasks/start_transcription/",
+                files={"file": (file.name, f)},
+                data={"fileName": str(file)},
+                params=params,
+                headers=headers,
+            )
+        else:
+            # the streaming endpoint starts transcribing while we are still
+            # uploading, the hash lets it answer from its cache right away
+            upload_req = requests.post(
+                f"{server}/tasks/start_transcription_stream/",
+                data=f,
+                params={
+                    **params,
+                    "fileName": str(file),
+                    "audio_hash": sha256sum(file),
+                },
+                headers=headers,
+            )
+    upload_req.raise_for_status()
+    return upload_req.json()
+
+
+def batch_files(pattern: str) -> List[Path]:
+    """The media files of a directory, or the files matching a glob pattern"""
+    if Path(pattern).is_dir():
+        return sorted(
+            path
+            for path in Path(pattern).iterdir()
+            if path.is_file() and path.suffix.lower() in MEDIA_FORMATS
+        )
+    return sorted(Path(path) for path in glob.glob(pattern) if Path(path).is_file())
+
+
+def output_files(files: List[Path]) -> List[Path]:
+    """Where the results are written, files with the same stem keep their suffix"""
+    stems = Counter(file.with_suffix("") for file in files)
+    return [
+        (
+            file.with_suffix(".audapolis")
+            if stems[file.with_suffix("")] == 1
+            else file.with_name(f"{file.name}.audapolis")
+        )
+        for file in files
+    ]
+
+
+def start_batch(
+    server: str,
+    files: List[Path],
+    params: dict,
+    headers: dict,
+    local: bool,
+    parallel: int,
+) -> dict:
+    params = {**params, "max_parallel": parallel}
+    if local:
+        batch_req = requests.post(
+            f"{server}/tasks/start_transcription_batch/",
+            data={"paths": [str(file.resolve()) for file in files]},
+            params=params,
+            headers=headers,
+        )
+        batch_req.raise_for_status()
+        return batch_req.json()
+
+    print(f"Uploading {len(files)} files")
+    with ExitStack() as stack:
+        batch_req = requests.post(
+            f"{server}/tasks/start_transcription_batch/",
+            files=[
+                ("files", (file.name, stack.enter_context(open(file, "rb"))))
+                for file in files
+            ],
+            params=params,
+            headers=headers,
+        )
+    batch_req.raise_for_status()
+    return batch_req.json()
+
+
+def transcribe_file(args, params: dict, headers: dict):
+    task = start_transcription(args.server, args.file, params, headers, args.local)
+
     pbar = tqdm.tqdm(total=100)
 
-    while True:
+    # long poll: the server answers as soon as the task changed
+    while task["state"] not in ("done", "failed"):
         status_req = requests.get(
-            f"{args.server}/tasks/{upload_req.json()['uuid']}/", headers=headers
+            f"{args.server}/tasks/{task['uuid']}/",
+            params={"since": task["version"]},
+            headers=headers,
         )
-        if status_req.json()["state"] == "done":
-            break
+        status_req.raise_for_status()
+        task = status_req.json()
 
-        time.sleep(0.1)
-
-        pbar.update((status_req.json()["progress"] * 100) - pbar.n)
-        pbar.set_description(status_req.json()["state"])
+        pbar.update((task["progress"] * 100) - pbar.n)
+        pbar.set_description(task["state"])
 
+    if task["state"] == "failed":
+        raise Exception(f"Transcription failed: {task.get('error')}")
     pbar.update(100 - pbar.n)
     pbar.close()
 
-    content = status_req.json()["content"]
-    source_hash = sha256sum(args.file)
+    save_task_result(
+        args.file,
+        args.file.with_suffix(".audapolis"),
+        fetch_result(args.server, task["uuid"], headers),
+        args.language,
+        args.diarize,
+    )
+
 
-    output_file = args.file.with_suffix(".audapolis")
-    save_result(
-        args.file, output_file, source_hash, content, args.language, args.diarize
+def transcribe_batch(args, files: List[Path], params: dict, headers: dict):
+    """Writes the result of each file as soon as it is done"""
+    batch = start_batch(args.server, files, params, headers, args.local, args.parallel)
+    pbar = tqdm.tqdm(total=100)
+    finished = set()
+    failed = []
+    while True:
+        for file, output_file, entry in zip(files, output_files(files), batch["files"]):
+            if entry["uuid"] in finished or entry["state"] not in ("done", "failed"):
+                continue
+            finished.add(entry["uuid"])
+            if entry["state"] == "failed":
+                failed.append(file)
+                pbar.write(f"Transcribing {file} failed: {entry.get('error')}")
+                continue
+            save_task_result(
+                file,
+                output_file,
+                fetch_result(args.server, entry["uuid"], headers),
+                args.language,
+                args.diarize,
+            )
+
+        pbar.update((batch["progress"] * 100) - pbar.n)
+        pbar.set_description(f"{batch['done']}/{len(files)} done")
+        if batch["state"] in ("done", "failed"):
+            break
+        # long poll: the server answers as soon as the batch changed
+        status_req = requests.get(
+            f"{args.server}/tasks/{batch['uuid']}/",
+            params={"since": batch["version"]},
+            headers=headers,
+        )
+        status_req.raise_for_status()
+        batch = status_req.json()
+    pbar.close()
+
+    if batch["state"] == "failed" or failed:
+        raise Exception(
+            f"{len(files) - batch['done']} of {len(files)} transcriptions failed"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "file",
+        help="a media file, or a directory or glob pattern (quoted) to transcribe"
+        " all of its files as a batch",
+    )
+    parser.add_argument("--language")
+    parser.add_argument("--transcription-model")
+    parser.add_argument("--server", default="http://127.0.0.1:8000")
+    parser.add_argument("--token")
+    parser.add_argument("--diarize", action="store_true")
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="let the server read the file from disk instead of uploading it"
+        " (the server has to run on this machine and be allowed to read it)",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=2,
+        help="number of files of a batch that are transcribed at the same time",
     )
+    args = parser.parse_args()
+
+    headers = {}
+    if args.token:
+        headers["Authorization"] = f"Bearer {args.token}"
+
+    params = {
+        "transcription_model": f"transcription-{args.language}-{args.transcription_model}",
+        "diarize": args.diarize,
+    }
+    if Path(args.file).is_file():
+        args.file = Path(args.file)
+        transcribe_file(args, params, headers)
+    else:
+        files = batch_files(args.file)
+        if not files:
+            parser.error(f"no files found for {args.file}")
+        transcribe_batch(args, files, params, headers)